@@ -1,22 +1,88 @@
 """
 Endpoint Cron pour Vercel - Sync rapide toutes les heures
 Synchronise: Arrêts + Pannes récentes
-Tables: parc_arrets, parc_pannes, parc_ascenseurs (flag en_arret), parc_sync_logs
+Tables: parc_arrets, parc_pannes, parc_ascenseurs (flag en_arret), parc_secteurs (cumuls), parc_sync_logs, parc_sync_watermarks
+
+Les pannes sont demandées depuis le début de la dernière sync réussie
+(filigrane 'pannes' moins PANNES_OVERLAP_MINUTES). Sans filigrane valide,
+par exemple après un échec, on repart sur les PANNES_FALLBACK_DAYS derniers jours.
+
+Les pannes transformées passent par le spool d'écriture (SYNC_SPOOL_DIR, partagé
+avec sync.py): si Supabase est indisponible, elles sont rejouées au prochain passage
+exécuté sur la même instance. Sur Vercel, /tmp est propre à chaque instance et
+disparaît avec elle: un segment en attente peut être perdu, la fenêtre de reprise
+(watermark) le retélécharge alors au passage suivant.
+
+parc_pannes_stats (statistiques par appareil) est maintenue par trigger à chaque
+écriture de pannes; le cron recalcule en plus, une fois par jour, les compteurs
+30 / 90 jours qui ont glissé.
+
+Le cron prend les verrous 'arrets' et 'pannes' (parc_sync_locks): si une autre
+sync les détient, le passage est ignoré et tracé dans parc_sync_logs (status "skipped").
 """
 
 import os
 import json
+import hashlib
 import re
 import ssl
+import threading
+import time
 import urllib.request
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from http.server import BaseHTTPRequestHandler
+from itertools import islice
+from urllib.parse import quote
 
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
 PROGILIFT_CODE = os.environ.get('PROGILIFT_CODE', 'AUVNB1')
 WS_URL = "https://ws.progilift.fr/WS_PROGILIFT_20230419_WEB/awws/WS_Progilift_20230419.awws"
 
+# Fenêtre de sync des pannes
+PANNES_FALLBACK_DAYS = 30
+PANNES_OVERLAP_MINUTES = 15
+
+# Nombre d'identifiants par filtre in.() (URL < ~8 Ko)
+IN_FILTER_CHUNK = 300
+
+# Spool d'écriture (même format que sync.py); /tmp ne survit pas à l'instance serverless
+SPOOL_DIR = os.environ.get('SYNC_SPOOL_DIR', '/tmp/parc_spool')
+SPOOL_BATCH_START = 100
+SPOOL_BATCH_MAX = 5000
+# Drains en erreur avant mise à l'écart du segment (<table>/failed/)
+SPOOL_MAX_ATTEMPTS = 5
+UPLOAD_CHUNK = 64 * 1024
+UPLOAD_GZIP = os.environ.get('SYNC_GZIP_UPLOADS', '') == '1'
+
+# Quarantaine des lignes refusées (parc_sync_quarantine, même format que sync.py):
+# seulement les SQLSTATE de ligne (22 = donnée invalide, 23 = contrainte)
+QUARANTINE_SQLSTATE_CLASSES = ('22', '23')
+# Au-delà de ce nombre de refus dans un appel: défaut de schéma, pas de quarantaine
+QUARANTINE_MAX_ROWS = 50
+VOLATILE_COLUMNS = ('synced_at', 'updated_at', 'row_hash')
+
+# Lecture paginée (en-tête Range, tri sur la clé primaire) et pages lues en parallèle
+READ_PAGE_SIZE = 1000
+READ_WORKERS = 4
+PRIMARY_KEYS = {
+    'parc_ascenseurs': 'id_wsoucont',
+    'parc_pannes': 'id_panne',
+    'parc_arrets': 'id',
+    'parc_type_planning': 'id',
+    'parc_sync_watermarks': 'scope',
+    'parc_sync_locks': 'scope'
+}
+
+# Verrous de périmètre partagés avec sync.py (parc_sync_locks), prolongés par heartbeat
+LOCK_TTL = 90
+LOCK_HEARTBEAT = 30
+LOCK_POLL_SECONDS = 5
+
 try:
     ssl_context = ssl.create_default_context()
 except:
@@ -79,7 +145,8 @@ def http_request(url, method='GET', data=None, headers=None, timeout=30):
         with urllib.request.urlopen(req, timeout=timeout, context=ssl_context) as resp:
             return resp.status, resp.read().decode('utf-8')
     except urllib.error.HTTPError as e:
-        return e.code, ''
+        # Corps conservé: l'erreur PostgREST (code SQLSTATE) décide de la quarantaine
+        return e.code, e.read().decode('utf-8', 'replace')
     except Exception as e:
         return 0, str(e)
 
@@ -110,10 +177,10 @@ def supabase_insert(table, data):
     status, _ = http_request(url, 'POST', data, headers, 30)
     return status in [200, 201, 204]
 
-def supabase_delete(table):
+def supabase_delete(table, filter_str=None):
     if not SUPABASE_URL:
         return False
-    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?id=neq.00000000-0000-0000-0000-000000000000"
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?{filter_str or 'id=neq.00000000-0000-0000-0000-000000000000'}"
     status, _ = http_request(url, 'DELETE', None, supabase_headers(), 30)
     return status in [200, 204]
 
@@ -124,17 +191,557 @@ def supabase_update(table, key_col, key_val, data):
     status, _ = http_request(url, 'PATCH', data, supabase_headers(), 15)
     return status in [200, 204]
 
-def supabase_get(table, select="*", filter_str=None):
+def supabase_update_in(table, key_col, keys, data, chunk_size=None):
+    """Update groupé: un PATCH {key_col}=in.(...) par paquet de clés (limite de longueur d'URL)"""
     if not SUPABASE_URL:
-        return []
+        return False
+    chunk_size = chunk_size or IN_FILTER_CHUNK
+    keys = sorted(keys)
+    ok = True
+    for i in range(0, len(keys), chunk_size):
+        ids = ','.join(str(k) for k in keys[i:i+chunk_size])
+        url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?{key_col}=in.({ids})"
+        status, _ = http_request(url, 'PATCH', data, supabase_headers(), 30)
+        ok = ok and status in [200, 204]
+    return ok
+
+def supabase_page(table, select, filter_str, start, end, count=False):
+    """Lignes [start, end] d'une lecture (en-tête Range), et le total exact si count.
+    Lève une exception en cas d'erreur HTTP, une page manquante ne doit pas passer inaperçue."""
     url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?select={select}"
     if filter_str:
         url += f"&{filter_str}"
-    headers = {'apikey': SUPABASE_KEY, 'Authorization': f'Bearer {SUPABASE_KEY}'}
-    status, body = http_request(url, 'GET', None, headers, 30)
-    if status == 200:
-        return json.loads(body)
-    return []
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Range-Unit': 'items',
+        'Range': f'{start}-{end}'
+    }
+    if count:
+        headers['Prefer'] = 'count=exact'
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=30, context=ssl_context) as resp:
+        total = (resp.headers.get('Content-Range') or '*/*').split('/')[-1]
+        return json.loads(resp.read().decode('utf-8')), int(total) if total.isdigit() else None
+
+def supabase_iter(table, select="*", filter_str=None, key=None, page_size=None, workers=None):
+    """Lecture complète d'une table, sans la limite max-rows de PostgREST.
+    Retourne (total exact, générateur de lignes): les pages suivantes sont lues
+    par `workers` requêtes en parallèle et rendues dans l'ordre, au plus
+    `workers` pages en mémoire. Tri sur la clé primaire pour des pages stables."""
+    page_size = page_size or READ_PAGE_SIZE
+    workers = workers or READ_WORKERS
+    key = key or PRIMARY_KEYS.get(table)
+    if key and 'order=' not in (filter_str or ''):
+        filter_str = f"{filter_str}&order={key}.asc" if filter_str else f"order={key}.asc"
+    
+    first, total = supabase_page(table, select, filter_str, 0, page_size - 1, count=True)
+    if total is None:
+        total = len(first)
+    # max-rows du serveur inférieur à la page demandée: on s'aligne dessus
+    page = len(first) if 0 < len(first) < min(page_size, total) else page_size
+    
+    def rows():
+        yield from first
+        starts = iter(range(len(first), total, page))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque(
+                pool.submit(supabase_page, table, select, filter_str, s, s + page - 1)
+                for s in islice(starts, workers)
+            )
+            while pending:
+                batch, _ = pending.popleft().result()
+                s = next(starts, None)
+                if s is not None:
+                    pending.append(pool.submit(supabase_page, table, select, filter_str, s, s + page - 1))
+                yield from batch
+    
+    return total, rows()
+
+def supabase_get(table, select="*", filter_str=None, limit=None):
+    """Get depuis Supabase (toutes les lignes, paginées, si limit n'est pas donné)"""
+    if not SUPABASE_URL:
+        return []
+    try:
+        if limit:
+            return supabase_page(table, select, filter_str, 0, limit - 1)[0]
+        return list(supabase_iter(table, select, filter_str)[1])
+    except Exception:
+        return []
+
+_batch_sizes = {}
+_quarantined = {}
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def spool_write(table, rows, on_conflict):
+    """Ajoute un segment (écrit en .tmp, fsync, renommé en .seg) au spool de la table"""
+    path = os.path.join(SPOOL_DIR, table)
+    os.makedirs(path, exist_ok=True)
+    name = f"{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    tmp = os.path.join(path, name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'table': table, 'on_conflict': on_conflict, 'rows': len(rows)}) + '\n')
+        for r in rows:
+            f.write(json.dumps(r, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    segment = os.path.join(path, name + '.seg')
+    os.replace(tmp, segment)
+    fsync_dir(path)
+    return segment
+
+def spool_segments(table):
+    path = os.path.join(SPOOL_DIR, table)
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.seg'))
+
+def segment_source(segment):
+    """(en-tête, nombre de lignes, lines(start, end)): seules les positions des lignes restent en mémoire"""
+    offsets = []
+    with open(segment, 'rb') as f:
+        header = json.loads(f.readline())
+        pos = f.tell()
+        for line in f:
+            offsets.append(pos)
+            pos += len(line)
+    
+    def lines(start, end):
+        if start >= len(offsets):
+            return
+        with open(segment, 'rb') as f:
+            f.seek(offsets[start])
+            for _ in range(min(end, len(offsets)) - start):
+                yield f.readline().rstrip(b'\n')
+    
+    return header, len(offsets), lines
+
+def segment_rewrite(segment, header, count, lines, keep):
+    """Réécrit un segment avec ses seules lignes d'index keep (.tmp, fsync, remplacement)"""
+    keep = set(keep)
+    tmp = segment[:-len('.seg')] + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(dict(header, rows=len(keep))).encode('utf-8') + b'\n')
+        for index, line in enumerate(lines(0, count)):
+            if index in keep:
+                f.write(line + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, segment)
+    fsync_dir(os.path.dirname(segment))
+
+def segment_attempts(segment):
+    """Drains déjà passés en erreur sur un segment (champ attempts de l'en-tête)"""
+    try:
+        with open(segment, 'rb') as f:
+            return int(json.loads(f.readline()).get('attempts') or 0)
+    except (OSError, ValueError):
+        return 0
+
+def segment_set_aside(segment):
+    """Déplace un segment qui échoue toujours dans <table>/failed/ (hors drains)"""
+    path = os.path.join(os.path.dirname(segment), 'failed')
+    os.makedirs(path, exist_ok=True)
+    os.replace(segment, os.path.join(path, os.path.basename(segment)))
+    fsync_dir(os.path.dirname(segment))
+
+def list_source(rows):
+    def lines(start, end):
+        for r in rows[start:end]:
+            yield json.dumps(r, ensure_ascii=False).encode('utf-8')
+    return len(rows), lines
+
+def json_array_body(lines, compress=False):
+    """Corps JSON '[l1,l2,...]' produit à la volée (Transfer-Encoding: chunked), gzip optionnel"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf = bytearray(b'[')
+    first = True
+    for line in lines:
+        if not first:
+            buf += b','
+        buf += line
+        first = False
+        if len(buf) >= UPLOAD_CHUNK:
+            out = compressor.compress(bytes(buf)) if compressor else bytes(buf)
+            buf.clear()
+            if out:
+                yield out
+    buf += b']'
+    out = bytes(buf)
+    if compressor:
+        out = compressor.compress(out) + compressor.flush()
+    if out:
+        yield out
+
+def upsert_adaptive(table, count, lines, on_conflict, failed=None):
+    """Upsert en flux par lots adaptatifs: (lignes écrites, erreurs, backend indisponible).
+    Les index des lignes ni écrites ni en quarantaine sont ajoutés à failed."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}"
+    if on_conflict:
+        url += f"?on_conflict={on_conflict}"
+    headers = supabase_headers()
+    headers['Prefer'] = 'resolution=merge-duplicates,return=minimal'
+    if UPLOAD_GZIP:
+        headers['Content-Encoding'] = 'gzip'
+    size = _batch_sizes.get(table, SPOOL_BATCH_START)
+    i, written, errors, rejected, lost, unavailable = 0, 0, [], [], [], False
+    while i < count:
+        n = min(size, count - i)
+        status, resp = http_request(url, 'POST', json_array_body(lines(i, i + n), UPLOAD_GZIP), dict(headers), 30)
+        if status in [200, 201, 204]:
+            written += n
+            i += n
+            size = min(size * 2, SPOOL_BATCH_MAX)
+            continue
+        size = max(1, size // 2)
+        if status == 0 or status == 429 or status >= 500:
+            errors.append(f"HTTP {status}")
+            unavailable = True
+            break
+        if n == 1:
+            row = json.loads(next(lines(i, i + 1)))
+            error = f"HTTP {status}: {resp[:300] if resp else 'No response'}"
+            if row_level_error(resp):
+                rejected.append((i, row, status, error))
+            else:
+                errors.append(f"{on_conflict}={row.get(on_conflict)}: {error}")
+                lost.append(i)
+            i += 1
+    # Trop de refus d'un coup: la table est en cause, pas le contenu des lignes
+    quarantine = len(rejected) <= QUARANTINE_MAX_ROWS
+    for index, row, status, error in rejected:
+        if quarantine and quarantine_row(table, row, on_conflict, status, error):
+            _quarantined[table] = _quarantined.get(table, 0) + 1
+        else:
+            errors.append(f"{on_conflict}={row.get(on_conflict)}: {error}")
+            lost.append(index)
+    if failed is not None:
+        failed.extend(sorted(lost))
+        failed.extend(range(i, count))
+    _batch_sizes[table] = size
+    return written, errors, unavailable
+
+def replace_table(table, rows):
+    """Remplace tout le contenu d'une table de référence en une transaction
+    (RPC parc_replace_rows). Retourne (lignes écrites, erreur)."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_replace_rows"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, body = http_request(url, 'POST', {'p_table': table, 'p_rows': rows}, headers, 60)
+    if status == 404:
+        # Migration add_parc_replace_rows pas encore appliquée: suppression puis insertion groupée
+        supabase_delete(table)
+        written, errors, _ = upsert_adaptive(table, *list_source(rows), None)
+        return written, '; '.join(errors[:3]) or None
+    if status != 200:
+        return 0, f"HTTP {status}: {body[:300] if body else 'No response'}"
+    try:
+        return int(json.loads(body)), None
+    except (ValueError, TypeError):
+        return len(rows), None
+
+def row_hash(data):
+    """Hash stable d'une ligne (hors colonnes volatiles), comme sync.py"""
+    stable = {k: v for k, v in data.items() if k not in VOLATILE_COLUMNS}
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+def row_level_error(resp):
+    """True si le corps d'erreur PostgREST porte un SQLSTATE de ligne (classes 22/23)"""
+    try:
+        code = json.loads(resp).get('code') or ''
+    except (ValueError, AttributeError):
+        return False
+    return str(code)[:2] in QUARANTINE_SQLSTATE_CLASSES
+
+def row_key(row, on_conflict):
+    """Clé d'une ligne en quarantaine: valeurs des colonnes de on_conflict, sinon son hash"""
+    if not on_conflict:
+        return row.get('row_hash') or row_hash(row)
+    return '|'.join(str(row.get(c)) for c in on_conflict.split(','))
+
+def quarantine_row(table, row, on_conflict, status, error):
+    """Met en quarantaine une ligne refusée seule par PostgREST (False si l'écriture a échoué)"""
+    return supabase_upsert('parc_sync_quarantine', {
+        'tbl': table,
+        'row_key': row_key(row, on_conflict),
+        'row_hash': row.get('row_hash') or row_hash(row),
+        'http_status': status,
+        'error': safe_str(error, 1000),
+        'record': row,
+        'last_seen': datetime.now().isoformat()
+    }, 'tbl,row_key')
+
+def quarantine_filter(table, rows, on_conflict):
+    """Retire les lignes en quarantaine dont le hash n'a pas changé (les autres
+    sortent de quarantaine). Retourne (lignes à écrire, nombre écartées)."""
+    try:
+        _, held = supabase_iter('parc_sync_quarantine', 'row_key,row_hash', f"tbl=eq.{table}", key='row_key')
+        held = {q['row_key']: q['row_hash'] for q in held}
+    except Exception:
+        return rows, 0
+    if not held:
+        return rows, 0
+    
+    kept, released = [], []
+    for r in rows:
+        key = row_key(r, on_conflict)
+        if key in held:
+            if held[key] == (r.get('row_hash') or row_hash(r)):
+                continue
+            released.append(key)
+        kept.append(r)
+    for i in range(0, len(released), IN_FILTER_CHUNK):
+        keys = ','.join(quote(f'"{k}"') for k in released[i:i+IN_FILTER_CHUNK])
+        supabase_delete('parc_sync_quarantine', f"tbl=eq.{table}&row_key=in.({keys})")
+    return kept, len(rows) - len(kept)
+
+def spool_drain(table):
+    """Rejoue les segments du spool (les plus anciens d'abord)"""
+    quarantined = _quarantined.get(table, 0)
+    result = {"rows": 0, "pending": 0, "retrying": 0, "set_aside": 0, "errors": [], "retry_errors": []}
+    for segment in spool_segments(table):
+        try:
+            header, count, lines = segment_source(segment)
+        except (OSError, ValueError) as e:
+            result["errors"].append(f"{os.path.basename(segment)}: {e}")
+            continue
+        failed = []
+        written, errors, unavailable = upsert_adaptive(table, count, lines, header.get('on_conflict'), failed)
+        result["rows"] += written
+        # Erreurs d'un segment déjà en échec: signalées à part, elles ne bloquent
+        # pas indéfiniment le succès des syncs qui l'ont suivi
+        attempts = header.get('attempts') or 0
+        result["retry_errors" if attempts else "errors"].extend(errors[:5])
+        if errors and not unavailable:
+            attempts += 1
+        if failed and attempts >= SPOOL_MAX_ATTEMPTS:
+            segment_set_aside(segment)
+            result["set_aside"] += 1
+        elif not failed:
+            os.remove(segment)
+            fsync_dir(os.path.dirname(segment))
+        elif len(failed) < count or attempts != (header.get('attempts') or 0):
+            # Seules les lignes en échec restent à rejouer: les lignes déjà
+            # écrites ne doivent pas écraser plus tard des valeurs plus récentes
+            segment_rewrite(segment, dict(header, attempts=attempts), count, lines, failed)
+        if unavailable:
+            break
+    # En attente: segments pas encore drainés ou en échec une seule fois; après un
+    # nouvel essai manqué ils passent dans retrying et ne bloquent plus le succès
+    attempts = [segment_attempts(segment) for segment in spool_segments(table)]
+    result["pending"] = sum(1 for a in attempts if a < 2)
+    result["retrying"] = len(attempts) - result["pending"]
+    result["quarantined"] = _quarantined.get(table, 0) - quarantined
+    return result
+
+def spool_upsert(table, rows, on_conflict):
+    """Écrit via le spool (hors lignes en quarantaine) puis draine;
+    écriture directe si le disque est inutilisable"""
+    rows, skipped = quarantine_filter(table, rows, on_conflict) if rows else (rows, 0)
+    if rows:
+        try:
+            spool_write(table, rows, on_conflict)
+        except OSError as e:
+            quarantined = _quarantined.get(table, 0)
+            written, errors, _ = upsert_adaptive(table, *list_source(rows), on_conflict)
+            return {"rows": written, "pending": 0, "retrying": 0, "errors": errors + [f"Spool: {e}"],
+                    "quarantined": _quarantined.get(table, 0) - quarantined, "quarantine_skipped": skipped}
+    result = spool_drain(table)
+    result["quarantine_skipped"] = skipped
+    return result
+
+def acquire_lock(scope, ttl, sync_type=None):
+    """Prend le verrou parc_sync_locks d'un périmètre pour ttl secondes.
+    Retourne l'identifiant du détenteur, ou None si le verrou est déjà pris."""
+    base = f"{SUPABASE_URL.rstrip('/')}/rest/v1/parc_sync_locks"
+    now = datetime.now()
+    holder = uuid.uuid4().hex
+    
+    # Créer la ligne si absente, sans écraser un verrou existant
+    headers = supabase_headers()
+    headers['Prefer'] = 'resolution=ignore-duplicates,return=minimal'
+    http_request(f"{base}?on_conflict=scope", 'POST', {'scope': scope}, headers, 15)
+    
+    # Prise atomique: un seul UPDATE conditionnel (libre ou expiré)
+    headers = supabase_headers()
+    headers['Prefer'] = 'return=representation'
+    url = f"{base}?scope=eq.{scope}&or=(holder.is.null,expires_at.lt.{now.isoformat()})"
+    status, body = http_request(url, 'PATCH', {
+        'holder': holder,
+        'sync_type': sync_type,
+        'acquired_at': now.isoformat(),
+        'heartbeat_at': now.isoformat(),
+        'expires_at': (now + timedelta(seconds=ttl)).isoformat()
+    }, headers, 15)
+    try:
+        return holder if status == 200 and json.loads(body) else None
+    except ValueError:
+        return None
+
+def renew_lock(scope, holder, ttl):
+    """Prolonge le bail du verrou s'il appartient encore à holder (heartbeat).
+    Faux si le verrou a été repris entre-temps."""
+    now = datetime.now()
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/parc_sync_locks?scope=eq.{scope}&holder=eq.{holder}"
+    headers = supabase_headers()
+    headers['Prefer'] = 'return=representation'
+    status, body = http_request(url, 'PATCH', {
+        'heartbeat_at': now.isoformat(),
+        'expires_at': (now + timedelta(seconds=ttl)).isoformat()
+    }, headers, 15)
+    try:
+        return status == 200 and bool(json.loads(body))
+    except ValueError:
+        return False
+
+def release_lock(scope, holder):
+    """Libère le verrou s'il appartient encore à holder"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/parc_sync_locks?scope=eq.{scope}&holder=eq.{holder}"
+    status, _ = http_request(url, 'PATCH', {'holder': None, 'expires_at': None}, supabase_headers(), 15)
+    return status in [200, 204]
+
+def acquire_locks(scopes, sync_type, wait=0):
+    """Prend tous les verrous (ordre trié, tout ou rien), en réessayant pendant wait secondes.
+    Retourne {scope: holder}, ou None si un verrou est resté pris."""
+    deadline = time.monotonic() + wait
+    while True:
+        held = {}
+        for scope in sorted(scopes):
+            holder = acquire_lock(scope, LOCK_TTL, sync_type)
+            if not holder:
+                break
+            held[scope] = holder
+        else:
+            return held
+        for scope, holder in held.items():
+            release_lock(scope, holder)
+        if time.monotonic() + LOCK_POLL_SECONDS > deadline:
+            return None
+        time.sleep(LOCK_POLL_SECONDS)
+
+def start_heartbeat(held, lost):
+    """Prolonge les verrous toutes les LOCK_HEARTBEAT secondes jusqu'à l'arrêt.
+    Les périmètres dont le verrou a été repris sont ajoutés à lost."""
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(LOCK_HEARTBEAT):
+            for scope, holder in held.items():
+                if scope not in lost and not renew_lock(scope, holder, LOCK_TTL):
+                    lost.append(scope)
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
+def run_locked(scopes, sync_type, fn, wait=0, log_skip=True):
+    """Exécute fn() sous les verrous des périmètres donnés, prolongés par heartbeat.
+    Si un verrou reste pris, la sync est ignorée et le passage tracé dans parc_sync_logs."""
+    if not scopes:
+        return fn()
+    held = acquire_locks(scopes, sync_type, wait)
+    if held is None:
+        busy = supabase_get('parc_sync_locks', 'scope,sync_type,acquired_at,heartbeat_at,expires_at',
+                            f"scope=in.({','.join(scopes)})&holder=not.is.null")
+        message = "Ignoré, verrou détenu: " + ('; '.join(
+            f"{b['scope']} par {b.get('sync_type') or '?'} depuis {b.get('acquired_at')}" for b in busy
+        ) or ', '.join(scopes))
+        if log_skip:
+            supabase_insert('parc_sync_logs', {
+                'sync_date': datetime.now().isoformat(),
+                'sync_type': sync_type,
+                'status': 'skipped',
+                'equipements_count': 0,
+                'pannes_count': 0,
+                'arrets_count': 0,
+                'duration_seconds': 0,
+                'error_message': message[:500]
+            })
+        return {"status": "skipped", "message": message, "locks": busy}
+    
+    lost = []
+    stop = start_heartbeat(held, lost)
+    try:
+        result = fn()
+    finally:
+        stop.set()
+        for scope, holder in held.items():
+            release_lock(scope, holder)
+    if lost:
+        result['lock_lost'] = lost
+    return result
+
+def get_watermark(scope):
+    """Filigrane d'un périmètre de sync: (datetime du dernier succès, statut)"""
+    rows = supabase_get('parc_sync_watermarks', 'watermark,status', f'scope=eq.{scope}')
+    if not rows:
+        return None, None
+    try:
+        wm = datetime.fromisoformat(rows[0]['watermark']) if rows[0].get('watermark') else None
+    except (TypeError, ValueError):
+        wm = None
+    return wm, rows[0].get('status')
+
+def set_watermark(scope, watermark, status):
+    """Enregistre le filigrane (watermark=None conserve le précédent)"""
+    data = {'scope': scope, 'status': status, 'updated_at': datetime.now().isoformat()}
+    if watermark:
+        data['watermark'] = watermark.isoformat()
+    return supabase_upsert('parc_sync_watermarks', data, 'scope')
+
+def pannes_since(now):
+    """Date de départ de la sync des pannes et mode ('delta' ou 'fallback')"""
+    wm, status = get_watermark('pannes')
+    if wm and status == 'success':
+        return wm - timedelta(minutes=PANNES_OVERLAP_MINUTES), 'delta'
+    return now - timedelta(days=PANNES_FALLBACK_DAYS), 'fallback'
+
+def refresh_secteurs(secteurs=None, synced_at=None, error=None):
+    """Recalcule les cumuls de parc_secteurs (tous les secteurs si secteurs=None).
+    synced_at / error enregistrent la dernière sync réussie ou l'échec des secteurs donnés."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_secteurs_refresh"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, _ = http_request(url, 'POST', {
+        'p_secteurs': [int(s) for s in secteurs] if secteurs else None,
+        'p_synced_at': synced_at.isoformat() if synced_at else None,
+        'p_error': safe_str(error, 500)
+    }, headers, 30)
+    return status == 200
+
+def sync_en_arret_flags(arret_ids):
+    """Aligne parc_ascenseurs.en_arret sur les appareils actuellement à l'arrêt.
+    Diff entre les appareils déjà marqués et les arrêts en cours, appliqué en
+    deux PATCH groupés (retrait / ajout du flag) au lieu d'un PATCH par appareil."""
+    stopped = {i for i in arret_ids if i}
+    try:
+        # Lecture paginée: une liste tronquée (max-rows) laisserait des flags en place
+        _, current = supabase_iter('parc_ascenseurs', 'id_wsoucont', 'en_arret=eq.true')
+        flagged = {a['id_wsoucont'] for a in current if a.get('id_wsoucont')}
+    except Exception as e:
+        return {"stopped": len(stopped), "set": 0, "cleared": 0, "ok": False, "error": str(e)}
+    
+    to_clear = flagged - stopped
+    to_set = stopped - flagged
+    ok = True
+    if to_clear:
+        ok = supabase_update_in('parc_ascenseurs', 'id_wsoucont', to_clear, {'en_arret': False}) and ok
+    if to_set:
+        ok = supabase_update_in('parc_ascenseurs', 'id_wsoucont', to_set, {'en_arret': True}) and ok
+    
+    return {"stopped": len(stopped), "set": len(to_set), "cleared": len(to_clear), "ok": ok}
 
 def progilift_call(method, params, wsid=None, timeout=30):
     params_xml = ""
@@ -154,18 +761,54 @@ def progilift_call(method, params, wsid=None, timeout=30):
     return body if status == 200 and body and "Fault" not in body else None
 
 def parse_items(xml, tag):
+    """Parse les items XML comme sync.py: valeurs gardées en texte ('0123' reste
+    '0123'), sinon data_wpanne et row_hash diffèrent d'un fichier à l'autre"""
     items = []
     if not xml:
         return items
-    for m in re.finditer(f'<{tag}>(.*?)</{tag}>', xml, re.DOTALL):
+    for m in re.finditer(f'<{tag}>(.*?)</{tag}>', xml, re.DOTALL | re.IGNORECASE):
         item = {}
         for f in re.finditer(r'<([A-Za-z0-9_]+)>([^<]*)</\1>', m.group(1)):
-            val = f.group(2).strip()
-            item[f.group(1)] = int(val) if val and val.lstrip('-').isdigit() else (val if val else None)
+            item[f.group(1)] = f.group(2).strip() if f.group(2).strip() else None
         if item:
             items.append(item)
     return items
 
+def dedupe_by_key(rows, key):
+    """Garde une seule ligne par clé: la dernière occurrence gagne (Wpanne ne
+    fournit pas d'horodatage de mise à jour, la réponse la plus tardive fait foi).
+    La ligne retenue garde la place de la première occurrence.
+    PostgREST rejette un upsert dont le lot contient deux fois la même clé.
+    Retourne (lignes dédoublonnées, nombre de doublons écartés)."""
+    seen = {}
+    result = []
+    for row in rows:
+        k = row[key]
+        if k in seen:
+            result[seen[k]] = row
+            continue
+        seen[k] = len(result)
+        result.append(row)
+    return result, len(rows) - len(result)
+
+def refresh_pannes_stats_windows():
+    """Recalcule les compteurs 30 / 90 jours de parc_pannes_stats qui ont glissé
+    depuis leur dernier calcul (une fois par jour, le reste est maintenu par trigger).
+    Retourne le nombre d'appareils recalculés, None si l'appel a échoué."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_pannes_stats_refresh_windows"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, body = http_request(url, 'POST', {}, headers, 60)
+    if status != 200:
+        return None
+    try:
+        return int(json.loads(body))
+    except (ValueError, TypeError):
+        return None
+
 def run_cron_sync():
     """Sync rapide pour le cron horaire"""
     start = datetime.now()
@@ -181,22 +824,22 @@ def run_cron_sync():
         return {"status": "error", "message": "No WSID"}
     wsid = m.group(1)
     
-    # 1. Arrêts - Vider et recréer
+    # 1. Arrêts - Remplacement atomique
     try:
         resp = progilift_call("get_AppareilsArret", {}, wsid, 30)
+        if resp is None:
+            raise Exception("get_AppareilsArret failed")
         arrets = parse_items(resp, "tabListeArrets")
         
-        # Supprimer les anciens
-        supabase_delete('parc_arrets')
-        
         # Collecter les IDs pour le flag en_arret
         arret_ids = []
+        rows = []
         
         for a in arrets:
             id_wsoucont = safe_int(a.get('nIDSOUCONT'))
             if id_wsoucont:
                 arret_ids.append(id_wsoucont)
-                supabase_insert('parc_arrets', {
+                rows.append({
                     'id_wsoucont': id_wsoucont,
                     'id_panne': safe_int(a.get('nClepanne')),
                     'code_appareil': safe_str(a.get('sAscenseur'), 50),
@@ -210,30 +853,30 @@ def run_cron_sync():
                     'synced_at': datetime.now().isoformat()
                 })
         
+        # Vider et recréer en une transaction (jamais de liste partielle visible)
+        _, error = replace_table('parc_arrets', rows)
+        if error:
+            raise Exception(f"parc_arrets: {error}")
+        
         stats["arrets"] = len(arrets)
         
         # Mettre à jour les flags en_arret dans parc_ascenseurs
-        # D'abord récupérer tous les ascenseurs actuellement marqués en_arret
-        current_arrets = supabase_get('parc_ascenseurs', 'id_wsoucont', 'en_arret=eq.true')
-        current_arret_ids = [a['id_wsoucont'] for a in current_arrets]
-        
-        # Remettre à FALSE ceux qui ne sont plus en arrêt
-        for id_ws in current_arret_ids:
-            if id_ws not in arret_ids:
-                supabase_update('parc_ascenseurs', 'id_wsoucont', id_ws, {'en_arret': False})
-        
-        # Mettre à TRUE les nouveaux arrêts
-        for id_ws in arret_ids:
-            supabase_update('parc_ascenseurs', 'id_wsoucont', id_ws, {'en_arret': True})
+        flags = sync_en_arret_flags(arret_ids)
+        if not flags["ok"]:
+            stats["errors"].append("Arrets: mise à jour des flags en_arret incomplète")
                 
     except Exception as e:
         stats["errors"].append(f"Arrets: {e}")
     
-    # 2. Pannes récentes (30 derniers jours)
+    # 2. Pannes modifiées depuis la dernière sync réussie
+    pannes_ok = False
     try:
-        date_30j = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%dT00:00:00")
+        since, stats["pannes_mode"] = pannes_since(start)
+        stats["pannes_since"] = since.strftime("%Y-%m-%dT%H:%M:%S")
         
-        resp = progilift_call("get_Synchro_Wpanne", {"dhDerniereMajFichier": date_30j}, wsid, 60)
+        resp = progilift_call("get_Synchro_Wpanne", {"dhDerniereMajFichier": stats["pannes_since"]}, wsid, 60)
+        if resp is None:
+            raise Exception("get_Synchro_Wpanne failed")
         items = parse_items(resp, "tabListeWpanne")
         
         pannes_list = []
@@ -267,15 +910,37 @@ def run_cron_sync():
                     'updated_at': datetime.now().isoformat()
                 })
         
-        # Upsert par batch de 50
-        for i in range(0, len(pannes_list), 50):
-            supabase_upsert('parc_pannes', pannes_list[i:i+50], 'id_panne')
+        # Une seule version par id_panne (sinon PostgREST rejette le lot)
+        pannes_list, stats["pannes_doublons"] = dedupe_by_key(pannes_list, 'id_panne')
+        # Même lignes et même hash que sync.py (mirror_changed). Le cron n'a pas accès au
+        # miroir SQLite de sync.py: celui-ci voit l'écart de parc_mirror_checksum et se
+        # reconstruit depuis les row_hash écrits ici, sans réécrire ces pannes ensuite.
+        for r in pannes_list:
+            r['row_hash'] = row_hash(r)
+        
+        # Écriture via le spool (rejoué au prochain passage si Supabase échoue)
+        drained = spool_upsert('parc_pannes', pannes_list, 'id_panne')
         
         stats["pannes"] = len(pannes_list)
+        stats["spool_pending"] = drained["pending"]
+        stats["spool_retrying"] = drained["retrying"]
+        stats["quarantined"] = drained["quarantined"]
+        stats["quarantine_skipped"] = drained["quarantine_skipped"]
+        if drained["errors"] or drained["pending"]:
+            stats["errors"].append(f"Pannes: {'; '.join(drained['errors'][:3]) or 'écriture incomplète'}")
+        else:
+            pannes_ok = True
         
     except Exception as e:
         stats["errors"].append(f"Pannes: {e}")
     
+    # Filigrane = début de cette exécution (les modifications pendant la sync
+    # seront reprises au prochain passage grâce à la marge de recouvrement)
+    set_watermark('pannes', start if pannes_ok else None, 'success' if pannes_ok else 'error')
+    stats["pannes_stats_windows"] = refresh_pannes_stats_windows()
+    # Cumuls par secteur (arrêts, pannes 30 jours)
+    stats["secteurs_refreshed"] = refresh_secteurs()
+    
     duration = (datetime.now() - start).total_seconds()
     
     # Log
@@ -307,7 +972,8 @@ class handler(BaseHTTPRequestHandler):
     
     def _respond(self):
         try:
-            result = run_cron_sync()
+            # Ignoré (et tracé) si une autre sync écrit déjà les arrêts ou les pannes
+            result = run_locked(['arrets', 'pannes'], 'cron', run_cron_sync)
         except Exception as e:
             result = {"status": "error", "message": str(e)}
         
@@ -0,0 +1,235 @@
+"""
+Progilift Export API - Export en flux de l'historique des pannes
+Table: parc_pannes (secteur résolu via parc_ascenseurs)
+
+Endpoints:
+  ?format=ndjson|csv           → Format de sortie (ndjson par défaut)
+  &secteur=X                   → Filtre secteur
+  &appareil=CODE               → Filtre code appareil (ou &id_wsoucont=N)
+  &since=YYYY-MM-DD&until=...  → Filtre sur date_appel
+  &columns=id_panne,date_appel → Projection (colonnes de EXPORT_COLUMNS)
+
+La réponse est envoyée en Transfer-Encoding: chunked, compressée en gzip si le
+client l'accepte. Les pannes sont lues par pages successives sur id_panne
+(keyset), la mémoire reste donc constante quelle que soit la taille de l'historique.
+Avec &secteur, les appareils sont traités par groupes de IN_FILTER_CHUNK (tri par
+id_panne dans chaque groupe). Une erreur en cours de flux interrompt la connexion
+sans le bloc final (réponse incomplète côté client), après une ligne
+{"error": ...} en ndjson.
+"""
+
+import os
+import csv
+import io
+import json
+import ssl
+import urllib.request
+import zlib
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, quote, urlparse
+
+SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
+
+# Taille des pages lues dans parc_pannes et parc_ascenseurs (<= max-rows PostgREST)
+PAGE_SIZE = 1000
+
+# Nombre d'identifiants par filtre in.() (URL < ~8 Ko)
+IN_FILTER_CHUNK = 300
+
+# Colonnes exportables (data_wpanne est le blob brut Progilift)
+EXPORT_COLUMNS = [
+    'id_panne', 'id_wsoucont', 'code_appareil', 'adresse', 'code_postal',
+    'date_appel', 'heure_appel', 'date_arrivee', 'heure_arrivee', 'date_depart', 'heure_depart',
+    'motif', 'cause', 'travaux', 'depanneur', 'duree_minutes', 'type_panne', 'etat',
+    'demandeur', 'personnes_bloquees', 'data_wpanne', 'synced_at', 'updated_at'
+]
+DEFAULT_COLUMNS = [c for c in EXPORT_COLUMNS if c != 'data_wpanne']
+
+try:
+    ssl_context = ssl.create_default_context()
+except:
+    ssl_context = ssl._create_unverified_context()
+
+def supabase_get(table, select="*", filter_str=None):
+    """Get depuis Supabase (lève une exception en cas d'erreur)"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?select={select}"
+    if filter_str:
+        url += f"&{filter_str}"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}'
+    }
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=30, context=ssl_context) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+def get_sector_ids(secteur):
+    """id_wsoucont des appareils d'un secteur (pagination keyset sur id_wsoucont)"""
+    ids = []
+    last_id = None
+    while True:
+        page_filter = f"secteur=eq.{int(secteur)}&id_wsoucont=not.is.null"
+        if last_id is not None:
+            page_filter += f"&id_wsoucont=gt.{last_id}"
+        rows = supabase_get('parc_ascenseurs', 'id_wsoucont', f"{page_filter}&order=id_wsoucont.asc&limit={PAGE_SIZE}")
+        ids.extend(r['id_wsoucont'] for r in rows)
+        if len(rows) < PAGE_SIZE:
+            return ids
+        last_id = rows[-1]['id_wsoucont']
+
+def build_filters(params):
+    """Jeux de filtres PostgREST, exportés l'un après l'autre: un seul sans
+    secteur, un par groupe de IN_FILTER_CHUNK appareils avec secteur
+    (liste vide si le secteur n'a aucun appareil)"""
+    filters = []
+    chunks = [None]
+
+    secteur = params.get('secteur', [None])[0]
+    if secteur:
+        ids = get_sector_ids(secteur)
+        chunks = [f"id_wsoucont=in.({','.join(str(i) for i in ids[k:k+IN_FILTER_CHUNK])})"
+                  for k in range(0, len(ids), IN_FILTER_CHUNK)]
+
+    id_wsoucont = params.get('id_wsoucont', [None])[0]
+    if id_wsoucont:
+        filters.append(f"id_wsoucont=eq.{int(id_wsoucont)}")
+
+    appareil = params.get('appareil', [None])[0]
+    if appareil:
+        filters.append(f"code_appareil=eq.{quote(appareil)}")
+
+    since = params.get('since', [None])[0]
+    if since:
+        filters.append(f"date_appel=gte.{quote(since[:10])}")
+    until = params.get('until', [None])[0]
+    if until:
+        filters.append(f"date_appel=lte.{quote(until[:10])}")
+
+    return [filters + [chunk] if chunk else filters for chunk in chunks]
+
+def parse_columns(value):
+    """Projection demandée, limitée aux colonnes connues; id_panne sert de curseur"""
+    if not value:
+        return DEFAULT_COLUMNS
+    columns = [c.strip() for c in value.split(',') if c.strip() in EXPORT_COLUMNS]
+    if 'id_panne' not in columns:
+        columns.insert(0, 'id_panne')
+    return columns
+
+def iter_pannes(columns, filters):
+    """Génère les pages de pannes triées par id_panne (pagination keyset)"""
+    select = ','.join(columns)
+    last_id = None
+    while True:
+        page_filters = list(filters)
+        if last_id is not None:
+            page_filters.append(f"id_panne=gt.{last_id}")
+        page_filters.append(f"order=id_panne.asc&limit={PAGE_SIZE}")
+
+        rows = supabase_get('parc_pannes', select, '&'.join(page_filters))
+        if not rows:
+            return
+        yield rows
+        if len(rows) < PAGE_SIZE:
+            return
+        last_id = rows[-1]['id_panne']
+
+def format_ndjson(rows):
+    return ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in rows)
+
+def format_csv(rows, columns, header=False):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(columns)
+    for r in rows:
+        writer.writerow([
+            json.dumps(r.get(c), ensure_ascii=False) if isinstance(r.get(c), (dict, list)) else r.get(c)
+            for c in columns
+        ])
+    return buf.getvalue()
+
+class handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 requis pour Transfer-Encoding: chunked
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        try:
+            parsed = urlparse(self.path)
+            params = parse_qs(parsed.query)
+
+            fmt = params.get('format', ['ndjson'])[0]
+            if fmt not in ('ndjson', 'csv'):
+                return self._send_error(400, f"Format inconnu: {fmt}")
+            if not SUPABASE_URL or not SUPABASE_KEY:
+                return self._send_error(500, "Supabase non configuré")
+
+            columns = parse_columns(params.get('columns', [None])[0])
+            filter_sets = build_filters(params)
+        except Exception as e:
+            return self._send_error(400, str(e))
+
+        use_gzip = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+
+        self.send_response(200)
+        if fmt == 'csv':
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.send_header('Content-Disposition', 'attachment; filename="parc_pannes.csv"')
+        else:
+            self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+
+        def emit(text, final=False):
+            data = text.encode('utf-8')
+            if compressor:
+                data = compressor.compress(data)
+                data += compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+            if data:
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+
+        try:
+            if fmt == 'csv':
+                emit(format_csv([], columns, header=True))
+
+            # Secteur sans appareil: aucun jeu de filtres, export vide
+            for filters in filter_sets:
+                for rows in iter_pannes(columns, filters):
+                    emit(format_csv(rows, columns) if fmt == 'csv' else format_ndjson(rows))
+        except Exception as e:
+            # Les en-têtes sont déjà partis: erreur signalée dans le flux (ndjson), puis
+            # connexion fermée sans bloc final pour que le client voie un export incomplet
+            if fmt == 'ndjson':
+                emit(json.dumps({"error": str(e)}, ensure_ascii=False) + '\n')
+            self.close_connection = True
+            return
+
+        emit('', final=True)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_error(self, code, message):
+        body = json.dumps({"status": "error", "message": message}, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
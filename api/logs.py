@@ -1,33 +1,55 @@
 """
 Progilift Logs API - Historique des synchronisations
-Table: parc_sync_logs
+Tables: parc_sync_logs, parc_sync_stats (agrégats journaliers maintenus par trigger)
+
+Endpoints:
+  ?limit=50&type=X&status=Y        → Derniers logs
+  ?before=<sync_date>              → Page suivante (logs plus anciens), en-tête Link rel="next"
+  ?after=<sync_date>               → Logs plus récents que le curseur
+  ?stats=1&since=YYYY-MM-DD&until= → Agrégats sur la fenêtre (30 derniers jours par défaut)
 """
 
 import os
 import json
+import hashlib
 import ssl
 import urllib.request
+from datetime import date, timedelta
 from http.server import BaseHTTPRequestHandler
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, quote, urlencode, urlparse
 
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
 
+# En-têtes de cache HTTP (navigateur / CDN Vercel)
+CACHE_CONTROL = "public, max-age=5, s-maxage=30, stale-while-revalidate=120"
+
+# Bornes hautes (secondes) des classes de l'histogramme des durées.
+# Doivent rester identiques à parc_sync_duration_bucket() (create_parc_sync_stats.sql).
+DURATION_BUCKETS = [1, 2, 5, 10, 20, 30, 60, 120, 300, 600]
+
 try:
     ssl_context = ssl.create_default_context()
 except:
     ssl_context = ssl._create_unverified_context()
 
-def get_logs(limit=50, sync_type=None, status=None):
+def get_logs(limit=50, sync_type=None, status=None, before=None, after=None):
+    """Logs triés du plus récent au plus ancien, paginés par curseur sur sync_date"""
     if not SUPABASE_URL or not SUPABASE_KEY:
         return []
     try:
-        url = f"{SUPABASE_URL}/rest/v1/parc_sync_logs?select=*&order=sync_date.desc&limit={limit}"
+        # Avec ?after= on lit vers le futur (tri croissant) puis on inverse
+        order = "asc" if after and not before else "desc"
+        url = f"{SUPABASE_URL}/rest/v1/parc_sync_logs?select=*&order=sync_date.{order}&limit={limit}"
         
         if sync_type:
             url += f"&sync_type=eq.{sync_type}"
         if status:
             url += f"&status=eq.{status}"
+        if before:
+            url += f"&sync_date=lt.{quote(before)}"
+        if after:
+            url += f"&sync_date=gt.{quote(after)}"
         
         headers = {
             'apikey': SUPABASE_KEY,
@@ -35,48 +57,163 @@ def get_logs(limit=50, sync_type=None, status=None):
         }
         req = urllib.request.Request(url, headers=headers)
         with urllib.request.urlopen(req, timeout=10, context=ssl_context) as resp:
-            return json.loads(resp.read().decode('utf-8'))
+            logs = json.loads(resp.read().decode('utf-8'))
+            return logs[::-1] if order == "asc" else logs
     except Exception as e:
         return []
 
-def get_stats():
-    """Statistiques des synchronisations"""
+def get_daily_stats(since, until):
+    """Lignes parc_sync_stats de la fenêtre [since, until]"""
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        return []
+    try:
+        url = f"{SUPABASE_URL}/rest/v1/parc_sync_stats?select=*&jour=gte.{since}&jour=lte.{until}"
+        headers = {
+            'apikey': SUPABASE_KEY,
+            'Authorization': f'Bearer {SUPABASE_KEY}'
+        }
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req, timeout=10, context=ssl_context) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+    except:
+        return []
+
+def hist_percentile(hist, q, max_duration):
+    """Percentile approché par interpolation linéaire dans l'histogramme"""
+    n = sum(hist)
+    if not n:
+        return 0
+    target = q * n
+    cumul = 0
+    for i, count in enumerate(hist):
+        if count and cumul + count >= target:
+            lower = DURATION_BUCKETS[i - 1] if i > 0 else 0
+            upper = DURATION_BUCKETS[i] if i < len(DURATION_BUCKETS) else max_duration
+            upper = min(upper, max_duration) if max_duration else upper
+            value = lower + (max(upper, lower) - lower) * (target - cumul) / count
+            return round(value, 2)
+        cumul += count
+    return round(max_duration, 2)
+
+def merge_stats(rows):
+    """Fusionne des lignes journalières en un agrégat unique"""
+    agg = {
+        "syncs": 0, "success": 0, "partial": 0, "errors": 0, "skipped": 0,
+        "timed": 0, "duration": 0.0, "max_duration": 0.0, "rows": 0,
+        "hist": [0] * (len(DURATION_BUCKETS) + 1)
+    }
+    for r in rows:
+        agg["syncs"] += r.get('nb_syncs') or 0
+        agg["success"] += r.get('nb_success') or 0
+        agg["partial"] += r.get('nb_partial') or 0
+        agg["errors"] += r.get('nb_errors') or 0
+        agg["skipped"] += r.get('nb_skipped') or 0
+        agg["timed"] += r.get('nb_timed') or 0
+        agg["duration"] += float(r.get('total_duration') or 0)
+        agg["max_duration"] = max(agg["max_duration"], float(r.get('max_duration') or 0))
+        agg["rows"] += r.get('timed_rows') or 0
+        for i, count in enumerate((r.get('duration_hist') or [])[:len(agg["hist"])]):
+            agg["hist"][i] += count or 0
+    
+    return {
+        "total_syncs": agg["syncs"],
+        "success": agg["success"],
+        "partial": agg["partial"],
+        "errors": agg["errors"],
+        "skipped": agg["skipped"],
+        "success_rate": round(agg["success"] / agg["syncs"] * 100, 1) if agg["syncs"] else 0,
+        "avg_duration_seconds": round(agg["duration"] / agg["timed"], 2) if agg["timed"] else 0,
+        "p50_duration_seconds": hist_percentile(agg["hist"], 0.50, agg["max_duration"]),
+        "p95_duration_seconds": hist_percentile(agg["hist"], 0.95, agg["max_duration"]),
+        "max_duration_seconds": round(agg["max_duration"], 2),
+        "rows_per_second": round(agg["rows"] / agg["duration"], 1) if agg["duration"] else 0
+    }
+
+def get_stats(since=None, until=None):
+    """Statistiques des synchronisations sur une fenêtre de dates.
+    Lit les agrégats journaliers (une ligne par jour et par type), donc le coût
+    ne dépend pas de la taille de parc_sync_logs."""
     if not SUPABASE_URL or not SUPABASE_KEY:
         return {}
     try:
-        logs = get_logs(100)
+        until = until or date.today().isoformat()
+        since = since or (date.fromisoformat(until[:10]) - timedelta(days=30)).isoformat()
         
-        if not logs:
+        rows = get_daily_stats(since[:10], until[:10])
+        if not rows:
             return {}
         
-        # Calculer les stats
-        total = len(logs)
-        success = sum(1 for l in logs if l.get('status') == 'success')
-        partial = sum(1 for l in logs if l.get('status') == 'partial')
-        errors = sum(1 for l in logs if l.get('status') == 'error')
-        
-        cron_count = sum(1 for l in logs if l.get('sync_type') == 'cron')
-        full_count = sum(1 for l in logs if l.get('sync_type') == 'full')
+        by_sync_type = {}
+        for r in rows:
+            by_sync_type.setdefault(r.get('sync_type') or 'other', []).append(r)
         
-        durations = [l.get('duration_seconds', 0) for l in logs if l.get('duration_seconds')]
-        avg_duration = round(sum(durations) / len(durations), 2) if durations else 0
+        stats = merge_stats(rows)
+        types = {t: merge_stats(type_rows) for t, type_rows in sorted(by_sync_type.items())}
+        cron_count = types.get('cron', {}).get('total_syncs', 0)
+        full_count = types.get('full', {}).get('total_syncs', 0)
         
-        return {
-            "total_syncs": total,
-            "success": success,
-            "partial": partial,
-            "errors": errors,
-            "success_rate": round(success / total * 100, 1) if total > 0 else 0,
+        stats.update({
+            "window": {"since": since[:10], "until": until[:10]},
             "by_type": {
                 "cron": cron_count,
                 "full": full_count,
-                "other": total - cron_count - full_count
+                "other": stats["total_syncs"] - cron_count - full_count
             },
-            "avg_duration_seconds": avg_duration
-        }
+            "by_sync_type": types
+        })
+        return stats
     except:
         return {}
 
+def page_links(path, params, logs, limit):
+    """En-tête Link (rel=next vers les logs plus anciens, rel=prev vers les plus récents)"""
+    if not logs:
+        return None
+    base = {k: v[0] for k, v in params.items() if k not in ('before', 'after')}
+    links = []
+    if len(logs) >= limit and logs[-1].get('sync_date'):
+        links.append(f'<{path}?{urlencode({**base, "before": logs[-1]["sync_date"]})}>; rel="next"')
+    if logs[0].get('sync_date'):
+        links.append(f'<{path}?{urlencode({**base, "after": logs[0]["sync_date"]})}>; rel="prev"')
+    return ', '.join(links) if links else None
+
+def get_logs_version(sync_type=None, status=None):
+    """Date du dernier log et nombre de logs, en une seule requête légère"""
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        return None, 0
+    try:
+        url = f"{SUPABASE_URL}/rest/v1/parc_sync_logs?select=sync_date&order=sync_date.desc&limit=1"
+        if sync_type:
+            url += f"&sync_type=eq.{sync_type}"
+        if status:
+            url += f"&status=eq.{status}"
+        
+        headers = {
+            'apikey': SUPABASE_KEY,
+            'Authorization': f'Bearer {SUPABASE_KEY}',
+            'Prefer': 'count=exact'
+        }
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req, timeout=10, context=ssl_context) as resp:
+            content_range = resp.headers.get('content-range', '0/0')
+            count = int(content_range.split('/')[-1]) if '/' in content_range else 0
+            data = json.loads(resp.read().decode('utf-8'))
+            return (data[0].get('sync_date') if data else None), count
+    except:
+        return None, 0
+
+def compute_etag(*parts):
+    """ETag faible dérivé des éléments qui versionnent la réponse"""
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:16]}"'
+
+def etag_matches(if_none_match, etag):
+    """Vérifie l'en-tête If-None-Match (liste séparée par des virgules ou *)"""
+    if not if_none_match or not etag:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or etag[2:] in candidates
+
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
@@ -87,23 +224,56 @@ class handler(BaseHTTPRequestHandler):
             sync_type = params.get('type', [None])[0]
             status = params.get('status', [None])[0]
             show_stats = params.get('stats', [''])[0] == '1'
+            before = params.get('before', [None])[0]
+            after = params.get('after', [None])[0]
+            since = params.get('since', [None])[0]
+            until = params.get('until', [None])[0]
+            link = None
+            
+            # Les logs ne changent qu'à l'écriture d'une sync: on répond 304
+            # sans relire la table si le client a déjà la version courante
+            last_date, count = get_logs_version(None if show_stats else sync_type, None if show_stats else status)
+            etag = compute_etag(last_date, count, parsed.query) if last_date else None
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', CACHE_CONTROL)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Access-Control-Expose-Headers', 'ETag')
+                self.end_headers()
+                return
             
             if show_stats:
                 result = {
-                    "stats": get_stats(),
+                    "stats": get_stats(since, until),
                     "recent_logs": get_logs(10)
                 }
             else:
-                result = get_logs(limit, sync_type, status)
+                result = get_logs(limit, sync_type, status, before, after)
+                link = page_links(parsed.path, params, result, limit)
+            
+            # Réponse vide alors que des logs existent = erreur Supabase, à ne pas mettre en cache
+            if count and not (result.get("stats") if show_stats else result):
+                etag = None
             
         except Exception as e:
             result = {"error": str(e)}
+            etag = None
+            link = None
         
         body = json.dumps(result, ensure_ascii=False).encode('utf-8')
         self.send_response(200)
         self.send_header('Content-type', 'application/json; charset=utf-8')
         self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+        else:
+            self.send_header('Cache-Control', 'no-store')
+        if link:
+            self.send_header('Link', link)
         self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag, Link')
         self.end_headers()
         self.wfile.write(body)
     
@@ -111,7 +281,7 @@ class handler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
         self.end_headers()
     
     def log_message(self, format, *args):
@@ -0,0 +1,144 @@
+"""
+Progilift Planning API - Tournée mensuelle d'un secteur
+Table: parc_planning_visites (ordre de visite par secteur et par mois, recalculé
+par api/sync.py après la sync des équipements du secteur)
+
+Endpoints:
+  ?secteur=X            → Appareils à visiter ce mois-ci, dans l'ordre de tournée
+  ?secteur=X&mois=1..12 → Même liste pour un autre mois
+
+Une tournée est lue sur la clé primaire (secteur, mois, rang): pas de filtre par
+colonne de mois ni de tri côté client.
+"""
+
+import os
+import json
+import hashlib
+import ssl
+import urllib.request
+from datetime import date
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
+
+# En-têtes de cache HTTP (navigateur / CDN Vercel): les tournées ne changent qu'à la sync
+CACHE_CONTROL = "public, max-age=60, s-maxage=300, stale-while-revalidate=600"
+
+# Taille des pages lues dans parc_planning_visites (<= max-rows PostgREST)
+PAGE_SIZE = 1000
+
+MOIS = ['janvier', 'février', 'mars', 'avril', 'mai', 'juin', 'juillet',
+        'août', 'septembre', 'octobre', 'novembre', 'décembre']
+
+COLUMNS = 'rang,id_wsoucont,code_appareil,adresse,ville,code_postal,nom_convivial,type_planning,wordre,ordre2,computed_at'
+
+try:
+    ssl_context = ssl.create_default_context()
+except:
+    ssl_context = ssl._create_unverified_context()
+
+def supabase_get(table, select="*", filter_str=None):
+    """Get depuis Supabase (lève une exception en cas d'erreur)"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?select={select}"
+    if filter_str:
+        url += f"&{filter_str}"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}'
+    }
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=15, context=ssl_context) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+def get_tournee(secteur, mois):
+    """Appareils à visiter d'un secteur pour un mois, triés par rang (pages keyset sur rang)"""
+    visites = []
+    last_rang = 0
+    while True:
+        rows = supabase_get(
+            'parc_planning_visites', COLUMNS,
+            f"secteur=eq.{secteur}&mois=eq.{mois}&rang=gt.{last_rang}&order=rang.asc&limit={PAGE_SIZE}"
+        )
+        visites.extend(rows)
+        if len(rows) < PAGE_SIZE:
+            return visites
+        last_rang = rows[-1]['rang']
+
+def compute_etag(*parts):
+    """ETag faible dérivé des éléments qui versionnent la réponse"""
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:16]}"'
+
+def etag_matches(if_none_match, etag):
+    """Vérifie l'en-tête If-None-Match (liste séparée par des virgules ou *)"""
+    if not if_none_match or not etag:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or etag[2:] in candidates
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        etag = None
+        try:
+            params = parse_qs(urlparse(self.path).query)
+            secteur = params.get('secteur', [None])[0]
+            mois = int(params.get('mois', [date.today().month])[0])
+            if not secteur:
+                return self._send_json(400, {"status": "error", "message": "Paramètre secteur requis"})
+            if not 1 <= mois <= 12:
+                return self._send_json(400, {"status": "error", "message": f"Mois invalide: {mois}"})
+            if not SUPABASE_URL or not SUPABASE_KEY:
+                return self._send_json(500, {"status": "error", "message": "Supabase non configuré"})
+
+            visites = get_tournee(int(secteur), mois)
+            result = {
+                "status": "ok",
+                "secteur": int(secteur),
+                "mois": mois,
+                "mois_nom": MOIS[mois - 1],
+                "count": len(visites),
+                "computed_at": max((v.get('computed_at') or '' for v in visites), default=None) or None,
+                "visites": visites
+            }
+            etag = compute_etag(result)
+        except ValueError as e:
+            return self._send_json(400, {"status": "error", "message": str(e)})
+        except Exception as e:
+            result = {"status": "error", "message": str(e)}
+
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Expose-Headers', 'ETag')
+            self.end_headers()
+            return
+        self._send_json(200, result, etag)
+
+    def _send_json(self, code, result, etag=None):
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+        else:
+            self.send_header('Cache-Control', 'no-store')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,298 @@
+"""
+Progilift Search API - Recherche d'appareils (typeahead NFC / parc)
+Table: parc_ascenseurs (colonne search_text écrite par api/sync.py)
+
+Endpoints:
+  ?q=texte&limit=20         → Appareils dont le code, l'adresse, la ville, le nom
+                              ou le n° de série contiennent tous les mots de q
+  &secteur=X                → Limite à un secteur
+  &source=index|trigram     → Index en mémoire (défaut) ou requête ilike sur search_text (index trigramme)
+  ?bench=1&q=texte&runs=5   → Compare l'ilike actuel du frontend, search_text et l'index en mémoire
+
+La recherche ignore la casse, les accents et la ponctuation ("Chateau" trouve
+"Château-d'Eau"). L'index en mémoire est rechargé au plus toutes les
+SEARCH_CACHE_TTL secondes, par pages triées sur id_wsoucont.
+"""
+
+import os
+import heapq
+import json
+import re
+import ssl
+import threading
+import time
+import unicodedata
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, quote, urlparse
+
+SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
+
+# Durée de vie de l'index en mémoire (secondes)
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', '300'))
+PAGE_SIZE = 1000
+MAX_LIMIT = 100
+
+# Champs repris dans search_text (identique à SEARCH_FIELDS dans sync.py)
+SEARCH_FIELDS = ('code_appareil', 'adresse', 'ville', 'nom_convivial', 'num_serie')
+RESULT_COLUMNS = ['id_wsoucont', 'code_appareil', 'adresse', 'ville', 'code_postal', 'secteur',
+                  'nom_convivial', 'num_serie', 'en_arret']
+
+try:
+    ssl_context = ssl.create_default_context()
+except:
+    ssl_context = ssl._create_unverified_context()
+
+# ============================================================
+# NORMALISATION
+# ============================================================
+
+def fold_text(value):
+    """Texte en minuscules, sans accents ni ponctuation (même normalisation que sync.py)"""
+    text = unicodedata.normalize('NFKD', str(value)).casefold().replace('œ', 'oe').replace('æ', 'ae')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+# ============================================================
+# CACHE TTL AVEC COALESCENCE
+# ============================================================
+
+_cache = {}
+_inflight = {}
+_cache_lock = threading.Lock()
+
+def cached(key, ttl, compute):
+    """Retourne compute() mis en cache ttl secondes.
+    Les appels concurrents sur une clé expirée attendent le calcul en cours
+    au lieu de relancer les requêtes Supabase."""
+    while True:
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            event = _inflight.get(key)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                _inflight[key] = event
+
+        if not owner:
+            event.wait(30)
+            continue
+
+        try:
+            value = compute()
+            with _cache_lock:
+                _cache[key] = (time.monotonic() + ttl, value)
+            return value
+        finally:
+            with _cache_lock:
+                _inflight.pop(key, None)
+            event.set()
+
+# ============================================================
+# REQUÊTES SUPABASE
+# ============================================================
+
+def supabase_get(table, select="*", filter_str=None):
+    """Get depuis Supabase (lève une exception en cas d'erreur)"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?select={select}"
+    if filter_str:
+        url += f"&{filter_str}"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}'
+    }
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=20, context=ssl_context) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+def ilike_pattern(text):
+    """Motif ilike PostgREST 'contient' (* = %), valeur échappée pour l'URL"""
+    return quote(f"*{text}*", safe='*')
+
+def search_ilike(q, limit, secteur=None):
+    """Recherche actuelle du frontend: ilike sur code_appareil, adresse, ville"""
+    term = q.replace(',', ' ').replace('(', ' ').replace(')', ' ').strip()
+    p = ilike_pattern(term)
+    filters = f"or=(code_appareil.ilike.{p},adresse.ilike.{p},ville.ilike.{p})&order=code_appareil.asc&limit={limit}"
+    if secteur:
+        filters += f"&secteur=eq.{int(secteur)}"
+    return supabase_get('parc_ascenseurs', ','.join(RESULT_COLUMNS), filters)
+
+def search_trigram(q, limit, secteur=None):
+    """Tous les mots de q dans search_text (ilike servi par l'index trigramme)"""
+    tokens = fold_text(q).split()
+    if not tokens:
+        return []
+    conditions = ','.join(f"search_text.ilike.{ilike_pattern(t)}" for t in tokens)
+    filters = f"and=({conditions})&order=code_appareil.asc&limit={limit}"
+    if secteur:
+        filters += f"&secteur=eq.{int(secteur)}"
+    return supabase_get('parc_ascenseurs', ','.join(RESULT_COLUMNS), filters)
+
+# ============================================================
+# INDEX EN MÉMOIRE
+# ============================================================
+
+def build_index():
+    """Charge tous les appareils (pages keyset sur id_wsoucont) en entrées
+    (search_text, code replié sans espaces, mots, ligne)"""
+    start = time.monotonic()
+    entries = []
+    select = ','.join(RESULT_COLUMNS + ['search_text'])
+    last_id = None
+    while True:
+        filters = f"order=id_wsoucont.asc&limit={PAGE_SIZE}"
+        if last_id is not None:
+            filters += f"&id_wsoucont=gt.{last_id}"
+        rows = supabase_get('parc_ascenseurs', select, filters)
+        for r in rows:
+            # Lignes pas encore resynchronisées: normalisation faite ici
+            text = r.pop('search_text', None) or fold_text(' '.join(str(r[f]) for f in SEARCH_FIELDS if r.get(f)))
+            code = fold_text(r.get('code_appareil') or '').replace(' ', '')
+            entries.append((text, code, set(text.split()), r))
+        if len(rows) < PAGE_SIZE:
+            break
+        last_id = rows[-1]['id_wsoucont']
+    return {
+        "entries": entries,
+        "built_at": time.time(),
+        "build_ms": round((time.monotonic() - start) * 1000, 1)
+    }
+
+def get_index():
+    return cached("index", SEARCH_CACHE_TTL, build_index)
+
+def match_score(entry, tokens, compact):
+    """Rang d'un appareil pour la requête (plus petit = meilleur), None s'il ne correspond pas.
+    0: code exact, 1: début de code, 2: tous les mots en début de mot, 3: contient"""
+    text, code, words, _ = entry
+    if not all(t in text for t in tokens):
+        return None
+    if code == compact:
+        return 0
+    if code.startswith(compact):
+        return 1
+    if all(any(w.startswith(t) for w in words) for t in tokens):
+        return 2
+    return 3
+
+def search_index(index, q, limit, secteur=None):
+    """Recherche dans l'index en mémoire, triée par rang puis par code"""
+    tokens = fold_text(q).split()
+    if not tokens:
+        return []
+    compact = ''.join(tokens)
+    secteur = int(secteur) if secteur else None
+    matches = []
+    for entry in index["entries"]:
+        if secteur is not None and entry[3].get('secteur') != secteur:
+            continue
+        score = match_score(entry, tokens, compact)
+        if score is not None:
+            matches.append((score, entry[1], entry[3]))
+    return [m[2] for m in heapq.nsmallest(limit, matches, key=lambda m: (m[0], m[1]))]
+
+# ============================================================
+# BENCHMARK
+# ============================================================
+
+def timed(fn, runs):
+    """(médiane en ms, résultat du dernier appel)"""
+    durations = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    durations.sort()
+    return round(durations[len(durations) // 2], 2), result
+
+def bench(q, limit, secteur=None, runs=5):
+    """Compare les trois chemins de recherche sur la même requête"""
+    index = get_index()
+    results = {}
+    for name, fn in (
+        ("ilike", lambda: search_ilike(q, limit, secteur)),
+        ("trigram", lambda: search_trigram(q, limit, secteur)),
+        ("index", lambda: search_index(index, q, limit, secteur))
+    ):
+        try:
+            ms, rows = timed(fn, runs)
+            results[name] = {"median_ms": ms, "count": len(rows), "first": [r.get('code_appareil') for r in rows[:5]]}
+        except Exception as e:
+            results[name] = {"error": str(e)}
+    return {
+        "status": "ok",
+        "mode": "bench",
+        "query": q,
+        "runs": runs,
+        "index_size": len(index["entries"]),
+        "index_build_ms": index["build_ms"],
+        "results": results
+    }
+
+# ============================================================
+# HANDLER HTTP (Vercel)
+# ============================================================
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        code = 200
+        try:
+            params = parse_qs(urlparse(self.path).query)
+            q = params.get('q', [''])[0].strip()
+            limit = max(1, min(int(params.get('limit', ['20'])[0]), MAX_LIMIT))
+            secteur = params.get('secteur', [None])[0]
+            source = params.get('source', ['index'])[0]
+
+            if not SUPABASE_URL or not SUPABASE_KEY:
+                code, result = 500, {"status": "error", "message": "Supabase non configuré"}
+            elif params.get('bench', [''])[0] == '1':
+                runs = max(1, min(int(params.get('runs', ['5'])[0]), 20))
+                result = bench(q, limit, secteur, runs)
+            elif len(fold_text(q)) < 2:
+                result = {"status": "ok", "query": q, "count": 0, "results": []}
+            else:
+                start = time.perf_counter()
+                if source == 'trigram':
+                    rows = search_trigram(q, limit, secteur)
+                    extra = {}
+                else:
+                    index = get_index()
+                    rows = search_index(index, q, limit, secteur)
+                    extra = {"index_size": len(index["entries"]), "index_age": round(time.time() - index["built_at"])}
+                result = {
+                    "status": "ok",
+                    "query": q,
+                    "source": 'trigram' if source == 'trigram' else 'index',
+                    "count": len(rows),
+                    "took_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "results": rows,
+                    **extra
+                }
+        except ValueError as e:
+            code, result = 400, {"status": "error", "message": str(e)}
+        except Exception as e:
+            code, result = 500, {"status": "error", "message": str(e)}
+
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'public, max-age=30' if code == 200 else 'no-store')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
@@ -1,27 +1,86 @@
 """
 Progilift Status API - État de la synchronisation
-Tables: parc_ascenseurs, parc_pannes, parc_arrets, parc_sync_logs
+Tables: parc_secteurs (cumuls maintenus par la sync), parc_arrets, parc_sync_logs
+Sans cumuls (migration add_parc_secteurs_rollup non appliquée), les comptages sont
+faits directement sur parc_ascenseurs et parc_pannes.
 """
 
 import os
 import json
+import hashlib
 import ssl
+import threading
+import time
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from http.server import BaseHTTPRequestHandler
 
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
 
+# Liste des 22 secteurs (identique à sync.py)
+SECTORS = ["1", "2", "3", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14", "15", "17", "18", "19", "20", "71", "72", "73", "74"]
+
+# Durée de vie du cache en mémoire (secondes) et parallélisme des requêtes
+CACHE_TTL = int(os.environ.get('STATUS_CACHE_TTL', '15'))
+MAX_WORKERS = 8
+
+# En-têtes de cache HTTP (navigateur / CDN Vercel)
+CACHE_CONTROL = f"public, max-age=5, s-maxage={CACHE_TTL}, stale-while-revalidate=60"
+
 try:
     ssl_context = ssl.create_default_context()
 except:
     ssl_context = ssl._create_unverified_context()
 
+# ============================================================
+# CACHE TTL AVEC COALESCENCE
+# ============================================================
+
+_cache = {}
+_inflight = {}
+_cache_lock = threading.Lock()
+
+def cached(key, ttl, compute):
+    """Retourne compute() mis en cache ttl secondes.
+    Les appels concurrents sur une clé expirée attendent le calcul en cours
+    au lieu de relancer les requêtes Supabase."""
+    while True:
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            event = _inflight.get(key)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                _inflight[key] = event
+        
+        if not owner:
+            event.wait(30)
+            continue
+        
+        try:
+            value = compute()
+            with _cache_lock:
+                _cache[key] = (time.monotonic() + ttl, value)
+            return value
+        finally:
+            with _cache_lock:
+                _inflight.pop(key, None)
+            event.set()
+
+# ============================================================
+# REQUÊTES SUPABASE
+# ============================================================
+
 def get_count(table, filter_str=None):
+    """Comptage exact via HEAD (aucune ligne téléchargée)"""
     if not SUPABASE_URL or not SUPABASE_KEY:
         return 0
     try:
-        url = f"{SUPABASE_URL}/rest/v1/{table}?select=count"
+        url = f"{SUPABASE_URL}/rest/v1/{table}?select=*"
         if filter_str:
             url += f"&{filter_str}"
         headers = {
@@ -29,7 +88,7 @@ def get_count(table, filter_str=None):
             'Authorization': f'Bearer {SUPABASE_KEY}',
             'Prefer': 'count=exact'
         }
-        req = urllib.request.Request(url, headers=headers)
+        req = urllib.request.Request(url, headers=headers, method='HEAD')
         with urllib.request.urlopen(req, timeout=10, context=ssl_context) as resp:
             content_range = resp.headers.get('content-range', '0/0')
             return int(content_range.split('/')[-1]) if '/' in content_range else 0
@@ -40,7 +99,8 @@ def get_last_sync():
     if not SUPABASE_URL or not SUPABASE_KEY:
         return None
     try:
-        url = f"{SUPABASE_URL}/rest/v1/parc_sync_logs?select=*&order=sync_date.desc&limit=1"
+        # Les passages ignorés faute de verrou (status skipped) ne sont pas des syncs
+        url = f"{SUPABASE_URL}/rest/v1/parc_sync_logs?select=*&status=neq.skipped&order=sync_date.desc&limit=1"
         headers = {
             'apikey': SUPABASE_KEY,
             'Authorization': f'Bearer {SUPABASE_KEY}'
@@ -68,49 +128,87 @@ def get_arrets_details():
     except:
         return []
 
-def get_stats_by_sector():
-    """Stats par secteur"""
+def get_stats_by_sector(executor=None):
+    """Stats par secteur: un comptage HEAD count=exact par secteur, en parallèle"""
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        return []
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            return get_stats_by_sector(pool)
+    
+    futures = [(s, executor.submit(get_count, "parc_ascenseurs", f"secteur=eq.{s}")) for s in SECTORS]
+    stats = []
+    for s, f in futures:
+        count = f.result()
+        if count:
+            stats.append({"secteur": int(s), "count": count})
+    return stats
+
+def get_secteurs_rollup():
+    """Cumuls par secteur maintenus par la sync (liste vide si non calculés)"""
     if not SUPABASE_URL or not SUPABASE_KEY:
         return []
     try:
-        # Récupérer les secteurs distincts avec comptage
-        url = f"{SUPABASE_URL}/rest/v1/parc_ascenseurs?select=secteur"
+        url = (f"{SUPABASE_URL}/rest/v1/parc_secteurs?select=numero,nom,nb_ascenseurs,nb_en_arret,nb_pannes,"
+               f"nb_pannes_30j,last_sync_at,last_error,last_error_at,stats_updated_at&order=numero")
         headers = {
             'apikey': SUPABASE_KEY,
             'Authorization': f'Bearer {SUPABASE_KEY}'
         }
         req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req, timeout=15, context=ssl_context) as resp:
-            data = json.loads(resp.read().decode('utf-8'))
-            
-            # Compter par secteur
-            sectors = {}
-            for item in data:
-                s = item.get('secteur')
-                if s:
-                    sectors[s] = sectors.get(s, 0) + 1
-            
-            return [{"secteur": k, "count": v} for k, v in sorted(sectors.items())]
+        with urllib.request.urlopen(req, timeout=10, context=ssl_context) as resp:
+            rows = json.loads(resp.read().decode('utf-8'))
+        return rows if any(r.get('stats_updated_at') for r in rows) else []
     except:
         return []
 
-def get_status():
-    last_sync = get_last_sync()
-    arrets_details = get_arrets_details()
-    
-    # Compter les pannes des 30 derniers jours
-    from datetime import datetime, timedelta
+def compute_status_rollup(rollup):
+    """Statut lu depuis les cumuls parc_secteurs (une ligne par secteur).
+    pannes_total / pannes_30j restent les comptages bruts de parc_pannes (comme
+    sans cumuls); les cumuls, tirés de parc_pannes_stats (hors visites cause 99,
+    appareils rattachés à un secteur, fenêtres recalculées une fois par jour),
+    sont exposés à part: pannes_secteurs / pannes_secteurs_30j."""
     date_30j = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        f_last_sync = pool.submit(get_last_sync)
+        f_arrets = pool.submit(get_arrets_details)
+        f_nb_arrets = pool.submit(get_count, "parc_arrets")
+        f_pannes = pool.submit(get_count, "parc_pannes")
+        f_pannes_30j = pool.submit(get_count, "parc_pannes", f"date_appel=gte.{date_30j}")
+        last_sync = f_last_sync.result()
+        arrets_details = f_arrets.result()
+        nb_arrets = f_nb_arrets.result()
+        nb_pannes = f_pannes.result()
+        nb_pannes_30j = f_pannes_30j.result()
     
+    sectors = [{
+        "secteur": r['numero'],
+        "nom": r.get('nom'),
+        "count": r.get('nb_ascenseurs') or 0,
+        "en_arret": r.get('nb_en_arret') or 0,
+        "pannes_30j": r.get('nb_pannes_30j') or 0,
+        "last_sync": r.get('last_sync_at'),
+        "last_error": r.get('last_error'),
+        "last_error_at": r.get('last_error_at')
+    } for r in rollup if r.get('nb_ascenseurs')]
+    
+    return build_status({
+        "ascenseurs": sum(r.get('nb_ascenseurs') or 0 for r in rollup),
+        "pannes_total": nb_pannes,
+        "pannes_30j": nb_pannes_30j,
+        "pannes_secteurs": sum(r.get('nb_pannes') or 0 for r in rollup),
+        "pannes_secteurs_30j": sum(r.get('nb_pannes_30j') or 0 for r in rollup),
+        "arrets": nb_arrets,
+        "secteurs": len(sectors)
+    }, sectors, arrets_details, last_sync, "parc_secteurs")
+
+def build_status(totals, sectors, arrets_details, last_sync, source):
+    """Réponse de statut, identique quelle que soit la source des comptages"""
     return {
         "status": "ok",
-        "totals": {
-            "ascenseurs": get_count("parc_ascenseurs"),
-            "pannes_total": get_count("parc_pannes"),
-            "pannes_30j": get_count("parc_pannes", f"date_appel=gte.{date_30j}"),
-            "arrets": get_count("parc_arrets"),
-            "secteurs": len(get_stats_by_sector())
-        },
+        "source": source,
+        "totals": totals,
+        "par_secteur": sectors,
         "arrets_en_cours": arrets_details,
         "last_sync": {
             "date": last_sync.get('sync_date') if last_sync else None,
@@ -123,6 +221,62 @@ def get_status():
         } if last_sync else None
     }
 
+def compute_status():
+    """Construit le statut depuis les cumuls parc_secteurs, ou à défaut
+    en lançant tous les comptages en parallèle"""
+    rollup = get_secteurs_rollup()
+    if rollup:
+        return compute_status_rollup(rollup)
+    
+    # Compter les pannes des 30 derniers jours
+    date_30j = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        f_last_sync = pool.submit(get_last_sync)
+        f_arrets = pool.submit(get_arrets_details)
+        f_counts = {
+            "ascenseurs": pool.submit(get_count, "parc_ascenseurs"),
+            "pannes_total": pool.submit(get_count, "parc_pannes"),
+            "pannes_30j": pool.submit(get_count, "parc_pannes", f"date_appel=gte.{date_30j}"),
+            "arrets": pool.submit(get_count, "parc_arrets")
+        }
+        sectors = get_stats_by_sector(pool)
+        
+        last_sync = f_last_sync.result()
+        arrets_details = f_arrets.result()
+        totals = {k: f.result() for k, f in f_counts.items()}
+    
+    totals["secteurs"] = len(sectors)
+    
+    return build_status(totals, sectors, arrets_details, last_sync, "comptages")
+
+def get_status():
+    return cached("status", CACHE_TTL, compute_status)
+
+# ============================================================
+# REQUÊTES CONDITIONNELLES (ETag)
+# ============================================================
+
+def compute_etag(*parts):
+    """ETag faible dérivé des éléments qui versionnent la réponse"""
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:16]}"'
+
+def etag_matches(if_none_match, etag):
+    """Vérifie l'en-tête If-None-Match (liste séparée par des virgules ou *)"""
+    if not if_none_match or not etag:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or etag[2:] in candidates
+
+def status_etag(result):
+    """La réponse ne change qu'avec une nouvelle sync ou un changement de comptage"""
+    if result.get("status") != "ok":
+        return None
+    last_sync = result.get("last_sync") or {}
+    return compute_etag(last_sync.get("date"), result.get("totals"), result.get("par_secteur"),
+                        len(result.get("arrets_en_cours") or []))
+
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
@@ -130,11 +284,27 @@ class handler(BaseHTTPRequestHandler):
         except Exception as e:
             result = {"status": "error", "message": str(e)}
         
+        etag = status_etag(result)
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Expose-Headers', 'ETag')
+            self.end_headers()
+            return
+        
         body = json.dumps(result, ensure_ascii=False).encode('utf-8')
         self.send_response(200)
         self.send_header('Content-type', 'application/json; charset=utf-8')
         self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', CACHE_CONTROL)
+        else:
+            self.send_header('Cache-Control', 'no-store')
         self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
         self.end_headers()
         self.wfile.write(body)
     
@@ -142,7 +312,7 @@ class handler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, If-None-Match')
         self.end_headers()
     
     def log_message(self, format, *args):
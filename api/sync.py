@@ -1,7 +1,9 @@
 """
 Progilift Sync API - Synchronisation complète vers Supabase
 ===========================================================
-Tables cibles: parc_ascenseurs, parc_pannes, parc_arrets, parc_secteurs, parc_type_planning, parc_sync_logs
+Tables cibles: parc_ascenseurs, parc_passages, parc_pannes, parc_arrets, parc_secteurs, parc_type_planning, parc_sync_logs
+(parc_pannes_stats est maintenue par trigger à chaque écriture dans parc_pannes,
+les cumuls de parc_secteurs sont recalculés après les écritures de chaque étape)
 
 Endpoints:
   ?step=0           → Types planning (table référence nb_visites)
@@ -10,18 +12,48 @@ Endpoints:
   ?step=2b&sector=X → Wsoucont2: passages, DAT, TXT (0-21)
   ?step=3&period=X  → Pannes (0-6)
   ?step=4           → Mise à jour nb_visites_an
-  ?mode=cron        → Sync rapide (arrêts + pannes récentes)
+  ?mode=cron        → Sync rapide (arrêts + pannes modifiées depuis le dernier succès)
+  ?mode=scheduler   → Lance le niveau (TIERS) le plus en retard, un par appel, à appeler chaque minute
+  ?mode=tier&tier=X → Force un niveau: stops, pannes ou equipements
+  ?mode=drain       → Rejoue les lots en attente dans le spool d'écriture
+  ?mode=bench&table=X&rows=N → Compare l'ingestion JSON / CSV (taille et temps)
+  ?mode=enqueue     → Crée une sync complète dans la file parc_sync_queue
+  ?mode=worker      → Traite des unités de la file (plusieurs workers en parallèle)
+  ?mode=queue       → Avancement de la sync complète en cours
+  ?mode=reconcile   → Empreintes par secteur Progilift / Supabase, resync des seuls secteurs divergents
+  &profile=1        → Profile l'étape ou le mode (cProfile + tracemalloc), enregistré dans parc_sync_profiles
+
+Les étapes 1, 3, 4 et le mode cron prennent les verrous de périmètre 'arrets' /
+'pannes' (parc_sync_locks). Si un verrou est pris, le passage est ignoré
+(status "skipped", tracé dans parc_sync_logs), ou attendu jusqu'à &wait=N secondes.
 """
 
 import os
+import cProfile
+import csv
+import io
 import json
+import hashlib
+import math
+import pstats
+import random
 import re
+import sqlite3
 import ssl
+import threading
+import time
 import traceback
+import tracemalloc
+import unicodedata
 import urllib.request
-from datetime import datetime
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from http.server import BaseHTTPRequestHandler
-from urllib.parse import parse_qs, urlparse
+from itertools import islice
+from urllib.parse import parse_qs, quote, urlparse
 
 # Configuration
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
@@ -32,6 +64,12 @@ WS_URL = "https://ws.progilift.fr/WS_PROGILIFT_20230419_WEB/awws/WS_Progilift_20
 # Liste des 22 secteurs
 SECTORS = ["1", "2", "3", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14", "15", "17", "18", "19", "20", "71", "72", "73", "74"]
 
+# Colonnes mois de Wsoucont, dans l'ordre des bits de planning_mask (bit 0 = janvier)
+PLANNING_MONTHS = ['JAN', 'FEV', 'MAR', 'AVR', 'MAI', 'JUI', 'JUL', 'AOU', 'SEP', 'OCT', 'NOV', 'DEC']
+
+# Champs des appareils repris dans search_text (recherche, api/search.py)
+SEARCH_FIELDS = ('code_appareil', 'adresse', 'ville', 'nom_convivial', 'num_serie')
+
 # Périodes pour les pannes
 PERIODS = [
     "2025-10-01T00:00:00",
@@ -43,6 +81,129 @@ PERIODS = [
     "2020-01-01T00:00:00"
 ]
 
+# Fenêtre de sync des pannes en mode cron (filigrane parc_sync_watermarks)
+PANNES_FALLBACK_DAYS = 30
+PANNES_OVERLAP_MINUTES = 15
+
+# Nombre d'identifiants par filtre in.() (URL < ~8 Ko)
+IN_FILTER_CHUNK = 300
+
+# Scheduler par niveaux: cadence (minutes) et budget de temps (secondes).
+# Chaque niveau a son propre verrou, un niveau lent ne bloque jamais les autres.
+TIERS = {
+    'stops': {'interval': 2, 'budget': 40},           # Arrêts (get_AppareilsArret)
+    'pannes': {'interval': 15, 'budget': 200},        # Pannes modifiées (Wpanne)
+    'equipements': {'interval': 30, 'budget': 270}  # Équipements modifiés (Wsoucont), secteurs priorisés
+}
+
+# Priorisation des secteurs (niveau equipements): budget journalier d'appels
+# get_Synchro_Wsoucont, ancienneté maximale d'un secteur, délai minimal entre deux
+# passages d'un secteur actif, lissage du taux de changement (lignes/jour) et
+# nombre de changements attendus à partir duquel un secteur est resynchronisé
+EQUIPEMENTS_DAILY_CALLS = int(os.environ.get('SYNC_EQUIPEMENTS_DAILY_CALLS', '66'))
+SECTOR_MAX_STALENESS_HOURS = 24
+SECTOR_MIN_INTERVAL_MINUTES = 60
+CHANGE_RATE_ALPHA = 0.3
+CHANGE_MIN_EXPECTED = 1.0
+# Secteur en échec (ou partiel): nouvel essai après un délai doublé à chaque échec
+# (30 min, 1 h, 2 h... plafonné à SECTOR_MAX_STALENESS_HOURS), payé sur les jetons
+SECTOR_RETRY_MINUTES = 30
+
+# Verrous de périmètre (parc_sync_locks): bail court prolongé par heartbeat tant
+# que la sync tourne, un verrou non prolongé est repris après LOCK_TTL secondes
+LOCK_TTL = 90
+LOCK_HEARTBEAT = 30
+LOCK_POLL_SECONDS = 5
+# Périmètres verrouillés par étape de la sync complète et par niveau du scheduler
+STEP_LOCKS = {
+    '1': ['arrets'],   # parc_arrets vidée puis recréée + flags en_arret
+    '3': ['pannes'],   # upsert parc_pannes
+    '4': ['arrets']    # flags en_arret depuis parc_arrets
+}
+TIER_LOCKS = {
+    'stops': ['arrets'],
+    'pannes': ['pannes']
+}
+
+# File de travail de la sync complète (parc_sync_queue): bail d'une unité,
+# budget d'un worker et nombre de tentatives avant abandon d'une unité
+QUEUE_LEASE_SECONDS = 300
+QUEUE_WORKER_BUDGET = 240
+QUEUE_POLL_SECONDS = 5
+QUEUE_MAX_ATTEMPTS = 3
+
+# Réconciliation: budget de temps d'un passage (secondes), repris au secteur suivant
+RECONCILE_BUDGET = 240
+
+# Profilage (&profile=1): nombre de fonctions et de sites d'allocation conservés
+PROFILE_TOP = 25
+
+# Miroir SQLite local (clés, hash de ligne, flags) - désactivé si SYNC_MIRROR_PATH est vide
+MIRROR_PATH = os.environ.get('SYNC_MIRROR_PATH', '')
+MIRROR_VERIFY_SECONDS = 600
+MIRROR_TABLES = {
+    'parc_ascenseurs': 'id_wsoucont',
+    'parc_pannes': 'id_panne'
+}
+# Colonnes exclues du hash de ligne (changent à chaque sync)
+VOLATILE_COLUMNS = ('synced_at', 'updated_at', 'row_hash')
+
+# Spool d'écriture: lots transformés conservés sur disque jusqu'à leur écriture dans Supabase.
+# Sur Vercel, /tmp est local à l'instance et ne survit pas à son recyclage:
+# SYNC_SPOOL_DIR doit pointer vers un volume persistant pour une reprise garantie.
+SPOOL_DIR = os.environ.get('SYNC_SPOOL_DIR', '/tmp/parc_spool')
+SPOOL_BATCH_START = 100
+SPOOL_BATCH_MAX = 5000
+# Drains successifs en erreur d'un même segment avant sa mise à l'écart dans
+# <table>/failed/ (il ne compte plus comme en attente dès le deuxième)
+SPOOL_MAX_ATTEMPTS = 5
+
+# Quarantaine (parc_sync_quarantine): classes SQLSTATE (champ 'code' de l'erreur
+# PostgREST) d'une ligne refusée pour son contenu, isolée par l'upsert adaptatif:
+# 22 = donnée invalide (type, longueur, date), 23 = contrainte d'intégrité.
+# Les erreurs de requête (PGRST*: colonne inconnue, on_conflict invalide, corps
+# illisible) touchent toutes les lignes et restent dans le spool.
+QUARANTINE_SQLSTATE_CLASSES = ('22', '23')
+# Au-delà de ce nombre de lignes refusées dans un même appel, défaut de schéma
+# probable (colonne trop courte, contrainte ajoutée): rien n'est mis en quarantaine
+QUARANTINE_MAX_ROWS = 50
+
+# Corps de requête d'upsert envoyés en flux (Transfer-Encoding: chunked)
+UPLOAD_CHUNK = 64 * 1024
+UPLOAD_GZIP = os.environ.get('SYNC_GZIP_UPLOADS', '') == '1'
+
+# Lecture paginée (en-tête Range, tri sur la clé primaire) et pages lues en parallèle
+READ_PAGE_SIZE = 1000
+READ_WORKERS = 4
+PRIMARY_KEYS = {
+    'parc_ascenseurs': 'id_wsoucont',
+    'parc_pannes': 'id_panne',
+    'parc_arrets': 'id',
+    'parc_type_planning': 'id',
+    'parc_passages': 'id',
+    'parc_sync_quarantine': 'row_key',
+    'parc_sync_watermarks': 'scope',
+    'parc_sync_locks': 'scope'
+}
+
+# Ingestion CSV (Content-Type: text/csv) pour les tables larges et plates, activée
+# table par table via SYNC_CSV_TABLES (ex: "parc_pannes,parc_arrets"). Les colonnes
+# listées ici sont les seules envoyées: le blob brut data_wpanne n'est pas écrit en CSV.
+CSV_COLUMNS = {
+    'parc_pannes': [
+        'id_panne', 'id_wsoucont', 'code_appareil', 'adresse', 'code_postal',
+        'date_appel', 'heure_appel', 'date_arrivee', 'heure_arrivee', 'date_depart', 'heure_depart',
+        'motif', 'cause', 'travaux', 'depanneur', 'duree_minutes', 'type_panne', 'etat',
+        'demandeur', 'personnes_bloquees', 'row_hash', 'synced_at', 'updated_at'
+    ],
+    'parc_arrets': [
+        'id_wsoucont', 'id_panne', 'code_appareil', 'adresse', 'ville', 'secteur',
+        'date_appel', 'heure_appel', 'motif', 'demandeur', 'synced_at'
+    ],
+    'parc_type_planning': ['id_wtypepla', 'code', 'nb_visites', 'libelle']
+}
+CSV_TABLES = {t.strip() for t in os.environ.get('SYNC_CSV_TABLES', '').split(',') if t.strip() in CSV_COLUMNS}
+
 # SSL Context
 try:
     ssl_context = ssl.create_default_context()
@@ -106,7 +267,8 @@ def safe_time(value):
         return None
 
 def http_request(url, method='GET', data=None, headers=None, timeout=30):
-    """Requête HTTP générique"""
+    """Requête HTTP générique
+    (un générateur de bytes en data est envoyé en Transfer-Encoding: chunked)"""
     headers = headers or {}
     if data and isinstance(data, (dict, list)):
         data = json.dumps(data).encode('utf-8')
@@ -225,6 +387,20 @@ def supabase_update(table, key_col, key_val, data):
     status, _ = http_request(url, 'PATCH', data, supabase_headers(), 15)
     return status in [200, 204]
 
+def supabase_update_in(table, key_col, keys, data, chunk_size=None):
+    """Update groupé: un PATCH {key_col}=in.(...) par paquet de clés (limite de longueur d'URL)"""
+    if not SUPABASE_URL:
+        return False
+    chunk_size = chunk_size or IN_FILTER_CHUNK
+    keys = sorted(keys)
+    ok = True
+    for i in range(0, len(keys), chunk_size):
+        ids = ','.join(str(k) for k in keys[i:i+chunk_size])
+        url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?{key_col}=in.({ids})"
+        status, _ = http_request(url, 'PATCH', data, supabase_headers(), 30)
+        ok = ok and status in [200, 204]
+    return ok
+
 def supabase_delete(table, filter_str=None):
     """Delete dans Supabase"""
     url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}"
@@ -235,21 +411,870 @@ def supabase_delete(table, filter_str=None):
     status, _ = http_request(url, 'DELETE', None, supabase_headers(), 30)
     return status in [200, 204]
 
-def supabase_get(table, select="*", filter_str=None, limit=None):
-    """Get depuis Supabase"""
+def replace_table(table, rows):
+    """Remplace tout le contenu d'une table de référence en une transaction
+    (RPC parc_replace_rows): les lecteurs voient l'ancien ou le nouveau contenu,
+    jamais une table à moitié écrite. Retourne (lignes écrites, erreur)."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_replace_rows"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, body = http_request(url, 'POST', {'p_table': table, 'p_rows': rows}, headers, 60)
+    if status == 404:
+        # Migration add_parc_replace_rows pas encore appliquée: suppression puis insertion groupée
+        supabase_delete(table)
+        written, errors, _ = upsert_adaptive(table, *list_source(rows), None)
+        return written, '; '.join(errors[:3]) or None
+    if status != 200:
+        return 0, f"HTTP {status}: {body[:300] if body else 'No response'}"
+    try:
+        return int(json.loads(body)), None
+    except (ValueError, TypeError):
+        return len(rows), None
+
+def supabase_page(table, select, filter_str, start, end, count=False):
+    """Lignes [start, end] d'une lecture (en-tête Range), et le total exact si count.
+    Lève une exception en cas d'erreur HTTP, une page manquante ne doit pas passer inaperçue."""
     url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?select={select}"
     if filter_str:
         url += f"&{filter_str}"
-    if limit:
-        url += f"&limit={limit}"
     headers = {
         'apikey': SUPABASE_KEY,
-        'Authorization': f'Bearer {SUPABASE_KEY}'
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Range-Unit': 'items',
+        'Range': f'{start}-{end}'
+    }
+    if count:
+        headers['Prefer'] = 'count=exact'
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=30, context=ssl_context) as resp:
+        total = (resp.headers.get('Content-Range') or '*/*').split('/')[-1]
+        return json.loads(resp.read().decode('utf-8')), int(total) if total.isdigit() else None
+
+def supabase_iter(table, select="*", filter_str=None, key=None, page_size=None, workers=None):
+    """Lecture complète d'une table, sans la limite max-rows de PostgREST.
+    Retourne (total exact, générateur de lignes): les pages suivantes sont lues
+    par `workers` requêtes en parallèle et rendues dans l'ordre, au plus
+    `workers` pages en mémoire. Tri sur la clé primaire pour des pages stables."""
+    page_size = page_size or READ_PAGE_SIZE
+    workers = workers or READ_WORKERS
+    key = key or PRIMARY_KEYS.get(table)
+    if key and 'order=' not in (filter_str or ''):
+        filter_str = f"{filter_str}&order={key}.asc" if filter_str else f"order={key}.asc"
+    
+    first, total = supabase_page(table, select, filter_str, 0, page_size - 1, count=True)
+    if total is None:
+        total = len(first)
+    # max-rows du serveur inférieur à la page demandée: on s'aligne dessus
+    page = len(first) if 0 < len(first) < min(page_size, total) else page_size
+    
+    def rows():
+        yield from first
+        starts = iter(range(len(first), total, page))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque(
+                pool.submit(supabase_page, table, select, filter_str, s, s + page - 1)
+                for s in islice(starts, workers)
+            )
+            while pending:
+                batch, _ = pending.popleft().result()
+                s = next(starts, None)
+                if s is not None:
+                    pending.append(pool.submit(supabase_page, table, select, filter_str, s, s + page - 1))
+                yield from batch
+    
+    return total, rows()
+
+def supabase_get(table, select="*", filter_str=None, limit=None):
+    """Get depuis Supabase (toutes les lignes, paginées, si limit n'est pas donné)"""
+    if not SUPABASE_URL:
+        return []
+    try:
+        if limit:
+            return supabase_page(table, select, filter_str, 0, limit - 1)[0]
+        return list(supabase_iter(table, select, filter_str)[1])
+    except Exception:
+        return []
+
+def get_watermark(scope):
+    """Filigrane d'un périmètre de sync: (datetime du dernier succès, statut)"""
+    rows = supabase_get('parc_sync_watermarks', 'watermark,status', f'scope=eq.{scope}')
+    if not rows:
+        return None, None
+    try:
+        wm = datetime.fromisoformat(rows[0]['watermark']) if rows[0].get('watermark') else None
+    except (TypeError, ValueError):
+        wm = None
+    return wm, rows[0].get('status')
+
+def set_watermark(scope, watermark, status):
+    """Enregistre le filigrane (watermark=None conserve le précédent)"""
+    data = {'scope': scope, 'status': status, 'updated_at': datetime.now().isoformat()}
+    if watermark:
+        data['watermark'] = watermark.isoformat()
+    return supabase_upsert('parc_sync_watermarks', data, 'scope')
+
+def get_sync_state(scope):
+    """Ligne parc_sync_watermarks d'un périmètre (dict vide si absente)"""
+    rows = supabase_get('parc_sync_watermarks', '*', f'scope=eq.{scope}')
+    return rows[0] if rows else {}
+
+def save_sync_state(scope, **fields):
+    """Met à jour les colonnes données de parc_sync_watermarks pour un périmètre"""
+    data = {'scope': scope, 'updated_at': datetime.now().isoformat()}
+    for k, v in fields.items():
+        data[k] = v.isoformat() if isinstance(v, datetime) else v
+    return supabase_upsert('parc_sync_watermarks', data, 'scope')
+
+def parse_ts(value):
+    """Timestamp ISO Supabase -> datetime naïf (None si invalide)"""
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None) if value else None
+    except (TypeError, ValueError):
+        return None
+
+def acquire_lock(scope, ttl, sync_type=None):
+    """Prend le verrou parc_sync_locks d'un périmètre pour ttl secondes.
+    Retourne l'identifiant du détenteur, ou None si le verrou est déjà pris."""
+    base = f"{SUPABASE_URL.rstrip('/')}/rest/v1/parc_sync_locks"
+    now = datetime.now()
+    holder = uuid.uuid4().hex
+    
+    # Créer la ligne si absente, sans écraser un verrou existant
+    headers = supabase_headers()
+    headers['Prefer'] = 'resolution=ignore-duplicates,return=minimal'
+    http_request(f"{base}?on_conflict=scope", 'POST', {'scope': scope}, headers, 15)
+    
+    # Prise atomique: un seul UPDATE conditionnel (libre ou expiré)
+    headers = supabase_headers()
+    headers['Prefer'] = 'return=representation'
+    url = f"{base}?scope=eq.{scope}&or=(holder.is.null,expires_at.lt.{now.isoformat()})"
+    status, body = http_request(url, 'PATCH', {
+        'holder': holder,
+        'sync_type': sync_type,
+        'acquired_at': now.isoformat(),
+        'heartbeat_at': now.isoformat(),
+        'expires_at': (now + timedelta(seconds=ttl)).isoformat()
+    }, headers, 15)
+    try:
+        return holder if status == 200 and json.loads(body) else None
+    except ValueError:
+        return None
+
+def renew_lock(scope, holder, ttl):
+    """Prolonge le bail du verrou s'il appartient encore à holder (heartbeat).
+    Faux si le verrou a été repris entre-temps."""
+    now = datetime.now()
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/parc_sync_locks?scope=eq.{scope}&holder=eq.{holder}"
+    headers = supabase_headers()
+    headers['Prefer'] = 'return=representation'
+    status, body = http_request(url, 'PATCH', {
+        'heartbeat_at': now.isoformat(),
+        'expires_at': (now + timedelta(seconds=ttl)).isoformat()
+    }, headers, 15)
+    try:
+        return status == 200 and bool(json.loads(body))
+    except ValueError:
+        return False
+
+def release_lock(scope, holder):
+    """Libère le verrou s'il appartient encore à holder"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/parc_sync_locks?scope=eq.{scope}&holder=eq.{holder}"
+    status, _ = http_request(url, 'PATCH', {'holder': None, 'expires_at': None}, supabase_headers(), 15)
+    return status in [200, 204]
+
+def acquire_locks(scopes, sync_type, wait=0):
+    """Prend tous les verrous (ordre trié, tout ou rien), en réessayant pendant wait secondes.
+    Retourne {scope: holder}, ou None si un verrou est resté pris."""
+    deadline = time.monotonic() + wait
+    while True:
+        held = {}
+        for scope in sorted(scopes):
+            holder = acquire_lock(scope, LOCK_TTL, sync_type)
+            if not holder:
+                break
+            held[scope] = holder
+        else:
+            return held
+        for scope, holder in held.items():
+            release_lock(scope, holder)
+        if time.monotonic() + LOCK_POLL_SECONDS > deadline:
+            return None
+        time.sleep(LOCK_POLL_SECONDS)
+
+def start_heartbeat(held, lost):
+    """Prolonge les verrous toutes les LOCK_HEARTBEAT secondes jusqu'à l'arrêt.
+    Les périmètres dont le verrou a été repris sont ajoutés à lost."""
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(LOCK_HEARTBEAT):
+            for scope, holder in held.items():
+                if scope not in lost and not renew_lock(scope, holder, LOCK_TTL):
+                    lost.append(scope)
+    threading.Thread(target=beat, daemon=True).start()
+    return stop
+
+def run_locked(scopes, sync_type, fn, wait=0, log_skip=True):
+    """Exécute fn() sous les verrous des périmètres donnés, prolongés par heartbeat.
+    Si un verrou reste pris, la sync est ignorée et le passage tracé dans parc_sync_logs."""
+    if not scopes:
+        return fn()
+    held = acquire_locks(scopes, sync_type, wait)
+    if held is None:
+        busy = supabase_get('parc_sync_locks', 'scope,sync_type,acquired_at,heartbeat_at,expires_at',
+                            f"scope=in.({','.join(scopes)})&holder=not.is.null")
+        message = "Ignoré, verrou détenu: " + ('; '.join(
+            f"{b['scope']} par {b.get('sync_type') or '?'} depuis {b.get('acquired_at')}" for b in busy
+        ) or ', '.join(scopes))
+        if log_skip:
+            supabase_insert('parc_sync_logs', {
+                'sync_date': datetime.now().isoformat(),
+                'sync_type': sync_type,
+                'status': 'skipped',
+                'equipements_count': 0,
+                'pannes_count': 0,
+                'arrets_count': 0,
+                'duration_seconds': 0,
+                'error_message': message[:500]
+            })
+        return {"status": "skipped", "message": message, "locks": busy}
+    
+    lost = []
+    stop = start_heartbeat(held, lost)
+    try:
+        result = fn()
+    finally:
+        stop.set()
+        for scope, holder in held.items():
+            release_lock(scope, holder)
+    if lost:
+        result['lock_lost'] = lost
+    return result
+
+def refresh_secteurs(secteurs=None, synced_at=None, error=None):
+    """Recalcule les cumuls de parc_secteurs (tous les secteurs si secteurs=None).
+    synced_at / error enregistrent la dernière sync réussie ou l'échec des secteurs donnés."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_secteurs_refresh"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, _ = http_request(url, 'POST', {
+        'p_secteurs': [int(s) for s in secteurs] if secteurs else None,
+        'p_synced_at': synced_at.isoformat() if synced_at else None,
+        'p_error': safe_str(error, 500)
+    }, headers, 30)
+    return status == 200
+
+def sync_en_arret_flags(arret_ids):
+    """Aligne parc_ascenseurs.en_arret sur les appareils actuellement à l'arrêt.
+    Diff entre les appareils déjà marqués et les arrêts en cours, appliqué en
+    deux PATCH groupés (retrait / ajout du flag) au lieu d'un PATCH par appareil."""
+    stopped = {i for i in arret_ids if i}
+    try:
+        # Lecture paginée: une liste tronquée (max-rows) laisserait des flags en place
+        _, current = supabase_iter('parc_ascenseurs', 'id_wsoucont', 'en_arret=eq.true')
+        flagged = {a['id_wsoucont'] for a in current if a.get('id_wsoucont')}
+    except Exception as e:
+        return {"stopped": len(stopped), "set": 0, "cleared": 0, "ok": False, "error": str(e)}
+    
+    to_clear = flagged - stopped
+    to_set = stopped - flagged
+    ok = True
+    if to_clear:
+        if supabase_update_in('parc_ascenseurs', 'id_wsoucont', to_clear, {'en_arret': False}):
+            mirror_set_flags(to_clear, False)
+        else:
+            ok = False
+    if to_set:
+        if supabase_update_in('parc_ascenseurs', 'id_wsoucont', to_set, {'en_arret': True}):
+            mirror_set_flags(to_set, True)
+        else:
+            ok = False
+    if to_clear or to_set:
+        refresh_secteurs()
+    
+    return {"stopped": len(stopped), "set": len(to_set), "cleared": len(to_clear), "ok": ok}
+
+def pannes_since(now):
+    """Date de départ de la sync des pannes et mode ('delta' ou 'fallback')"""
+    wm, status = get_watermark('pannes')
+    if wm and status == 'success':
+        return wm - timedelta(minutes=PANNES_OVERLAP_MINUTES), 'delta'
+    return now - timedelta(days=PANNES_FALLBACK_DAYS), 'fallback'
+
+# ============================================================
+# MIROIR LOCAL (SQLite)
+# ============================================================
+# Copie locale de (clé, secteur, id_wsoucont, row_hash, en_arret) pour
+# parc_ascenseurs et parc_pannes. Permet de ne renvoyer à Supabase que les
+# lignes dont le hash a changé, sans relire les tables via PostgREST.
+# Contrôlé par parc_mirror_checksum() (nombre de lignes + somme des hash),
+# reconstruit entièrement en cas d'écart.
+
+_mirror_conn = None
+
+def mirror_db():
+    """Connexion au miroir, None si désactivé"""
+    global _mirror_conn
+    if not MIRROR_PATH:
+        return None
+    if _mirror_conn is None:
+        _mirror_conn = sqlite3.connect(MIRROR_PATH, timeout=30)
+        _mirror_conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS mirror_rows (
+                tbl TEXT NOT NULL,
+                key INTEGER NOT NULL,
+                secteur INTEGER,
+                id_wsoucont INTEGER,
+                row_hash TEXT NOT NULL DEFAULT '',
+                en_arret INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (tbl, key)
+            );
+            CREATE TABLE IF NOT EXISTS mirror_meta (
+                tbl TEXT PRIMARY KEY,
+                verified_at REAL
+            );
+        """)
+    return _mirror_conn
+
+def row_hash(data):
+    """Hash stable d'une ligne (hors colonnes volatiles), 16 caractères hexa"""
+    stable = {k: v for k, v in data.items() if k not in VOLATILE_COLUMNS}
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+def hash_value(h):
+    """Valeur numérique d'un hash pour la somme de contrôle (60 bits, cf. parc_mirror_checksum)"""
+    return int(h[:15], 16) if h else 0
+
+def mirror_local_checksum(table):
+    db = mirror_db()
+    count, flagged, total = 0, 0, 0
+    for h, en_arret in db.execute("SELECT row_hash, en_arret FROM mirror_rows WHERE tbl = ?", (table,)):
+        count += 1
+        flagged += en_arret
+        total += hash_value(h)
+    return {"count": count, "checksum": total, "flagged": flagged}
+
+def mirror_remote_checksum(table):
+    """Somme de contrôle calculée côté Supabase (RPC), None si indisponible"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_mirror_checksum"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, body = http_request(url, 'POST', {'p_table': table}, headers, 30)
+    if status != 200:
+        return None
+    try:
+        data = json.loads(body)
+        return {"count": int(data['count']), "checksum": int(data['checksum']), "flagged": int(data['flagged'])}
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def mirror_rebuild(table):
+    """Recharge le miroir d'une table depuis Supabase (lecture paginée triée sur la clé)"""
+    db = mirror_db()
+    key_col = MIRROR_TABLES[table]
+    select = 'id_wsoucont,secteur,row_hash,en_arret' if table == 'parc_ascenseurs' else 'id_panne,id_wsoucont,row_hash'
+    
+    db.execute("DELETE FROM mirror_rows WHERE tbl = ?", (table,))
+    _, rows = supabase_iter(table, select, key=key_col)
+    loaded = 0
+    for batch in iter(lambda: list(islice(rows, READ_PAGE_SIZE)), []):
+        db.executemany(
+            "INSERT OR REPLACE INTO mirror_rows (tbl, key, secteur, id_wsoucont, row_hash, en_arret) VALUES (?, ?, ?, ?, ?, ?)",
+            [(table, r[key_col], r.get('secteur'), r.get('id_wsoucont'), r.get('row_hash') or '', 1 if r.get('en_arret') else 0) for r in batch]
+        )
+        loaded += len(batch)
+    db.commit()
+    return loaded
+
+def mirror_verify(table, force=False):
+    """Vérifie le miroir contre Supabase (au plus toutes les MIRROR_VERIFY_SECONDS)
+    et le reconstruit en cas d'écart. Retourne False si le miroir est inutilisable."""
+    db = mirror_db()
+    if db is None:
+        return False
+    row = db.execute("SELECT verified_at FROM mirror_meta WHERE tbl = ?", (table,)).fetchone()
+    now = datetime.now().timestamp()
+    if row and row[0] and not force and now - row[0] < MIRROR_VERIFY_SECONDS:
+        return True
+    
+    remote = mirror_remote_checksum(table)
+    if remote is None:
+        return False
+    if remote != mirror_local_checksum(table):
+        try:
+            mirror_rebuild(table)
+        except Exception:
+            # Lecture interrompue: on garde l'ancien miroir, inutilisable pour ce passage
+            db.rollback()
+            return False
+        if mirror_local_checksum(table) != mirror_remote_checksum(table):
+            return False
+    db.execute("INSERT OR REPLACE INTO mirror_meta (tbl, verified_at) VALUES (?, ?)", (table, now))
+    db.commit()
+    return True
+
+def mirror_changed(table, rows):
+    """Ajoute row_hash à chaque ligne et ne garde que celles qui diffèrent du miroir
+    (toutes les lignes si le miroir est désactivé ou invérifiable)"""
+    for r in rows:
+        r['row_hash'] = row_hash(r)
+    if not mirror_verify(table):
+        return rows
+    key_col = MIRROR_TABLES[table]
+    db = mirror_db()
+    known = {}
+    keys = [r[key_col] for r in rows]
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i+500]
+        q = f"SELECT key, row_hash FROM mirror_rows WHERE tbl = ? AND key IN ({','.join('?' * len(chunk))})"
+        known.update(db.execute(q, [table] + chunk).fetchall())
+    return [r for r in rows if known.get(r[key_col]) != r['row_hash']]
+
+def mirror_record(table, rows):
+    """Enregistre dans le miroir des lignes écrites avec succès dans Supabase"""
+    db = mirror_db()
+    if db is None or rows is None:
+        return
+    key_col = MIRROR_TABLES[table]
+    db.executemany(
+        """INSERT INTO mirror_rows (tbl, key, secteur, id_wsoucont, row_hash) VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT (tbl, key) DO UPDATE SET secteur = excluded.secteur,
+             id_wsoucont = excluded.id_wsoucont, row_hash = excluded.row_hash""",
+        ((table, r[key_col], r.get('secteur'), r.get('id_wsoucont'), r.get('row_hash') or row_hash(r)) for r in rows)
+    )
+    db.commit()
+
+def mirror_set_flags(ids, en_arret):
+    """Reporte dans le miroir un changement de flag en_arret"""
+    db = mirror_db()
+    if db is None or not ids:
+        return
+    db.executemany(
+        "UPDATE mirror_rows SET en_arret = ? WHERE tbl = 'parc_ascenseurs' AND key = ?",
+        [(1 if en_arret else 0, i) for i in ids]
+    )
+    db.commit()
+
+# ============================================================
+# SPOOL D'ÉCRITURE
+# ============================================================
+# Les lots transformés sont d'abord ajoutés au spool de leur table: un
+# segment par lot, écrit en .tmp, fsync puis renommé en .seg. Le drainer
+# rejoue les segments dans l'ordre par upserts idempotents, avec une taille
+# de lot adaptative, et ne supprime un segment qu'une fois entièrement écrit;
+# un segment partiellement écrit est réécrit avec ses seules lignes en échec.
+# Un segment encore en échec au drain suivant n'est plus compté comme en
+# attente (retrying) et, après SPOOL_MAX_ATTEMPTS drains, est mis à l'écart
+# dans <table>/failed/ pour examen.
+# Si Supabase est lent ou indisponible, les données téléchargées restent
+# dans le spool et seront écrites au prochain drain... sur la même instance:
+# le spool par défaut (/tmp) disparaît avec l'instance serverless, les
+# segments non drainés sont alors perdus et seuls les filigranes (pannes,
+# secteurs) garantissent qu'ils seront retéléchargés.
+
+_batch_sizes = {}
+_quarantined = {}
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def spool_write(table, rows, on_conflict):
+    """Ajoute un segment au spool de la table, retourne son chemin"""
+    path = os.path.join(SPOOL_DIR, table)
+    os.makedirs(path, exist_ok=True)
+    name = f"{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    tmp = os.path.join(path, name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'table': table, 'on_conflict': on_conflict, 'rows': len(rows)}) + '\n')
+        for r in rows:
+            f.write(json.dumps(r, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    segment = os.path.join(path, name + '.seg')
+    os.replace(tmp, segment)
+    fsync_dir(path)
+    return segment
+
+def spool_segments(table):
+    """Segments complets en attente, du plus ancien au plus récent"""
+    path = os.path.join(SPOOL_DIR, table)
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.seg'))
+
+def segment_source(segment):
+    """(en-tête, nombre de lignes, lines(start, end)) d'un segment.
+    Seule la position de début des lignes est gardée en mémoire."""
+    offsets = []
+    with open(segment, 'rb') as f:
+        header = json.loads(f.readline())
+        pos = f.tell()
+        for line in f:
+            offsets.append(pos)
+            pos += len(line)
+    
+    def lines(start, end):
+        if start >= len(offsets):
+            return
+        with open(segment, 'rb') as f:
+            f.seek(offsets[start])
+            for _ in range(min(end, len(offsets)) - start):
+                yield f.readline().rstrip(b'\n')
+    
+    return header, len(offsets), lines
+
+def segment_rewrite(segment, header, count, lines, keep):
+    """Réécrit un segment avec ses seules lignes d'index keep (.tmp, fsync, remplacement)"""
+    keep = set(keep)
+    tmp = segment[:-len('.seg')] + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(dict(header, rows=len(keep))).encode('utf-8') + b'\n')
+        for index, line in enumerate(lines(0, count)):
+            if index in keep:
+                f.write(line + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, segment)
+    fsync_dir(os.path.dirname(segment))
+
+def segment_attempts(segment):
+    """Drains déjà passés en erreur sur un segment (champ attempts de l'en-tête)"""
+    try:
+        with open(segment, 'rb') as f:
+            return int(json.loads(f.readline()).get('attempts') or 0)
+    except (OSError, ValueError):
+        return 0
+
+def segment_set_aside(segment):
+    """Déplace un segment qui échoue toujours dans <table>/failed/ (hors drains)"""
+    path = os.path.join(os.path.dirname(segment), 'failed')
+    os.makedirs(path, exist_ok=True)
+    os.replace(segment, os.path.join(path, os.path.basename(segment)))
+    fsync_dir(os.path.dirname(segment))
+
+def list_source(rows):
+    """Équivalent de segment_source pour une liste de lignes en mémoire"""
+    def lines(start, end):
+        for r in rows[start:end]:
+            yield json.dumps(r, ensure_ascii=False).encode('utf-8')
+    return len(rows), lines
+
+def buffered_body(pieces, compress=False):
+    """Regroupe des morceaux de bytes en blocs d'environ UPLOAD_CHUNK octets
+    (corps envoyé en Transfer-Encoding: chunked), compressés en gzip si demandé"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf = bytearray()
+    for piece in pieces:
+        buf += piece
+        if len(buf) >= UPLOAD_CHUNK:
+            out = compressor.compress(bytes(buf)) if compressor else bytes(buf)
+            buf.clear()
+            if out:
+                yield out
+    out = bytes(buf)
+    if compressor:
+        out = compressor.compress(out) + compressor.flush()
+    if out:
+        yield out
+
+def json_array_body(lines, compress=False):
+    """Corps JSON '[l1,l2,...]' produit à la volée à partir de lignes JSON"""
+    def pieces():
+        yield b'['
+        for n, line in enumerate(lines):
+            yield b',' + line if n else line
+        yield b']'
+    return buffered_body(pieces(), compress)
+
+def csv_value(value):
+    """Valeur CSV PostgREST (NULL = valeur nulle)"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def csv_body(columns, lines, compress=False):
+    """Corps CSV (en-tête + une ligne par enregistrement) produit à la volée à partir de lignes JSON"""
+    def pieces():
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(columns)
+        for line in lines:
+            row = json.loads(line)
+            writer.writerow([csv_value(row.get(c)) for c in columns])
+            if out.tell() >= UPLOAD_CHUNK:
+                yield out.getvalue().encode('utf-8')
+                out.seek(0)
+                out.truncate()
+        yield out.getvalue().encode('utf-8')
+    return buffered_body(pieces(), compress)
+
+def request_body(table, lines, compress=False):
+    """(corps, Content-Type) selon le format d'ingestion choisi pour la table"""
+    if table in CSV_TABLES:
+        return csv_body(CSV_COLUMNS[table], lines, compress), 'text/csv'
+    return json_array_body(lines, compress), 'application/json'
+
+def upsert_adaptive(table, count, lines, on_conflict, failed=None, deadline=None):
+    """Upsert de count lignes JSON (lines(start, end)) par lots de taille
+    adaptative: doublée après un succès, divisée par deux après un échec.
+    Les lots sont sérialisés en flux, la mémoire ne dépend pas de leur taille.
+    Aucun lot n'est envoyé après deadline (time.monotonic()).
+    Retourne (lignes écrites, erreurs, backend indisponible); les index des
+    lignes ni écrites ni en quarantaine sont ajoutés à failed."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}"
+    if on_conflict:
+        url += f"?on_conflict={on_conflict}"
+    headers = supabase_headers()
+    headers['Prefer'] = 'resolution=merge-duplicates,return=minimal'
+    if UPLOAD_GZIP:
+        headers['Content-Encoding'] = 'gzip'
+    
+    size = _batch_sizes.get(table, SPOOL_BATCH_START)
+    i = 0
+    written = 0
+    errors = []
+    rejected = []
+    lost = []
+    unavailable = False
+    while i < count:
+        if deadline and time.monotonic() > deadline:
+            break
+        n = min(size, count - i)
+        body, headers['Content-Type'] = request_body(table, lines(i, i + n), UPLOAD_GZIP)
+        status, resp = http_request(url, 'POST', body, dict(headers), 60)
+        if status in [200, 201]:
+            if table in MIRROR_TABLES:
+                mirror_record(table, (json.loads(line) for line in lines(i, i + n)))
+            written += n
+            i += n
+            size = min(size * 2, SPOOL_BATCH_MAX)
+            continue
+        
+        error = f"HTTP {status}: {resp[:300] if resp else 'No response'}"
+        size = max(1, size // 2)
+        if status == 0 or status == 429 or status >= 500:
+            # Supabase lent ou indisponible: on garde le reste pour le prochain drain
+            errors.append(error)
+            unavailable = True
+            break
+        if n == 1:
+            # Ligne refusée isolément: candidate à la quarantaine si l'erreur porte sur son contenu
+            row = json.loads(next(lines(i, i + 1)))
+            if row_level_error(resp):
+                rejected.append((i, row, status, error))
+            else:
+                errors.append(f"{on_conflict}={row.get(on_conflict)}: {error}")
+                lost.append(i)
+            i += 1
+    
+    # Trop de refus d'un coup: la table est en cause, pas le contenu des lignes
+    quarantine = len(rejected) <= QUARANTINE_MAX_ROWS
+    for index, row, status, error in rejected:
+        if quarantine and quarantine_row(table, row, on_conflict, status, error):
+            _quarantined[table] = _quarantined.get(table, 0) + 1
+        else:
+            errors.append(f"{on_conflict}={row.get(on_conflict)}: {error}")
+            lost.append(index)
+    
+    if failed is not None:
+        failed.extend(sorted(lost))
+        failed.extend(range(i, count))
+    _batch_sizes[table] = size
+    return written, errors, unavailable
+
+# ============================================================
+# QUARANTAINE DES LIGNES REFUSÉES
+# ============================================================
+# Une ligne que PostgREST refuse seule (valeur trop longue, date invalide,
+# type incompatible) est enregistrée dans parc_sync_quarantine avec l'erreur
+# et l'enregistrement brut, puis écartée des lots suivants tant que son hash
+# source (row_hash) ne change pas.
+
+def row_level_error(resp):
+    """True si le corps d'erreur PostgREST porte un SQLSTATE de ligne (classes 22/23)"""
+    try:
+        code = json.loads(resp).get('code') or ''
+    except (ValueError, AttributeError):
+        return False
+    return str(code)[:2] in QUARANTINE_SQLSTATE_CLASSES
+
+def row_key(row, on_conflict):
+    """Clé d'une ligne en quarantaine: valeurs des colonnes de on_conflict, sinon son hash"""
+    if not on_conflict:
+        return row.get('row_hash') or row_hash(row)
+    return '|'.join(str(row.get(c)) for c in on_conflict.split(','))
+
+def quarantine_row(table, row, on_conflict, status, error):
+    """Met en quarantaine une ligne refusée (False si l'écriture a échoué)"""
+    return supabase_upsert('parc_sync_quarantine', {
+        'tbl': table,
+        'row_key': row_key(row, on_conflict),
+        'row_hash': row.get('row_hash') or row_hash(row),
+        'http_status': status,
+        'error': safe_str(error, 1000),
+        'record': row,
+        'last_seen': datetime.now().isoformat()
+    }, 'tbl,row_key')
+
+def quarantine_filter(table, rows, on_conflict):
+    """Retire les lignes en quarantaine dont le hash n'a pas changé.
+    Une ligne modifiée depuis sort de quarantaine et est retentée.
+    Retourne (lignes à écrire, nombre de lignes écartées)."""
+    try:
+        _, held = supabase_iter('parc_sync_quarantine', 'row_key,row_hash', f"tbl=eq.{table}", key='row_key')
+        held = {q['row_key']: q['row_hash'] for q in held}
+    except Exception:
+        return rows, 0
+    if not held:
+        return rows, 0
+    
+    kept, released = [], []
+    for r in rows:
+        key = row_key(r, on_conflict)
+        if key in held:
+            if held[key] == (r.get('row_hash') or row_hash(r)):
+                continue
+            released.append(key)
+        kept.append(r)
+    for i in range(0, len(released), IN_FILTER_CHUNK):
+        keys = ','.join(quote(f'"{k}"') for k in released[i:i+IN_FILTER_CHUNK])
+        supabase_delete('parc_sync_quarantine', f"tbl=eq.{table}&row_key=in.({keys})")
+    return kept, len(rows) - len(kept)
+
+def spool_drain(table, budget=None):
+    """Rejoue les segments du spool d'une table dans Supabase"""
+    start = time.monotonic()
+    quarantined = _quarantined.get(table, 0)
+    result = {"segments": 0, "rows": 0, "pending": 0, "retrying": 0, "set_aside": 0, "errors": [], "retry_errors": []}
+    for segment in spool_segments(table):
+        if budget and time.monotonic() - start > budget:
+            break
+        try:
+            header, count, lines = segment_source(segment)
+        except (OSError, ValueError) as e:
+            result["errors"].append(f"{os.path.basename(segment)}: {e}")
+            continue
+        
+        failed = []
+        written, errors, unavailable = upsert_adaptive(table, count, lines, header.get('on_conflict'), failed,
+                                                       start + budget if budget else None)
+        result["rows"] += written
+        # Erreurs d'un segment déjà en échec: signalées à part, elles ne bloquent
+        # pas indéfiniment le succès des syncs qui l'ont suivi
+        attempts = header.get('attempts') or 0
+        result["retry_errors" if attempts else "errors"].extend(errors[:5])
+        if errors and not unavailable:
+            attempts += 1
+        if failed and attempts >= SPOOL_MAX_ATTEMPTS:
+            segment_set_aside(segment)
+            result["set_aside"] += 1
+        elif not failed:
+            os.remove(segment)
+            fsync_dir(os.path.dirname(segment))
+            result["segments"] += 1
+        elif len(failed) < count or attempts != (header.get('attempts') or 0):
+            # Seules les lignes en échec restent à rejouer: les lignes déjà
+            # écrites ne doivent pas écraser plus tard des valeurs plus récentes
+            segment_rewrite(segment, dict(header, attempts=attempts), count, lines, failed)
+        if unavailable:
+            break
+    
+    # En attente: segments pas encore drainés ou en échec une seule fois; après un
+    # nouvel essai manqué ils passent dans retrying et ne bloquent plus le succès
+    attempts = [segment_attempts(segment) for segment in spool_segments(table)]
+    result["pending"] = sum(1 for a in attempts if a < 2)
+    result["retrying"] = len(attempts) - result["pending"]
+    result["quarantined"] = _quarantined.get(table, 0) - quarantined
+    return result
+
+def spool_upsert(table, rows, on_conflict, budget=None):
+    """Écrit des lignes via le spool puis draine la table (hors lignes en quarantaine)
+    pendant au plus budget secondes. Sans disque utilisable, écrit directement
+    (upsert adaptatif)."""
+    rows, skipped = quarantine_filter(table, rows, on_conflict) if rows else (rows, 0)
+    if rows:
+        try:
+            spool_write(table, rows, on_conflict)
+        except OSError as e:
+            quarantined = _quarantined.get(table, 0)
+            written, errors, _ = upsert_adaptive(table, *list_source(rows), on_conflict)
+            return {"segments": 0, "rows": written, "pending": 0, "retrying": 0, "errors": errors + [f"Spool: {e}"],
+                    "quarantined": _quarantined.get(table, 0) - quarantined, "quarantine_skipped": skipped}
+    result = spool_drain(table, budget)
+    result["quarantine_skipped"] = skipped
+    return result
+
+def bench_ingest(table, nb_rows=1000):
+    """Compare l'ingestion JSON et CSV sur les mêmes lignes, relues depuis la table
+    puis réécrites telles quelles (upsert idempotent sur la clé)"""
+    if table not in CSV_COLUMNS:
+        return {"status": "error", "message": f"Table non supportée: {table}", "tables": list(CSV_COLUMNS)}
+    key = 'id_panne' if table == 'parc_pannes' else 'id'
+    columns = CSV_COLUMNS[table] if key in CSV_COLUMNS[table] else [key] + CSV_COLUMNS[table]
+    rows = supabase_get(table, ','.join(columns), f"order={key}.asc", nb_rows)
+    if not rows:
+        return {"status": "error", "message": f"{table} est vide"}
+    count, lines = list_source(rows)
+    
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{table}?on_conflict={key}"
+    results = {}
+    for fmt in ('json', 'csv'):
+        body = b''.join(csv_body(columns, lines(0, count)) if fmt == 'csv' else json_array_body(lines(0, count)))
+        headers = supabase_headers()
+        headers['Prefer'] = 'resolution=merge-duplicates,return=minimal'
+        headers['Content-Type'] = 'text/csv' if fmt == 'csv' else 'application/json'
+        t0 = time.monotonic()
+        status, resp = http_request(url, 'POST', body, headers, 120)
+        results[fmt] = {
+            "http_status": status,
+            "payload_bytes": len(body),
+            "payload_gzip_bytes": len(zlib.compress(body, 6)),
+            "ingest_seconds": round(time.monotonic() - t0, 3),
+            "error": resp[:300] if status not in [200, 201] else None
+        }
+    
+    return {
+        "status": "success",
+        "mode": "bench",
+        "table": table,
+        "rows": count,
+        "columns": columns,
+        "results": results,
+        "csv_size_ratio": round(results['csv']['payload_bytes'] / results['json']['payload_bytes'], 3),
+        "csv_time_ratio": round(results['csv']['ingest_seconds'] / results['json']['ingest_seconds'], 3) if results['json']['ingest_seconds'] else None
+    }
+
+def sync_drain():
+    """Draine les spools de toutes les tables"""
+    tables = sorted(os.listdir(SPOOL_DIR)) if os.path.isdir(SPOOL_DIR) else []
+    results = {t: spool_drain(t) for t in tables}
+    if any(r["rows"] for r in results.values()):
+        refresh_secteurs()
+    return {
+        "status": "success" if all(not r["pending"] for r in results.values()) else "partial",
+        "mode": "drain",
+        "tables": results
     }
-    status, body = http_request(url, 'GET', None, headers, 30)
-    if status == 200:
-        return json.loads(body)
-    return []
 
 # ============================================================
 # STEP 0: Types de planning
@@ -273,9 +1298,7 @@ def sync_type_planning():
     if not items:
         return {"status": "error", "message": "No data in Wtypepla response", "response_size": len(resp)}
     
-    # Supprimer et recréer
-    supabase_delete('parc_type_planning')
-    inserted = 0
+    rows = []
     
     for item in items:
         code = safe_str(item.get('TYPEPLANNING') or item.get('typeplanning'), 50)
@@ -284,13 +1307,17 @@ def sync_type_planning():
         id_type = safe_int(item.get('IDWTYPEPLA') or item.get('idwtypepla'))
         
         if code:
-            if supabase_insert('parc_type_planning', {
+            rows.append({
                 'id_wtypepla': id_type,
                 'code': code,
                 'nb_visites': nb_visites,
                 'libelle': libelle
-            }):
-                inserted += 1
+            })
+    
+    # Remplacement atomique: l'étape 4 ne lit jamais un référentiel partiel
+    inserted, error = replace_table('parc_type_planning', rows)
+    if error:
+        return {"status": "error", "step": 0, "type_planning_found": len(items), "message": error}
     
     return {
         "status": "success",
@@ -311,15 +1338,23 @@ def sync_arrets():
         return {"status": "error", "message": "Auth failed"}
     
     resp = progilift_call("get_AppareilsArret", {}, wsid, 30)
+    if not resp:
+        return {"status": "error", "step": 1, "message": "get_AppareilsArret failed"}
     arrets = parse_items(resp, "tabListeArrets")
     
-    # Supprimer les anciens arrêts
-    supabase_delete('parc_arrets')
-    
-    # Remettre tous les ascenseurs en_arret = FALSE
-    # (on ne peut pas faire un UPDATE global facilement, on le fera dans step 4)
+    return write_arrets(arrets)
+
+def arrets_fingerprint(arrets):
+    """Empreinte de la liste des arrêts Progilift (indépendante de l'ordre)"""
+    items = sorted(json.dumps(a, sort_keys=True) for a in arrets)
+    return hashlib.sha1('\n'.join(items).encode('utf-8')).hexdigest()
+
+def write_arrets(arrets):
+    """Remplace le contenu de parc_arrets par la liste des arrêts (en une transaction)"""
+    # Les flags en_arret de parc_ascenseurs sont alignés par sync_en_arret_flags
+    # (step 4 et cron)
     
-    inserted = 0
+    rows = []
     wsoucont_ids = []
     
     for a in arrets:
@@ -328,8 +1363,7 @@ def sync_arrets():
             continue
             
         wsoucont_ids.append(id_wsoucont)
-        
-        if supabase_insert('parc_arrets', {
+        rows.append({
             'id_wsoucont': id_wsoucont,
             'id_panne': safe_int(a.get('nClepanne')),
             'code_appareil': safe_str(a.get('sAscenseur'), 50),
@@ -341,8 +1375,11 @@ def sync_arrets():
             'motif': safe_str(a.get('sMotifAppel'), 500),
             'demandeur': safe_str(a.get('sDemandeur'), 100),
             'synced_at': datetime.now().isoformat()
-        }):
-            inserted += 1
+        })
+    
+    inserted, error = replace_table('parc_arrets', rows)
+    if error:
+        return {"status": "error", "step": 1, "arrets_found": len(arrets), "message": error}
     
     return {
         "status": "success",
@@ -357,8 +1394,100 @@ def sync_arrets():
 # STEP 2: Équipements (Wsoucont)
 # ============================================================
 
-def sync_equipements(sector_idx):
-    """Synchronise les équipements pour un secteur dans parc_ascenseurs"""
+def fold_text(value):
+    """Texte en minuscules, sans accents ni ponctuation (même normalisation que api/search.py)"""
+    text = unicodedata.normalize('NFKD', str(value)).casefold().replace('œ', 'oe').replace('æ', 'ae')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+def planning_mask(e):
+    """Masque 12 bits des mois de visite prévus (bit 0 = janvier)"""
+    return sum(1 << i for i, month in enumerate(PLANNING_MONTHS) if safe_int(e.get(month)) == 1)
+
+def refresh_planning(secteurs):
+    """Recalcule les tournées (parc_planning_visites) des secteurs donnés"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_planning_refresh"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, body = http_request(url, 'POST', {'p_secteurs': sorted(int(s) for s in secteurs)}, headers, 60)
+    if status != 200:
+        return None
+    try:
+        return int(json.loads(body))
+    except (ValueError, TypeError):
+        return None
+
+def fetch_equipements(sector, wsid, since_date=None):
+    """Éléments Wsoucont d'un secteur (None si l'appel Progilift échoue)"""
+    resp = progilift_call("get_Synchro_Wsoucont", {
+        "dhDerniereMajFichier": since_date or "2000-01-01T00:00:00",
+        "sListeSecteursTechnicien": sector
+    }, wsid, 120)
+    if not resp:
+        return None
+    return parse_items(resp, "tabListeWsoucont")
+
+def equipement_row(e):
+    """Ligne parc_ascenseurs d'un élément Wsoucont (None sans IDWSOUCONT)"""
+    id_wsoucont = safe_int(e.get('IDWSOUCONT'))
+    if not id_wsoucont:
+        return None
+    
+    data = {
+        'id_wsoucont': id_wsoucont,
+        'id_wcontrat': safe_int(e.get('IDWCONTRAT')),
+        'secteur': safe_int(e.get('SECTEUR')),
+        'code_appareil': safe_str(e.get('ASCENSEUR'), 50),
+        'indice': safe_int(e.get('INDICE')),
+        'adresse': safe_str(e.get('DES2'), 200),
+        'ville': safe_str(e.get('DES3'), 200),
+        'code_postal': safe_str(e.get('DES3', '')[:5] if e.get('DES3') else None, 10),
+        'localisation': safe_str(e.get('LOCALISATION'), 200),
+        'nom_convivial': safe_str(e.get('NOM_CONVIVIAL'), 100),
+        'client_ref': safe_str(e.get('REFCLI'), 100),
+        'client_ref2': safe_str(e.get('REFCLI2'), 100),
+        'client_ref3': safe_str(e.get('REFCLI3'), 100),
+        'num_appareil_client': safe_str(e.get('NUMAPPCLI'), 50),
+        'genre': safe_int(e.get('GENRE')),
+        'type_appareil': safe_str(e.get('TYPE'), 50),
+        'marque': safe_str(e.get('DIV1'), 100),
+        'modele': safe_str(e.get('DIV2'), 100),
+        'num_serie': safe_str(e.get('DIV7'), 100),
+        'tel_cabine': safe_str(e.get('TELCABINE'), 50),
+        'type_depannage': safe_int(e.get('IDTYPE_DEPANNAGE')),
+        'securite': safe_int(e.get('SECURITE')),
+        'securite2': safe_int(e.get('SECURITE2')),
+        'type_planning': safe_str(e.get('TYPEPLANNING'), 50),
+        # Ordre de tournée
+        'wordre': safe_int(e.get('WORDRE')),
+        'ordre2': safe_int(e.get('ORDRE2')),
+        # Planning mensuel (1 = mois prévu)
+        'planning_jan': safe_int(e.get('JAN')) == 1,
+        'planning_fev': safe_int(e.get('FEV')) == 1,
+        'planning_mar': safe_int(e.get('MAR')) == 1,
+        'planning_avr': safe_int(e.get('AVR')) == 1,
+        'planning_mai': safe_int(e.get('MAI')) == 1,
+        'planning_jun': safe_int(e.get('JUI')) == 1,
+        'planning_jul': safe_int(e.get('JUL')) == 1,
+        'planning_aou': safe_int(e.get('AOU')) == 1,
+        'planning_sep': safe_int(e.get('SEP')) == 1,
+        'planning_oct': safe_int(e.get('OCT')) == 1,
+        'planning_nov': safe_int(e.get('NOV')) == 1,
+        'planning_dec': safe_int(e.get('DEC')) == 1,
+        'planning_mask': planning_mask(e),
+        'data_wsoucont': e,
+        'synced_at': datetime.now().isoformat(),
+        'updated_at': datetime.now().isoformat()
+    }
+    data['search_text'] = fold_text(' '.join(str(data[f]) for f in SEARCH_FIELDS if data.get(f)))
+    return data
+
+def sync_equipements(sector_idx, since_date=None):
+    """Synchronise les équipements pour un secteur dans parc_ascenseurs
+    (since_date: seulement les équipements modifiés depuis cette date)"""
     if sector_idx >= len(SECTORS):
         return {"status": "done", "message": "All sectors completed", "next": "?step=2b&sector=0"}
     
@@ -367,85 +1496,77 @@ def sync_equipements(sector_idx):
     if not wsid:
         return {"status": "error", "message": "Auth failed"}
     
-    resp = progilift_call("get_Synchro_Wsoucont", {
-        "dhDerniereMajFichier": "2000-01-01T00:00:00",
-        "sListeSecteursTechnicien": sector
-    }, wsid, 120)
+    items = fetch_equipements(sector, wsid, since_date)
+    if items is None:
+        refresh_secteurs([sector], error="get_Synchro_Wsoucont failed")
+        return {"status": "error", "step": 2, "sector": sector, "message": "get_Synchro_Wsoucont failed"}
     
-    items = parse_items(resp, "tabListeWsoucont")
     upserted = 0
+    rows = [r for r in map(equipement_row, items) if r]
     
-    for e in items:
-        id_wsoucont = safe_int(e.get('IDWSOUCONT'))
-        if not id_wsoucont:
-            continue
-        
-        data = {
-            'id_wsoucont': id_wsoucont,
-            'id_wcontrat': safe_int(e.get('IDWCONTRAT')),
-            'secteur': safe_int(e.get('SECTEUR')),
-            'code_appareil': safe_str(e.get('ASCENSEUR'), 50),
-            'indice': safe_int(e.get('INDICE')),
-            'adresse': safe_str(e.get('DES2'), 200),
-            'ville': safe_str(e.get('DES3'), 200),
-            'code_postal': safe_str(e.get('DES3', '')[:5] if e.get('DES3') else None, 10),
-            'localisation': safe_str(e.get('LOCALISATION'), 200),
-            'nom_convivial': safe_str(e.get('NOM_CONVIVIAL'), 100),
-            'client_ref': safe_str(e.get('REFCLI'), 100),
-            'client_ref2': safe_str(e.get('REFCLI2'), 100),
-            'client_ref3': safe_str(e.get('REFCLI3'), 100),
-            'num_appareil_client': safe_str(e.get('NUMAPPCLI'), 50),
-            'genre': safe_int(e.get('GENRE')),
-            'type_appareil': safe_str(e.get('TYPE'), 50),
-            'marque': safe_str(e.get('DIV1'), 100),
-            'modele': safe_str(e.get('DIV2'), 100),
-            'num_serie': safe_str(e.get('DIV7'), 100),
-            'tel_cabine': safe_str(e.get('TELCABINE'), 50),
-            'type_depannage': safe_int(e.get('IDTYPE_DEPANNAGE')),
-            'securite': safe_int(e.get('SECURITE')),
-            'securite2': safe_int(e.get('SECURITE2')),
-            'type_planning': safe_str(e.get('TYPEPLANNING'), 50),
-            # Ordre de tournée
-            'wordre': safe_int(e.get('WORDRE')),
-            'ordre2': safe_int(e.get('ORDRE2')),
-            # Planning mensuel (1 = mois prévu)
-            'planning_jan': safe_int(e.get('JAN')) == 1,
-            'planning_fev': safe_int(e.get('FEV')) == 1,
-            'planning_mar': safe_int(e.get('MAR')) == 1,
-            'planning_avr': safe_int(e.get('AVR')) == 1,
-            'planning_mai': safe_int(e.get('MAI')) == 1,
-            'planning_jun': safe_int(e.get('JUI')) == 1,
-            'planning_jul': safe_int(e.get('JUL')) == 1,
-            'planning_aou': safe_int(e.get('AOU')) == 1,
-            'planning_sep': safe_int(e.get('SEP')) == 1,
-            'planning_oct': safe_int(e.get('OCT')) == 1,
-            'planning_nov': safe_int(e.get('NOV')) == 1,
-            'planning_dec': safe_int(e.get('DEC')) == 1,
-            'data_wsoucont': e,
-            'synced_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
-        
-        if supabase_upsert('parc_ascenseurs', data, 'id_wsoucont'):
-            upserted += 1
+    # Avec le miroir local, seules les lignes modifiées sont renvoyées
+    changed = mirror_changed('parc_ascenseurs', rows)
+    drained = spool_upsert('parc_ascenseurs', changed, 'id_wsoucont')
+    upserted = drained["rows"]
+    
+    # Cumuls du secteur (nombre d'appareils, arrêts, pannes) et dernière sync
+    if drained["pending"]:
+        refresh_secteurs([sector], error='; '.join(drained["errors"][:3]) or "Écriture incomplète (spool)")
+    else:
+        refresh_secteurs([sector], synced_at=datetime.now())
+    
+    # Tournées mensuelles des secteurs modifiés (ordre de visite, masque de planning)
+    planning = None
+    if changed and not drained["pending"]:
+        planning = refresh_planning({sector} | {r['secteur'] for r in changed if r.get('secteur')})
     
     next_sector = sector_idx + 1
-    return {
-        "status": "success",
+    result = {
+        "status": "success" if not drained["pending"] else "partial",
         "step": 2,
         "sector": sector,
         "sector_idx": sector_idx,
         "equipements_found": len(items),
+        "unchanged": len(rows) - len(changed),
         "upserted": upserted,
+        "spool_pending": drained["pending"],
+        "quarantined": drained["quarantined"],
+        "quarantine_skipped": drained["quarantine_skipped"],
+        "planning_visites": planning,
         "next": f"?step=2&sector={next_sector}" if next_sector < len(SECTORS) else "?step=2b&sector=0"
     }
+    if drained["errors"]:
+        result["errors"] = drained["errors"][:5]
+    return result
 
 # ============================================================
 # STEP 2b: Passages et données complémentaires (Wsoucont2)
 # ============================================================
 
+def passage_date(val):
+    """Date de passage Progilift (entier YYYYMMDD) -> 'YYYY-MM-DD' (None si invalide)"""
+    # strptime accepte des mois/jours sur un chiffre ('2025310' -> 2025-03-10)
+    if not val or len(str(val)) != 8:
+        return None
+    try:
+        return datetime.strptime(str(val), '%Y%m%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+def passage_rows(id_wsoucont, secteur, dates):
+    """Lignes parc_passages d'un appareil: une par date de passage distincte"""
+    now = datetime.now().isoformat()
+    return [{
+        'id_wsoucont': id_wsoucont,
+        'secteur': secteur,
+        'date_passage': d,
+        'source': 'progilift',
+        'synced_at': now
+    } for d in sorted({d for d in dates if d})]
+
 def sync_passages(sector_idx):
-    """Synchronise les passages (Wsoucont2) pour un secteur"""
+    """Synchronise les passages (Wsoucont2) pour un secteur: colonnes passage_1..5
+    de parc_ascenseurs et historique parc_passages (une ligne par passage)"""
     if sector_idx >= len(SECTORS):
         return {"status": "done", "message": "All sectors completed", "next": "?step=3&period=0"}
     
@@ -461,66 +1582,91 @@ def sync_passages(sector_idx):
     
     items = parse_items(resp, "tabListeWsoucont2")
     updated = 0
+    passages = []
     
     for e in items:
         id_wsoucont = safe_int(e.get('IDWSOUCONT'))
         if not id_wsoucont:
             continue
         
-        # Convertir les dates de passage (format YYYYMMDD en entier)
-        def convert_passage_date(val):
-            if not val:
-                return None
-            try:
-                s = str(val)
-                if len(s) == 8:
-                    return f"{s[:4]}-{s[4:6]}-{s[6:8]}"
-                return None
-            except:
-                return None
-        
+        dates = [passage_date(e.get(f'DATEPASS{n}')) for n in range(1, 6)]
         data = {
-            'passage_1': convert_passage_date(e.get('DATEPASS1')),
-            'passage_2': convert_passage_date(e.get('DATEPASS2')),
-            'passage_3': convert_passage_date(e.get('DATEPASS3')),
-            'passage_4': convert_passage_date(e.get('DATEPASS4')),
-            'passage_5': convert_passage_date(e.get('DATEPASS5')),
-            'dernier_passage': convert_passage_date(e.get('DATEPASS1')),  # Le plus récent
+            'passage_1': dates[0],
+            'passage_2': dates[1],
+            'passage_3': dates[2],
+            'passage_4': dates[3],
+            'passage_5': dates[4],
+            'dernier_passage': dates[0],  # Le plus récent
             'data_wsoucont2': e,
             'updated_at': datetime.now().isoformat()
         }
         
         if supabase_update('parc_ascenseurs', 'id_wsoucont', id_wsoucont, data):
             updated += 1
+        # Les passages sortis de la fenêtre Progilift restent dans l'historique
+        passages.extend(passage_rows(id_wsoucont, safe_int(e.get('SECTEUR')) or int(sector), dates))
+    
+    drained = spool_upsert('parc_passages', passages, 'source,id_wsoucont,date_passage')
     
     next_sector = sector_idx + 1
-    return {
-        "status": "success",
+    result = {
+        "status": "success" if not drained["pending"] else "partial",
         "step": "2b",
         "sector": sector,
         "sector_idx": sector_idx,
         "passages_found": len(items),
         "updated": updated,
+        "passages_upserted": drained["rows"],
+        "spool_pending": drained["pending"],
+        "quarantined": drained["quarantined"],
+        "quarantine_skipped": drained["quarantine_skipped"],
         "next": f"?step=2b&sector={next_sector}" if next_sector < len(SECTORS) else "?step=3&period=0"
     }
+    if drained["errors"]:
+        result["errors"] = drained["errors"][:5]
+    return result
 
 # ============================================================
 # STEP 3: Pannes
 # ============================================================
 
-def sync_pannes(period_idx):
-    """Synchronise les pannes pour une période dans parc_pannes"""
-    if period_idx >= len(PERIODS):
+def dedupe_by_key(rows, key):
+    """Garde une seule ligne par clé: la dernière occurrence gagne (Wpanne ne
+    fournit pas d'horodatage de mise à jour, la réponse la plus tardive fait foi).
+    La ligne retenue garde la place de la première occurrence.
+    PostgREST rejette un upsert dont le lot contient deux fois la même clé.
+    Retourne (lignes dédoublonnées, nombre de doublons écartés)."""
+    seen = {}
+    result = []
+    for row in rows:
+        k = row[key]
+        if k in seen:
+            result[seen[k]] = row
+            continue
+        seen[k] = len(result)
+        result.append(row)
+    return result, len(rows) - len(result)
+
+
+def sync_pannes(period_idx, since_date=None, budget=None):
+    """Synchronise les pannes pour une période dans parc_pannes
+    (since_date remplace PERIODS[period_idx], utilisé par le cron).
+    Avec budget (secondes), l'appel Progilift et l'écriture s'y limitent:
+    les lignes non écrites restent dans le spool (status partial)."""
+    clock = time.monotonic()
+    if since_date is None and period_idx >= len(PERIODS):
         return {"status": "done", "message": "All periods completed", "next": "?step=4"}
     
-    since_date = PERIODS[period_idx]
+    since_date = since_date or PERIODS[period_idx]
     wsid = get_auth()
     if not wsid:
         return {"status": "error", "message": "Auth failed"}
     
     resp = progilift_call("get_Synchro_Wpanne", {
         "dhDerniereMajFichier": since_date
-    }, wsid, 180)
+    }, wsid, min(180, budget) if budget else 180)
+    if not resp:
+        return {"status": "error", "step": 3, "period": since_date, "message": "get_Synchro_Wpanne failed"}
     
     items = parse_items(resp, "tabListeWpanne")
     upserted = 0
@@ -567,29 +1713,38 @@ def sync_pannes(period_idx):
         }
         batch.append(data)
     
+    # Une seule version par id_panne sur toute l'exécution
+    batch, duplicates = dedupe_by_key(batch, 'id_panne')
+    
     # Debug: premier batch item
     first_batch = batch[0] if batch else None
     
-    # Upsert par batch de 100
-    batch_size = 100
-    for i in range(0, len(batch), batch_size):
-        chunk = batch[i:i+batch_size]
-        success, error_msg = supabase_upsert_with_error('parc_pannes', chunk, 'id_panne')
-        if success:
-            upserted += len(chunk)
-        else:
-            errors.append(f"Batch {i//batch_size}: {error_msg}")
+    # Avec le miroir local, seules les pannes modifiées sont renvoyées
+    changed = mirror_changed('parc_pannes', batch)
+    
+    # Écriture via le spool (lots adaptatifs, rejoués si Supabase est indisponible)
+    drained = spool_upsert('parc_pannes', changed, 'id_panne',
+                           max(1, budget - (time.monotonic() - clock)) if budget else None)
+    upserted = drained["rows"]
+    errors.extend(drained["errors"])
+    if upserted:
+        refresh_secteurs()
     
     next_period = period_idx + 1
     result = {
-        "status": "success" if not errors else "partial",
+        "status": "success" if not errors and not drained["pending"] else "partial",
         "step": 3,
         "period": since_date,
         "period_idx": period_idx,
         "pannes_found": len(items),
         "valid_batch": len(batch),
+        "unchanged": len(batch) - len(changed),
+        "duplicates": duplicates,
         "skipped": skipped,
         "upserted": upserted,
+        "spool_pending": drained["pending"],
+        "quarantined": drained["quarantined"],
+        "quarantine_skipped": drained["quarantine_skipped"],
         "debug_keys": first_keys,
         "debug_first_id": first_item.get('P0CLEUNIK') if first_item else None,
         "next": f"?step=3&period={next_period}" if next_period < len(PERIODS) else "?step=4"
@@ -614,8 +1769,8 @@ def update_nb_visites():
     
     type_map = {tp['code']: tp['nb_visites'] for tp in type_planning if tp.get('code')}
     
-    # Récupérer les équipements avec typeplanning
-    equipements = supabase_get('parc_ascenseurs', 'id_wsoucont,type_planning', 'type_planning=not.is.null')
+    # Récupérer les équipements avec typeplanning (toutes les pages, lues au fil de l'eau)
+    nb_equipements, equipements = supabase_iter('parc_ascenseurs', 'id_wsoucont,type_planning', 'type_planning=not.is.null')
     
     updated = 0
     for eq in equipements:
@@ -625,24 +1780,20 @@ def update_nb_visites():
             if supabase_update('parc_ascenseurs', 'id_wsoucont', eq['id_wsoucont'], {'nb_visites_an': nb_visites}):
                 updated += 1
     
-    # Mettre à jour les flags en_arret
-    # D'abord tout à FALSE
-    # Puis TRUE pour ceux qui sont dans parc_arrets
+    # Mettre à jour les flags en_arret depuis parc_arrets
     arrets = supabase_get('parc_arrets', 'id_wsoucont')
     arret_ids = [a['id_wsoucont'] for a in arrets if a.get('id_wsoucont')]
+    flags = sync_en_arret_flags(arret_ids)
     
-    # Reset all to FALSE (on fait un update par batch)
-    all_equip = supabase_get('parc_ascenseurs', 'id_wsoucont')
-    for eq in all_equip:
-        en_arret = eq['id_wsoucont'] in arret_ids
-        supabase_update('parc_ascenseurs', 'id_wsoucont', eq['id_wsoucont'], {'en_arret': en_arret})
+    # Seul le total exact est utile: une ligne lue
+    nb_total, _ = supabase_iter('parc_ascenseurs', 'id_wsoucont', page_size=1)
     
     # Log de synchronisation
     supabase_insert('parc_sync_logs', {
         'sync_date': datetime.now().isoformat(),
         'sync_type': 'full',
         'status': 'success',
-        'equipements_count': len(all_equip),
+        'equipements_count': nb_total,
         'pannes_count': 0,  # Non compté ici
         'arrets_count': len(arret_ids),
         'duration_seconds': 0  # Non mesuré ici
@@ -652,9 +1803,10 @@ def update_nb_visites():
         "status": "success",
         "step": 4,
         "type_planning_codes": len(type_map),
-        "equipements_with_planning": len(equipements),
+        "equipements_with_planning": nb_equipements,
         "updated": updated,
         "arrets_flagged": len(arret_ids),
+        "en_arret": flags,
         "message": "nb_visites_an and en_arret flags updated!"
     }
 
@@ -662,6 +1814,40 @@ def update_nb_visites():
 # CRON: Sync rapide
 # ============================================================
 
+def refresh_pannes_stats_windows():
+    """Recalcule les compteurs 30 / 90 jours de parc_pannes_stats qui ont glissé
+    depuis leur dernier calcul (une fois par jour, le reste est maintenu par trigger).
+    Retourne le nombre d'appareils recalculés, None si l'appel a échoué."""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_pannes_stats_refresh_windows"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, body = http_request(url, 'POST', {}, headers, 60)
+    if status != 200:
+        return None
+    try:
+        return int(json.loads(body))
+    except (ValueError, TypeError):
+        return None
+
+def sync_pannes_delta(start, budget=None):
+    """Pannes modifiées depuis le filigrane 'pannes', qui avance en cas de succès.
+    Avec budget, le recalcul des fenêtres 30/90 jours est reporté s'il est épuisé."""
+    since, mode = pannes_since(start)
+    result = sync_pannes(0, since.strftime("%Y-%m-%dT%H:%M:%S"), budget)
+    ok = result.get('status') == 'success'
+    set_watermark('pannes', start if ok else None, 'success' if ok else 'error')
+    result['mode'] = mode
+    if budget and (datetime.now() - start).total_seconds() > budget:
+        result['stats_windows_refreshed'] = None
+        return result
+    result['stats_windows_refreshed'] = refresh_pannes_stats_windows()
+    if result['stats_windows_refreshed']:
+        refresh_secteurs()
+    return result
+
 def sync_cron():
     """Sync rapide pour cron job (arrêts + pannes récentes)"""
     start = datetime.now()
@@ -671,17 +1857,17 @@ def sync_cron():
     r1 = sync_arrets()
     results['arrets'] = r1.get('inserted', 0)
     
-    # Pannes récentes (première période seulement)
-    r2 = sync_pannes(0)
+    # Pannes modifiées depuis la dernière sync réussie
+    r2 = sync_pannes_delta(start)
     results['pannes'] = r2.get('upserted', 0)
+    results['pannes_since'] = r2.get('period')
+    results['pannes_mode'] = r2.get('mode')
+    pannes_ok = r2.get('status') == 'success'
     
-    # Mettre à jour les flags en_arret
-    arrets = supabase_get('parc_arrets', 'id_wsoucont')
-    arret_ids = [a['id_wsoucont'] for a in arrets if a.get('id_wsoucont')]
-    
-    # On ne met à jour que les flags des ascenseurs concernés
-    for id_wsoucont in arret_ids:
-        supabase_update('parc_ascenseurs', 'id_wsoucont', id_wsoucont, {'en_arret': True})
+    # Mettre à jour les flags en_arret (ajouts et retraits), seulement si
+    # la liste des arrêts a bien été récupérée
+    if r1.get('status') == 'success':
+        results['en_arret'] = sync_en_arret_flags(r1.get('wsoucont_ids', []))
     
     duration = (datetime.now() - start).total_seconds()
     
@@ -689,7 +1875,7 @@ def sync_cron():
     supabase_insert('parc_sync_logs', {
         'sync_date': datetime.now().isoformat(),
         'sync_type': 'cron',
-        'status': 'success',
+        'status': 'success' if pannes_ok else 'partial',
         'equipements_count': 0,
         'pannes_count': results['pannes'],
         'arrets_count': results['arrets'],
@@ -697,13 +1883,709 @@ def sync_cron():
     })
     
     return {
-        "status": "success",
+        "status": "success" if pannes_ok else "partial",
         "mode": "cron",
         "results": results,
         "duration": round(duration, 2),
         "timestamp": datetime.now().isoformat()
     }
 
+# ============================================================
+# SCHEDULER PAR NIVEAUX
+# ============================================================
+
+def tier_stops(start, budget):
+    """Arrêts: réécrit parc_arrets et les flags seulement si la liste a changé"""
+    wsid = get_auth()
+    if not wsid:
+        return {"status": "error", "message": "Auth failed"}
+    
+    resp = progilift_call("get_AppareilsArret", {}, wsid, budget)
+    if not resp:
+        return {"status": "error", "message": "get_AppareilsArret failed"}
+    arrets = parse_items(resp, "tabListeArrets")
+    
+    fingerprint = arrets_fingerprint(arrets)
+    if get_sync_state('arrets').get('fingerprint') == fingerprint:
+        save_sync_state('arrets', last_run=start)
+        return {"status": "success", "changed": False, "arrets_found": len(arrets)}
+    
+    result = write_arrets(arrets)
+    if result.get('status') != 'success':
+        # parc_arrets inchangée: empreinte non enregistrée, on réessaie au prochain passage
+        save_sync_state('arrets', last_run=start, status='error')
+        return {"status": "error", "changed": True, "arrets_found": len(arrets), "message": result.get('message')}
+    flags = sync_en_arret_flags(result['wsoucont_ids'])
+    ok = flags['ok'] and result['inserted'] == len(result['wsoucont_ids'])
+    # Empreinte enregistrée seulement si tout est écrit, sinon on réessaie au prochain passage
+    save_sync_state('arrets', last_run=start, watermark=start, status='success' if ok else 'error',
+                    fingerprint=fingerprint if ok else None)
+    return {
+        "status": "success" if ok else "partial",
+        "changed": True,
+        "arrets_found": len(arrets),
+        "inserted": result['inserted'],
+        "en_arret": flags
+    }
+
+def tier_pannes(start, budget):
+    """Pannes modifiées depuis la dernière sync réussie, dans le budget du niveau"""
+    result = sync_pannes_delta(start, budget)
+    save_sync_state('pannes', last_run=start)
+    return {k: result.get(k) for k in ('status', 'mode', 'period', 'pannes_found', 'upserted', 'errors', 'message', 'stats_windows_refreshed') if k in result}
+
+def sector_states():
+    """État de sync des équipements par secteur (parc_sync_secteurs), indexé par secteur"""
+    rows = supabase_get('parc_sync_secteurs', 'secteur,watermark,change_rate,failures,next_attempt_at')
+    return {str(r['secteur']): r for r in rows}
+
+def plan_sectors(states, now, tokens, fallback=None):
+    """Secteurs à synchroniser, dans l'ordre: d'abord ceux qui dépassent
+    SECTOR_MAX_STALENESS_HOURS (même sans jeton), puis, tant qu'il reste des
+    jetons, les secteurs en échec dont le délai de nouvel essai est écoulé et
+    les plus actifs. Actif = changements attendus depuis la dernière sync
+    (taux observé x ancienneté) >= CHANGE_MIN_EXPECTED."""
+    overdue, retry, hot = [], [], []
+    for idx, sector in enumerate(SECTORS):
+        state = states.get(sector, {})
+        failures = int(state.get('failures') or 0)
+        retry_at = parse_ts(state.get('next_attempt_at'))
+        if retry_at and retry_at > now:
+            continue
+        since = parse_ts(state.get('watermark')) or fallback
+        age_hours = (now - since).total_seconds() / 3600 if since else None
+        rate = float(state['change_rate']) if state.get('change_rate') is not None else None
+        expected = (rate or 0) * (age_hours or 0) / 24
+        entry = {"sector_idx": idx, "sector": sector, "since": since, "rate": rate,
+                 "age_hours": round(age_hours, 1) if age_hours is not None else None,
+                 "expected": round(expected, 1), "failures": failures}
+        if failures:
+            # Son filigrane n'avance pas: il resterait « en retard » et passerait hors budget à chaque appel
+            retry.append(dict(entry, reason='retry'))
+        elif age_hours is None or age_hours >= SECTOR_MAX_STALENESS_HOURS:
+            overdue.append(dict(entry, reason='stale'))
+        elif age_hours * 60 >= SECTOR_MIN_INTERVAL_MINUTES and expected >= CHANGE_MIN_EXPECTED:
+            hot.append(dict(entry, reason='hot'))
+    
+    overdue.sort(key=lambda e: -(e['age_hours'] if e['age_hours'] is not None else float('inf')))
+    retry.sort(key=lambda e: e['failures'])
+    hot.sort(key=lambda e: -e['expected'])
+    return overdue + (retry + hot)[:max(0, int(tokens) - len(overdue))]
+
+def tier_equipements(start, budget):
+    """Équipements modifiés, secteur par secteur selon leur taux de changement.
+    Les secteurs actifs passent souvent, les secteurs calmes seulement quand ils
+    atteignent SECTOR_MAX_STALENESS_HOURS, dans un budget journalier d'appels
+    Progilift (seau de jetons rechargé de EQUIPEMENTS_DAILY_CALLS par jour)."""
+    state = get_sync_state('equipements')
+    # Le budget couvre au moins un passage de chaque secteur par période de fraîcheur
+    daily_calls = max(EQUIPEMENTS_DAILY_CALLS, math.ceil(len(SECTORS) * 24 / SECTOR_MAX_STALENESS_HOURS))
+    tokens_at = parse_ts(state.get('tokens_at'))
+    tokens = float(state['tokens']) if state.get('tokens') is not None else len(SECTORS)
+    if tokens_at:
+        tokens += daily_calls * (start - tokens_at).total_seconds() / 86400
+    tokens = min(tokens, len(SECTORS))
+    
+    # Secteurs jamais suivis individuellement: filigrane de l'ancienne passe complète
+    plan = plan_sectors(sector_states(), start, tokens, parse_ts(state.get('watermark')))
+    
+    done = []
+    errors = []
+    for entry in plan:
+        if (datetime.now() - start).total_seconds() > budget:
+            break
+        sector = entry['sector']
+        since = entry['since']
+        since_date = (since - timedelta(minutes=PANNES_OVERLAP_MINUTES)).strftime("%Y-%m-%dT%H:%M:%S") if since else None
+        synced_from = datetime.now()
+        r = sync_equipements(entry['sector_idx'], since_date)
+        tokens -= 1
+        
+        # Échec ou partiel (filigrane inchangé): nouvel essai différé, délai doublé à chaque fois
+        data = {'secteur': int(sector), 'failures': 0, 'next_attempt_at': None, 'updated_at': datetime.now().isoformat()}
+        if r.get('status') != 'success':
+            data['failures'] = entry['failures'] + 1
+            delay = min(SECTOR_RETRY_MINUTES * 2 ** entry['failures'], SECTOR_MAX_STALENESS_HOURS * 60)
+            data['next_attempt_at'] = (datetime.now() + timedelta(minutes=delay)).isoformat()
+        if r.get('status') not in ('success', 'partial'):
+            errors.append(f"Secteur {sector}: {r.get('message')}")
+            supabase_upsert('parc_sync_secteurs', data, 'secteur')
+            continue
+        
+        # Lignes dont le hash a changé (avec le miroir) ou modifiées côté Progilift depuis le filigrane
+        changed = r['equipements_found'] - r['unchanged']
+        data['last_changed'] = changed
+        if r.get('status') == 'success':
+            data['watermark'] = synced_from.isoformat()
+        if since_date and entry['age_hours']:
+            observed = changed * 24 / max(entry['age_hours'], 1)
+            rate = entry.get('rate')
+            data['change_rate'] = round(observed if rate is None else CHANGE_RATE_ALPHA * observed + (1 - CHANGE_RATE_ALPHA) * rate, 3)
+        supabase_upsert('parc_sync_secteurs', data, 'secteur')
+        done.append({"sector": sector, "reason": entry['reason'], "age_hours": entry['age_hours'],
+                     "expected": entry['expected'], "found": r['equipements_found'], "changed": changed,
+                     "change_rate": data.get('change_rate'), "failures": data['failures']})
+    
+    # Dette bornée: des secteurs en échec répété ne bloquent pas les autres indéfiniment
+    tokens = max(tokens, -len(SECTORS))
+    save_sync_state('equipements', tokens=round(tokens, 3), tokens_at=start, last_run=start,
+                    status='error' if errors else 'success')
+    
+    result = {
+        "status": "partial" if errors else "running" if len(done) < len(plan) else "success",
+        "daily_calls": daily_calls,
+        "tokens": round(tokens, 2),
+        "planned": len(plan),
+        "sectors": done
+    }
+    if errors:
+        result["errors"] = errors
+    return result
+
+TIER_FUNCTIONS = {
+    'stops': tier_stops,
+    'pannes': tier_pannes,
+    'equipements': tier_equipements
+}
+
+def run_tier(tier):
+    """Exécute un niveau sous son propre verrou et dans son budget de temps"""
+    config = TIERS[tier]
+    start = datetime.now()
+    holder = acquire_lock(f"tier:{tier}", config['budget'] + 60)
+    if not holder:
+        return {"status": "skipped", "tier": tier, "message": "Tier already running"}
+    try:
+        result = run_locked(TIER_LOCKS.get(tier), 'scheduler', lambda: TIER_FUNCTIONS[tier](start, config['budget']))
+    finally:
+        release_lock(f"tier:{tier}", holder)
+    result['tier'] = tier
+    result['duration'] = round((datetime.now() - start).total_seconds(), 2)
+    return result
+
+def tier_lateness(tier, now):
+    """Retard d'un niveau en nombre d'intervalles (None s'il n'est pas dû)"""
+    scope = 'arrets' if tier == 'stops' else tier
+    last_run = parse_ts(get_sync_state(scope).get('last_run'))
+    if last_run is None:
+        return float('inf')
+    elapsed = (now - last_run).total_seconds() / 60
+    return elapsed / TIERS[tier]['interval'] if elapsed >= TIERS[tier]['interval'] else None
+
+def sync_scheduler():
+    """Lance un seul niveau par appel: le plus en retard parmi ceux arrivés à
+    échéance (à égalité, le plus rapide), pour rester dans la durée maximale
+    d'une invocation. Un niveau déjà en cours ailleurs cède la place au suivant."""
+    now = datetime.now()
+    lateness = {tier: tier_lateness(tier, now) for tier in TIERS}
+    due = sorted((t for t in TIERS if lateness[t] is not None), key=lambda t: -lateness[t])
+    results = {}
+    for tier in due:
+        results[tier] = run_tier(tier)
+        if results[tier].get('status') != 'skipped':
+            break
+    return {
+        "status": "success",
+        "mode": "scheduler",
+        "tiers": results,
+        "timestamp": datetime.now().isoformat()
+    }
+
+# ============================================================
+# RÉCONCILIATION (ANTI-ENTROPIE)
+# ============================================================
+# Empreinte par secteur (nombre d'appareils + somme des row_hash, même calcul
+# que parc_mirror_checksum) des deux côtés: Progilift (lignes recalculées) et
+# parc_ascenseurs (RPC parc_secteur_fingerprints). Seuls les secteurs dont les
+# empreintes diffèrent sont comparés ligne à ligne et réécrits.
+
+def fingerprint(hashes):
+    """Empreinte d'un ensemble de row_hash: nombre et somme (indépendante de l'ordre)"""
+    hashes = list(hashes)
+    return {"count": len(hashes), "checksum": sum(hash_value(h) for h in hashes)}
+
+def remote_fingerprints(secteurs):
+    """Empreintes parc_ascenseurs par secteur (RPC), None si indisponible"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/rpc/parc_secteur_fingerprints"
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Authorization': f'Bearer {SUPABASE_KEY}',
+        'Content-Type': 'application/json'
+    }
+    status, body = http_request(url, 'POST', {'p_secteurs': [int(s) for s in secteurs]}, headers, 30)
+    if status != 200:
+        return None
+    try:
+        prints = {str(int(s)): {"count": 0, "checksum": 0} for s in secteurs}
+        for r in json.loads(body):
+            prints[str(r['secteur'])] = {"count": int(r['nb']), "checksum": int(r['checksum'])}
+        return prints
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def reconcile_sector(sector, wsid, remote, dry=False):
+    """Compare un secteur à Progilift et réécrit les appareils manquants ou modifiés.
+    Les appareils présents seulement dans Supabase sont signalés, pas supprimés."""
+    items = fetch_equipements(sector, wsid)
+    if items is None:
+        return {"sector": sector, "status": "error", "message": "get_Synchro_Wsoucont failed"}
+    
+    # Appareils rattachés à un autre secteur: comptés dans l'empreinte de leur secteur
+    rows = [r for r in map(equipement_row, items) if r and str(r.get('secteur')) == sector]
+    for r in rows:
+        r['row_hash'] = row_hash(r)
+    local = fingerprint(r['row_hash'] for r in rows)
+    if local == remote:
+        return {"sector": sector, "status": "in_sync", "count": local["count"]}
+    
+    _, stored = supabase_iter('parc_ascenseurs', 'id_wsoucont,row_hash', f"secteur=eq.{sector}", key='id_wsoucont')
+    stored = {r['id_wsoucont']: r.get('row_hash') for r in stored}
+    missing = [r for r in rows if r['id_wsoucont'] not in stored]
+    changed = [r for r in rows if r['id_wsoucont'] in stored and stored[r['id_wsoucont']] != r['row_hash']]
+    extra = sorted(set(stored) - {r['id_wsoucont'] for r in rows})
+    
+    result = {
+        "sector": sector,
+        "status": "drift",
+        "progilift": local,
+        "supabase": remote,
+        "missing": len(missing),
+        "changed": len(changed),
+        "extra": len(extra),
+        "extra_ids": extra[:20],
+        "repaired": 0
+    }
+    if dry or not (missing or changed):
+        return result
+    
+    drained = spool_upsert('parc_ascenseurs', missing + changed, 'id_wsoucont')
+    result["repaired"] = drained["rows"]
+    if drained["pending"]:
+        result["status"] = "partial"
+        result["spool_pending"] = drained["pending"]
+        result["errors"] = drained["errors"][:5]
+        refresh_secteurs([sector], error='; '.join(drained["errors"][:3]) or "Écriture incomplète (spool)")
+    else:
+        refresh_secteurs([sector], synced_at=datetime.now())
+        refresh_planning({sector} | {r['secteur'] for r in changed if r.get('secteur')})
+    return result
+
+def sync_reconcile(sectors=None, dry=False, budget=RECONCILE_BUDGET):
+    """Réconcilie les secteurs donnés (tous par défaut, en reprenant au curseur
+    sauvegardé quand le budget de temps a interrompu le passage précédent)"""
+    start = datetime.now()
+    resume = sectors is None
+    cursor = (get_sync_state('reconcile').get('cursor') or 0) if resume else 0
+    todo = SECTORS[cursor:] if resume else sectors
+    
+    remote = remote_fingerprints(todo)
+    if remote is None:
+        return {"status": "error", "mode": "reconcile", "message": "parc_secteur_fingerprints indisponible"}
+    wsid = get_auth()
+    if not wsid:
+        return {"status": "error", "mode": "reconcile", "message": "Auth failed"}
+    
+    checked = []
+    for sector in todo:
+        if (datetime.now() - start).total_seconds() > budget:
+            break
+        try:
+            checked.append(reconcile_sector(sector, wsid, remote[sector], dry))
+        except Exception as e:
+            checked.append({"sector": sector, "status": "error", "message": str(e)})
+    
+    remaining = len(todo) - len(checked)
+    if resume and not dry:
+        # Passage complet: le suivant repart du premier secteur
+        save_sync_state('reconcile', cursor=cursor + len(checked) if remaining else 0,
+                        status='running' if remaining else 'success', last_run=start)
+    
+    drifted = [c for c in checked if c['status'] not in ('in_sync', 'error')]
+    failed = [c for c in checked if c['status'] in ('error', 'partial')]
+    repaired = sum(c.get('repaired', 0) for c in checked)
+    duration = (datetime.now() - start).total_seconds()
+    status = "partial" if failed else "success"
+    
+    if not dry:
+        supabase_insert('parc_sync_logs', {
+            'sync_date': datetime.now().isoformat(),
+            'sync_type': 'reconcile',
+            'status': status,
+            'equipements_count': repaired,
+            'pannes_count': 0,
+            'arrets_count': 0,
+            'duration_seconds': round(duration, 2),
+            'error_message': safe_str('; '.join(f"Secteur {c['sector']}: {c.get('message') or c.get('errors')}" for c in failed), 500) or None
+        })
+    
+    return {
+        "status": status,
+        "mode": "reconcile",
+        "dry_run": dry,
+        "checked": len(checked),
+        "in_sync": len([c for c in checked if c['status'] == 'in_sync']),
+        "drifted": [c['sector'] for c in drifted],
+        "repaired": repaired,
+        "remaining": remaining,
+        "sectors": checked,
+        "duration": round(duration, 2)
+    }
+
+# ============================================================
+# FILE DE TRAVAIL: SYNC COMPLÈTE DISTRIBUÉE
+# ============================================================
+
+def queue_units():
+    """Unités de la sync complète: (unit, step, idx, phase)"""
+    units = [('0', '0', 0, 0), ('1', '1', 0, 0)]
+    units += [(f'2:{i}', '2', i, 1) for i in range(len(SECTORS))]
+    units += [(f'3:{i}', '3', i, 1) for i in range(len(PERIODS))]
+    # Les passages mettent à jour des équipements déjà créés par l'étape 2
+    units += [(f'2b:{i}', '2b', i, 2) for i in range(len(SECTORS))]
+    units.append(('4', '4', 0, 3))
+    return units
+
+def run_step(step, idx):
+    """Exécute une étape de la sync complète (mêmes fonctions que ?step=X)"""
+    if step == '0':
+        return sync_type_planning()
+    if step == '1':
+        return sync_arrets()
+    if step == '2':
+        return sync_equipements(idx)
+    if step == '2b':
+        return sync_passages(idx)
+    if step == '3':
+        return sync_pannes(idx)
+    if step == '4':
+        return update_nb_visites()
+    return {"status": "error", "message": f"Unknown step: {step}"}
+
+def run_unit(step, idx, wait=0, log_skip=True):
+    """Exécute une étape sous les verrous de STEP_LOCKS"""
+    return run_locked(STEP_LOCKS.get(step), 'full', lambda: run_step(step, idx), wait, log_skip)
+
+def latest_run_id():
+    """run_id de la dernière sync complète créée"""
+    rows = supabase_get('parc_sync_queue', 'run_id', 'order=run_id.desc', 1)
+    return rows[0]['run_id'] if rows else None
+
+def enqueue_full_sync(force=False):
+    """Crée une sync complète dans parc_sync_queue (sauf si une autre est en cours)"""
+    open_units = supabase_get('parc_sync_queue', 'run_id', 'status=in.(pending,running)&order=run_id.asc', 1)
+    if open_units and not force:
+        result = queue_status(open_units[0]['run_id'])
+        result['status'] = 'exists'
+        result['message'] = "A full sync is already queued, use &force=1 to queue another one"
+        return result
+    
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+    rows = [{
+        'run_id': run_id,
+        'unit': unit,
+        'step': step,
+        'idx': idx,
+        'phase': phase,
+        'status': 'pending',
+        'attempts': 0
+    } for unit, step, idx, phase in queue_units()]
+    if not supabase_upsert('parc_sync_queue', rows, 'run_id,unit'):
+        return {"status": "error", "message": "Failed to create queue units"}
+    return {"status": "success", "mode": "enqueue", "run_id": run_id, "units": len(rows)}
+
+def queue_patch(run_id, unit, filter_str, data):
+    """PATCH conditionnel d'une unité: vrai si la ligne a été modifiée"""
+    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/parc_sync_queue?run_id=eq.{run_id}&unit=eq.{unit}&{filter_str}"
+    headers = supabase_headers()
+    headers['Prefer'] = 'return=representation'
+    status, body = http_request(url, 'PATCH', data, headers, 15)
+    try:
+        return status == 200 and bool(json.loads(body))
+    except ValueError:
+        return False
+
+def claim_unit(holder, run_id=None):
+    """Prend une unité disponible de la plus ancienne sync en cours, dans sa phase courante.
+    Retourne (unité, None) ou (None, 'empty' | 'waiting')."""
+    filter_str = 'status=in.(pending,running)&order=run_id.asc,phase.asc,idx.asc'
+    if run_id:
+        filter_str += f'&run_id=eq.{run_id}'
+    rows = supabase_get('parc_sync_queue', 'run_id,unit,step,idx,phase,status,leased_until,attempts', filter_str, 500)
+    if not rows:
+        return None, 'empty'
+    
+    # Phase courante = plus petite phase non terminée de la sync la plus ancienne
+    run_id, phase = rows[0]['run_id'], rows[0]['phase']
+    now = datetime.now()
+    candidates = []
+    for r in rows:
+        if r['run_id'] != run_id or r['phase'] != phase:
+            continue
+        lease = parse_ts(r.get('leased_until'))
+        if r['status'] == 'pending' or lease is None or lease < now:
+            candidates.append(r)
+    if not candidates:
+        return None, 'waiting'
+    
+    # Ordre aléatoire: des workers démarrés ensemble ne visent pas tous la même unité
+    random.shuffle(candidates)
+    # La condition reprend l'état lu (statut, bail expiré, tentatives): un seul worker gagne
+    available = f"attempts=eq.{{attempts}}&or=(status.eq.pending,and(status.eq.running,leased_until.lt.{now.isoformat()}))"
+    for r in candidates:
+        condition = available.format(attempts=r['attempts'])
+        if r['attempts'] >= QUEUE_MAX_ATTEMPTS:
+            # Bail expiré après la dernière tentative: abandon de l'unité
+            queue_patch(r['run_id'], r['unit'], condition, {
+                'status': 'failed',
+                'holder': None,
+                'leased_until': None,
+                'last_error': 'Lease expired on last attempt',
+                'finished_at': now.isoformat()
+            })
+            continue
+        if queue_patch(r['run_id'], r['unit'], condition, {
+            'status': 'running',
+            'holder': holder,
+            'leased_until': (now + timedelta(seconds=QUEUE_LEASE_SECONDS)).isoformat(),
+            'attempts': r['attempts'] + 1,
+            'started_at': now.isoformat()
+        }):
+            r['attempts'] += 1
+            return r, None
+    return None, 'waiting'
+
+def finish_unit(unit, holder, result):
+    """Marque l'unité terminée, ou la remet en file (failed après QUEUE_MAX_ATTEMPTS).
+    Sans effet si le bail a été perdu et l'unité reprise par un autre worker."""
+    ok = result.get('status') != 'error'
+    data = {
+        'holder': None,
+        'leased_until': None,
+        'result': {k: v for k, v in result.items() if not isinstance(v, (list, dict))}
+    }
+    if result.get('status') == 'skipped':
+        # Remise en file sans compter de tentative
+        data.update({'status': 'pending', 'attempts': unit['attempts'] - 1, 'last_error': safe_str(result.get('message'), 500)})
+    elif ok:
+        data.update({'status': 'done', 'last_error': None, 'finished_at': datetime.now().isoformat()})
+    elif unit['attempts'] >= QUEUE_MAX_ATTEMPTS:
+        data.update({'status': 'failed', 'last_error': safe_str(result.get('message'), 500), 'finished_at': datetime.now().isoformat()})
+    else:
+        data.update({'status': 'pending', 'last_error': safe_str(result.get('message'), 500)})
+    return queue_patch(unit['run_id'], unit['unit'], f'holder=eq.{holder}&status=eq.running', data)
+
+def queue_status(run_id=None):
+    """Avancement d'une sync complète (la dernière par défaut)"""
+    run_id = run_id or latest_run_id()
+    if not run_id:
+        return {"status": "empty", "mode": "queue", "message": "No full sync queued, use ?mode=enqueue"}
+    
+    rows = supabase_get('parc_sync_queue', 'unit,phase,status,attempts,last_error,started_at,finished_at',
+                        f'run_id=eq.{run_id}&order=phase.asc,idx.asc')
+    counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+    for r in rows:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    open_phases = [r['phase'] for r in rows if r['status'] in ('pending', 'running')]
+    
+    return {
+        "status": "running" if open_phases else "completed",
+        "mode": "queue",
+        "run_id": run_id,
+        "units": len(rows),
+        "counts": counts,
+        "phase": min(open_phases) if open_phases else None,
+        "running": [r['unit'] for r in rows if r['status'] == 'running'],
+        "failed": [{"unit": r['unit'], "attempts": r['attempts'], "error": r.get('last_error')} for r in rows if r['status'] == 'failed']
+    }
+
+def sync_worker(run_id=None, budget=QUEUE_WORKER_BUDGET):
+    """Traite des unités de la file jusqu'à épuisement ou fin du budget.
+    Plusieurs invocations peuvent tourner en parallèle sur la même sync."""
+    start = datetime.now()
+    holder = uuid.uuid4().hex
+    processed = []
+    state = 'budget'
+    
+    while (datetime.now() - start).total_seconds() < budget:
+        unit, state = claim_unit(holder, run_id)
+        if state == 'empty':
+            break
+        if state == 'waiting':
+            # Phase courante entièrement prise par d'autres workers
+            time.sleep(QUEUE_POLL_SECONDS)
+            state = 'budget'
+            continue
+        
+        t0 = datetime.now()
+        try:
+            # Périmètre verrouillé par une autre sync: l'unité est remise en file
+            result = run_unit(unit['step'], unit['idx'], log_skip=False)
+        except Exception as e:
+            result = {"status": "error", "message": str(e)}
+        kept = finish_unit(unit, holder, result)
+        if result.get('status') == 'skipped':
+            time.sleep(QUEUE_POLL_SECONDS)
+        processed.append({
+            "unit": unit['unit'],
+            "status": result.get('status'),
+            "attempt": unit['attempts'],
+            "duration": round((datetime.now() - t0).total_seconds(), 2),
+            "lease_lost": not kept
+        })
+    
+    return {
+        "status": "success",
+        "mode": "worker",
+        "worker": holder,
+        "processed": processed,
+        "stopped": state,
+        "queue": queue_status(run_id),
+        "duration": round((datetime.now() - start).total_seconds(), 2)
+    }
+
+# ============================================================
+# PROFILAGE À LA DEMANDE (&profile=1)
+# ============================================================
+# cProfile ne suit que le thread de la requête (pas les threads de lecture
+# parallèle ni le heartbeat des verrous); tracemalloc compte tous les threads.
+
+def profile_label(params):
+    """Étape profilée, sous forme de query string sans le paramètre profile"""
+    return '&'.join(f"{k}={v[0]}" for k, v in sorted(params.items()) if k != 'profile') or 'ready'
+
+def profile_functions(profiler, top):
+    """Fonctions les plus coûteuses en temps cumulé"""
+    stats = pstats.Stats(profiler).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    return [{
+        "function": f"{os.path.basename(filename)}:{line}({name})" if filename != '~' else name,
+        "calls": nc,
+        "tottime": round(tt, 4),
+        "cumtime": round(ct, 4)
+    } for (filename, line, name), (cc, nc, tt, ct, callers) in ranked]
+
+def profile_allocations(snapshot, top):
+    """Lignes ayant alloué le plus de mémoire encore présente en fin d'étape"""
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
+    return [{
+        "site": f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}",
+        "size_kb": round(s.size / 1024, 1),
+        "count": s.count
+    } for s in snapshot.statistics('lineno')[:top]]
+
+def run_profiled(params, fn, top=PROFILE_TOP):
+    """Exécute fn sous cProfile et tracemalloc, joint le profil au résultat
+    et l'enregistre dans parc_sync_profiles"""
+    label = profile_label(params)
+    start = datetime.now()
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = fn()
+    except Exception as e:
+        result = {"status": "error", "message": str(e), "trace": traceback.format_exc()[:500]}
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    
+    profile = {
+        "label": label,
+        "status": result.get('status') if isinstance(result, dict) else None,
+        "duration_seconds": round((datetime.now() - start).total_seconds(), 2),
+        "peak_memory_kb": round(peak / 1024, 1),
+        "top_functions": profile_functions(profiler, top),
+        "top_allocations": profile_allocations(snapshot, top)
+    }
+    profile["stored"] = supabase_insert('parc_sync_profiles', {
+        **profile,
+        'created_at': start.isoformat()
+    })
+    result['profile'] = profile
+    return result
+
+def dispatch(params):
+    """Exécute l'étape ou le mode demandé par les paramètres de la requête"""
+    step = params.get('step', [''])[0]
+    sector = int(params.get('sector', ['0'])[0])
+    period = int(params.get('period', ['0'])[0])
+    mode = params.get('mode', [''])[0]
+    tier = params.get('tier', [''])[0]
+    run_id = params.get('run', [None])[0]
+    wait = min(int(params.get('wait', ['0'])[0]), 240)
+    
+    if mode == 'cron':
+        result = run_locked(['arrets', 'pannes'], 'cron', sync_cron, wait)
+    elif mode == 'drain':
+        result = sync_drain()
+    elif mode == 'bench':
+        result = bench_ingest(params.get('table', ['parc_pannes'])[0], int(params.get('rows', ['1000'])[0]))
+    elif mode == 'enqueue':
+        result = enqueue_full_sync(params.get('force', [''])[0] == '1')
+    elif mode == 'worker':
+        result = sync_worker(run_id)
+    elif mode == 'queue':
+        result = queue_status(run_id)
+    elif mode == 'reconcile':
+        only = params.get('sector', [None])[0]
+        result = sync_reconcile([SECTORS[int(only)]] if only is not None else None,
+                                params.get('dry', [''])[0] == '1')
+    elif mode == 'scheduler':
+        result = sync_scheduler()
+    elif mode == 'tier':
+        if tier not in TIERS:
+            result = {"status": "error", "message": f"Unknown tier: {tier}", "tiers": list(TIERS)}
+        else:
+            result = run_tier(tier)
+    elif step in ('0', '1', '2', '2b', '3', '4'):
+        result = run_unit(step, period if step == '3' else sector, wait)
+    else:
+        result = {
+            "status": "ready",
+            "message": "Progilift Sync API v3 - AuvergneTech",
+            "tables": {
+                "parc_ascenseurs": "Équipements (id_wsoucont unique)",
+                "parc_passages": "Historique des passages (appareil, date, source)",
+                "parc_pannes": "Historique pannes (id_panne unique)",
+                "parc_arrets": "Arrêts en cours (temps réel)",
+                "parc_type_planning": "Référentiel plannings",
+                "parc_planning_visites": "Tournées par secteur et par mois (ordre de visite)",
+                "parc_secteurs": "Référentiel secteurs + cumuls (appareils, arrêts, pannes 30 j, dernière sync)",
+                "parc_sync_logs": "Logs synchronisation"
+            },
+            "config": {
+                "sectors": len(SECTORS),
+                "periods": len(PERIODS)
+            },
+            "endpoints": {
+                "step0": "?step=0 → Types planning (référentiel nb_visites)",
+                "step1": "?step=1 → Arrêts en cours",
+                "step2": "?step=2&sector=0..21 → Équipements (Wsoucont)",
+                "step2b": "?step=2b&sector=0..21 → Passages (Wsoucont2)",
+                "step3": "?step=3&period=0..6 → Pannes",
+                "step4": "?step=4 → Mise à jour nb_visites_an + flags en_arret",
+                "cron": "?mode=cron → Sync rapide (arrêts + pannes depuis le dernier succès)",
+                "scheduler": "?mode=scheduler → Niveau le plus en retard, un par appel (arrêts 2 min, pannes 15 min, équipements 30 min, secteurs actifs en priorité, chaque secteur au moins toutes les 24 h)",
+                "tier": "?mode=tier&tier=stops|pannes|equipements → Force un niveau",
+                "drain": "?mode=drain → Rejoue le spool d'écriture",
+                "bench": "?mode=bench&table=parc_pannes&rows=1000 → Benchmark JSON vs CSV",
+                "enqueue": "?mode=enqueue[&force=1] → Met une sync complète en file (parc_sync_queue)",
+                "worker": "?mode=worker[&run=ID] → Traite la file, à lancer en plusieurs exemplaires",
+                "queue": "?mode=queue[&run=ID] → Avancement de la sync complète",
+                "reconcile": "?mode=reconcile[&sector=0..21][&dry=1] → Compare les empreintes par secteur et ne resynchronise que les secteurs divergents"
+            },
+            "full_sync_order": "0 → 1 → 2 (x22) → 2b (x22) → 3 (x7) → 4",
+            "full_sync_parallel": "?mode=enqueue puis N x ?mode=worker",
+            "locks": "&wait=N → Attend jusqu'à N s un verrou de périmètre pris au lieu d'ignorer le passage",
+            "profile": "&profile=1 → Temps par fonction, pic mémoire et sites d'allocation (parc_sync_profiles)"
+        }
+    return result
+
 # ============================================================
 # HANDLER HTTP (Vercel)
 # ============================================================
@@ -727,52 +2609,10 @@ class handler(BaseHTTPRequestHandler):
             parsed = urlparse(self.path)
             params = parse_qs(parsed.query)
             
-            step = params.get('step', [''])[0]
-            sector = int(params.get('sector', ['0'])[0])
-            period = int(params.get('period', ['0'])[0])
-            mode = params.get('mode', [''])[0]
-            
-            if mode == 'cron':
-                result = sync_cron()
-            elif step == '0':
-                result = sync_type_planning()
-            elif step == '1':
-                result = sync_arrets()
-            elif step == '2':
-                result = sync_equipements(sector)
-            elif step == '2b':
-                result = sync_passages(sector)
-            elif step == '3':
-                result = sync_pannes(period)
-            elif step == '4':
-                result = update_nb_visites()
+            if params.get('profile', [''])[0] == '1':
+                result = run_profiled(params, lambda: dispatch(params))
             else:
-                result = {
-                    "status": "ready",
-                    "message": "Progilift Sync API v3 - AuvergneTech",
-                    "tables": {
-                        "parc_ascenseurs": "Équipements (id_wsoucont unique)",
-                        "parc_pannes": "Historique pannes (id_panne unique)",
-                        "parc_arrets": "Arrêts en cours (temps réel)",
-                        "parc_type_planning": "Référentiel plannings",
-                        "parc_secteurs": "Référentiel secteurs",
-                        "parc_sync_logs": "Logs synchronisation"
-                    },
-                    "config": {
-                        "sectors": len(SECTORS),
-                        "periods": len(PERIODS)
-                    },
-                    "endpoints": {
-                        "step0": "?step=0 → Types planning (référentiel nb_visites)",
-                        "step1": "?step=1 → Arrêts en cours",
-                        "step2": "?step=2&sector=0..21 → Équipements (Wsoucont)",
-                        "step2b": "?step=2b&sector=0..21 → Passages (Wsoucont2)",
-                        "step3": "?step=3&period=0..6 → Pannes",
-                        "step4": "?step=4 → Mise à jour nb_visites_an + flags en_arret",
-                        "cron": "?mode=cron → Sync rapide (arrêts + pannes récentes)"
-                    },
-                    "full_sync_order": "0 → 1 → 2 (x22) → 2b (x22) → 3 (x7) → 4"
-                }
+                result = dispatch(params)
         
         except Exception as e:
             result = {
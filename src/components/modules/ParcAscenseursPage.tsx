@@ -317,6 +317,7 @@ const getLastSync = async (): Promise<SyncLog | null> => {
     const { data, error } = await supabase
       .from('parc_sync_logs')
       .select('*')
+      .neq('status', 'skipped')
       .order('sync_date', { ascending: false })
       .limit(1)
       .maybeSingle(); // Utiliser maybeSingle au lieu de single pour éviter l'erreur si vide
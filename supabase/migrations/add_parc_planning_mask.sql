@@ -0,0 +1,79 @@
+-- ============================================
+-- MASQUE DE PLANNING ET ORDRE DE TOURNÉE PAR MOIS
+-- ============================================
+-- planning_mask: 12 bits, bit 0 = janvier ... bit 11 = décembre (mêmes mois que
+-- planning_jan..planning_dec, qui restent écrits). Calculé par api/sync.py.
+--
+-- parc_planning_visites: appareils à visiter par (secteur, mois), numérotés dans
+-- l'ordre de tournée (wordre, ordre2). Recalculée par secteur après la sync de ses
+-- équipements; api/planning.py lit une tournée en une requête sur la clé primaire.
+
+ALTER TABLE parc_ascenseurs ADD COLUMN IF NOT EXISTS planning_mask SMALLINT NOT NULL DEFAULT 0;
+
+UPDATE parc_ascenseurs SET planning_mask =
+    (CASE WHEN planning_jan THEN 1 ELSE 0 END)
+  | (CASE WHEN planning_fev THEN 2 ELSE 0 END)
+  | (CASE WHEN planning_mar THEN 4 ELSE 0 END)
+  | (CASE WHEN planning_avr THEN 8 ELSE 0 END)
+  | (CASE WHEN planning_mai THEN 16 ELSE 0 END)
+  | (CASE WHEN planning_jun THEN 32 ELSE 0 END)
+  | (CASE WHEN planning_jul THEN 64 ELSE 0 END)
+  | (CASE WHEN planning_aou THEN 128 ELSE 0 END)
+  | (CASE WHEN planning_sep THEN 256 ELSE 0 END)
+  | (CASE WHEN planning_oct THEN 512 ELSE 0 END)
+  | (CASE WHEN planning_nov THEN 1024 ELSE 0 END)
+  | (CASE WHEN planning_dec THEN 2048 ELSE 0 END);
+
+CREATE TABLE IF NOT EXISTS parc_planning_visites (
+  secteur INTEGER NOT NULL,
+  mois SMALLINT NOT NULL CHECK (mois BETWEEN 1 AND 12),
+  rang INTEGER NOT NULL, -- position dans la tournée du mois (1..n)
+  id_wsoucont INTEGER NOT NULL,
+  code_appareil TEXT,
+  adresse TEXT,
+  ville TEXT,
+  code_postal TEXT,
+  nom_convivial TEXT,
+  type_planning TEXT,
+  wordre INTEGER,
+  ordre2 INTEGER,
+  computed_at TIMESTAMPTZ DEFAULT NOW(),
+  PRIMARY KEY (secteur, mois, rang)
+);
+
+CREATE INDEX IF NOT EXISTS idx_parc_planning_visites_appareil ON parc_planning_visites(id_wsoucont);
+
+-- Recalcule les tournées des secteurs donnés (tous si NULL)
+CREATE OR REPLACE FUNCTION parc_planning_refresh(p_secteurs INTEGER[] DEFAULT NULL) RETURNS INTEGER AS $$
+DECLARE
+  nb INTEGER;
+BEGIN
+  DELETE FROM parc_planning_visites
+  WHERE p_secteurs IS NULL OR secteur = ANY(p_secteurs);
+
+  INSERT INTO parc_planning_visites (
+    secteur, mois, rang, id_wsoucont, code_appareil, adresse, ville, code_postal,
+    nom_convivial, type_planning, wordre, ordre2
+  )
+  SELECT
+    a.secteur,
+    m.mois,
+    row_number() OVER (
+      PARTITION BY a.secteur, m.mois
+      ORDER BY a.wordre NULLS LAST, a.ordre2 NULLS LAST, a.code_appareil, a.id_wsoucont
+    ),
+    a.id_wsoucont, a.code_appareil, a.adresse, a.ville, a.code_postal,
+    a.nom_convivial, a.type_planning, a.wordre, a.ordre2
+  FROM parc_ascenseurs a
+  CROSS JOIN generate_series(1, 12) AS m(mois)
+  WHERE a.secteur IS NOT NULL
+    AND (p_secteurs IS NULL OR a.secteur = ANY(p_secteurs))
+    AND (a.planning_mask >> (m.mois - 1)) & 1 = 1;
+  GET DIAGNOSTICS nb = ROW_COUNT;
+
+  RETURN nb;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Premier calcul
+SELECT parc_planning_refresh();
@@ -0,0 +1,37 @@
+-- ============================================
+-- REMPLACEMENT ATOMIQUE DES TABLES DE RÉFÉRENCE
+-- ============================================
+-- parc_replace_rows(table, lignes JSON) vide la table et insère le nouveau
+-- contenu dans la même transaction (un seul appel RPC depuis api/sync.py et
+-- api/cron.py). Une sync interrompue laisse l'ancien contenu en place et les
+-- lecteurs (étape 4: nb_visites_an depuis parc_type_planning, frontend:
+-- parc_arrets) ne voient jamais une table à moitié écrite.
+--
+-- Les colonnes insérées sont les clés du premier objet; les autres (id,
+-- created_at...) prennent leur valeur par défaut.
+
+CREATE OR REPLACE FUNCTION parc_replace_rows(p_table TEXT, p_rows JSONB) RETURNS INTEGER AS $$
+DECLARE
+  cols TEXT;
+  nb INTEGER := 0;
+BEGIN
+  IF p_table NOT IN ('parc_type_planning', 'parc_arrets') THEN
+    RAISE EXCEPTION 'Table non supportée: %', p_table;
+  END IF;
+
+  -- Un seul remplacement à la fois; les lectures ne sont pas bloquées
+  EXECUTE format('LOCK TABLE %I IN SHARE ROW EXCLUSIVE MODE', p_table);
+  EXECUTE format('DELETE FROM %I', p_table);
+
+  IF jsonb_array_length(COALESCE(p_rows, '[]'::jsonb)) > 0 THEN
+    SELECT string_agg(quote_ident(k), ', ') INTO cols FROM jsonb_object_keys(p_rows->0) AS k;
+    EXECUTE format(
+      'INSERT INTO %1$I (%2$s) SELECT %2$s FROM jsonb_populate_recordset(NULL::%1$I, $1)',
+      p_table, cols
+    ) USING p_rows;
+    GET DIAGNOSTICS nb = ROW_COUNT;
+  END IF;
+
+  RETURN nb;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,35 @@
+-- ============================================
+-- HASH DE LIGNE POUR LE MIROIR LOCAL DE SYNC
+-- ============================================
+-- row_hash = 16 premiers caractères hexa du SHA-1 de la ligne synchronisée
+-- (hors synced_at / updated_at), écrit par api/sync.py. Le miroir SQLite de la
+-- sync (SYNC_MIRROR_PATH) compare sa propre somme de contrôle à celle-ci.
+
+ALTER TABLE parc_ascenseurs ADD COLUMN IF NOT EXISTS row_hash TEXT;
+ALTER TABLE parc_pannes ADD COLUMN IF NOT EXISTS row_hash TEXT;
+
+-- Somme de contrôle: nombre de lignes, somme des 60 premiers bits des hash
+-- (indépendante de l'ordre) et nombre d'appareils en arrêt.
+-- Doit rester cohérente avec hash_value() / mirror_local_checksum() dans api/sync.py.
+CREATE OR REPLACE FUNCTION parc_mirror_checksum(p_table TEXT) RETURNS JSON AS $$
+DECLARE
+  result JSON;
+BEGIN
+  IF p_table = 'parc_ascenseurs' THEN
+    SELECT json_build_object(
+      'count', count(*),
+      'checksum', COALESCE(sum(('x' || lpad(substr(COALESCE(row_hash, ''), 1, 15), 16, '0'))::bit(64)::bigint), 0)::text,
+      'flagged', count(*) FILTER (WHERE en_arret)
+    ) INTO result FROM parc_ascenseurs;
+  ELSIF p_table = 'parc_pannes' THEN
+    SELECT json_build_object(
+      'count', count(*),
+      'checksum', COALESCE(sum(('x' || lpad(substr(COALESCE(row_hash, ''), 1, 15), 16, '0'))::bit(64)::bigint), 0)::text,
+      'flagged', 0
+    ) INTO result FROM parc_pannes;
+  ELSE
+    RAISE EXCEPTION 'Table non supportée: %', p_table;
+  END IF;
+  RETURN result;
+END;
+$$ LANGUAGE plpgsql STABLE;
@@ -0,0 +1,22 @@
+-- ============================================
+-- INDEX DE RECHERCHE DES APPAREILS
+-- ============================================
+-- search_text: code_appareil, adresse, ville, nom_convivial et num_serie en
+-- minuscules, sans accents ni ponctuation (écrit par api/sync.py, étape 2).
+-- L'index trigramme sert les recherches "contient" (ilike '%...%') sur cette
+-- colonne; api/search.py s'en sert pour construire son index en mémoire.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+ALTER TABLE parc_ascenseurs ADD COLUMN IF NOT EXISTS search_text TEXT;
+
+-- Reprise de l'existant (la sync réécrit ensuite la colonne avec la même normalisation)
+UPDATE parc_ascenseurs SET search_text = trim(regexp_replace(
+  lower(unaccent(concat_ws(' ', code_appareil, adresse, ville, nom_convivial, num_serie))),
+  '[^a-z0-9]+', ' ', 'g'
+))
+WHERE search_text IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_parc_ascenseurs_search_trgm
+  ON parc_ascenseurs USING gin (search_text gin_trgm_ops);
@@ -0,0 +1,18 @@
+-- ============================================
+-- EMPREINTES PAR SECTEUR (RÉCONCILIATION)
+-- ============================================
+-- api/sync.py?mode=reconcile compare, secteur par secteur, l'empreinte des
+-- équipements Progilift à celle de parc_ascenseurs et ne resynchronise que les
+-- secteurs qui diffèrent. Empreinte = nombre de lignes + somme des 60 premiers
+-- bits de row_hash, comme parc_mirror_checksum (cf. hash_value() dans api/sync.py).
+
+CREATE OR REPLACE FUNCTION parc_secteur_fingerprints(p_secteurs INTEGER[])
+RETURNS TABLE (secteur INTEGER, nb BIGINT, checksum TEXT) AS $$
+  SELECT
+    a.secteur,
+    count(*),
+    COALESCE(sum(('x' || lpad(substr(COALESCE(a.row_hash, ''), 1, 15), 16, '0'))::bit(64)::bigint), 0)::text
+  FROM parc_ascenseurs a
+  WHERE a.secteur = ANY(p_secteurs)
+  GROUP BY a.secteur;
+$$ LANGUAGE sql STABLE;
@@ -0,0 +1,80 @@
+-- ============================================
+-- CUMULS PAR SECTEUR DANS parc_secteurs
+-- ============================================
+-- Compteurs recalculés par api/sync.py et api/cron.py après leurs écritures
+-- (équipements d'un secteur, flags en_arret, pannes), via parc_secteurs_refresh().
+-- api/status.py lit ces lignes au lieu de compter parc_ascenseurs / parc_pannes.
+-- Les pannes (hors visites, cause 99) viennent de parc_pannes_stats.
+
+CREATE TABLE IF NOT EXISTS parc_secteurs (
+  numero INTEGER PRIMARY KEY,
+  nom TEXT,
+  couleur TEXT
+);
+
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS nb_ascenseurs INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS nb_en_arret INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS nb_pannes INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS nb_pannes_30j INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS last_sync_at TIMESTAMP; -- dernière sync réussie des équipements du secteur
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS last_error TEXT;
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS last_error_at TIMESTAMP;
+ALTER TABLE parc_secteurs ADD COLUMN IF NOT EXISTS stats_updated_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_parc_ascenseurs_secteur ON parc_ascenseurs(secteur);
+
+-- Recalcule les compteurs des secteurs donnés (tous si NULL).
+-- p_synced_at: sync réussie du secteur (efface last_error), p_error: échec du secteur.
+CREATE OR REPLACE FUNCTION parc_secteurs_refresh(
+  p_secteurs INTEGER[] DEFAULT NULL,
+  p_synced_at TIMESTAMP DEFAULT NULL,
+  p_error TEXT DEFAULT NULL
+) RETURNS INTEGER AS $$
+DECLARE
+  nb INTEGER;
+BEGIN
+  -- Secteurs présents dans le parc mais absents du référentiel
+  INSERT INTO parc_secteurs (numero, nom)
+  SELECT DISTINCT a.secteur, 'Secteur ' || a.secteur
+  FROM parc_ascenseurs a
+  WHERE a.secteur IS NOT NULL
+    AND (p_secteurs IS NULL OR a.secteur = ANY(p_secteurs))
+    AND NOT EXISTS (SELECT 1 FROM parc_secteurs s WHERE s.numero = a.secteur);
+
+  UPDATE parc_secteurs s SET
+    nb_ascenseurs = r.nb_ascenseurs,
+    nb_en_arret = r.nb_en_arret,
+    nb_pannes = r.nb_pannes,
+    nb_pannes_30j = r.nb_pannes_30j,
+    stats_updated_at = NOW()
+  FROM (
+    SELECT
+      x.numero,
+      count(a.id_wsoucont)::int AS nb_ascenseurs,
+      count(a.id_wsoucont) FILTER (WHERE a.en_arret)::int AS nb_en_arret,
+      COALESCE(sum(ps.nb_pannes), 0)::int AS nb_pannes,
+      COALESCE(sum(ps.nb_pannes_30j), 0)::int AS nb_pannes_30j
+    FROM parc_secteurs x
+    LEFT JOIN parc_ascenseurs a ON a.secteur = x.numero
+    LEFT JOIN parc_pannes_stats ps ON ps.id_wsoucont = a.id_wsoucont
+    WHERE p_secteurs IS NULL OR x.numero = ANY(p_secteurs)
+    GROUP BY x.numero
+  ) r
+  WHERE s.numero = r.numero;
+  GET DIAGNOSTICS nb = ROW_COUNT;
+
+  IF p_synced_at IS NOT NULL AND p_secteurs IS NOT NULL THEN
+    UPDATE parc_secteurs SET last_sync_at = p_synced_at, last_error = NULL
+    WHERE numero = ANY(p_secteurs);
+  END IF;
+  IF p_error IS NOT NULL AND p_secteurs IS NOT NULL THEN
+    UPDATE parc_secteurs SET last_error = p_error, last_error_at = NOW()
+    WHERE numero = ANY(p_secteurs);
+  END IF;
+
+  RETURN nb;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Premier calcul
+SELECT parc_secteurs_refresh();
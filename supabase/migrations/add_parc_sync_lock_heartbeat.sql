@@ -0,0 +1,71 @@
+-- ============================================
+-- VERROUS DE PÉRIMÈTRE AVEC HEARTBEAT
+-- ============================================
+-- Les syncs qui écrivent parc_arrets ('arrets') ou parc_pannes ('pannes') prennent
+-- un verrou parc_sync_locks à bail court (90 s), prolongé toutes les 30 s tant
+-- qu'elles tournent. Un verrou dont le heartbeat s'est arrêté expire et peut être
+-- repris. Un passage ignoré faute de verrou est tracé dans parc_sync_logs avec le
+-- statut 'skipped'.
+
+ALTER TABLE parc_sync_locks ADD COLUMN IF NOT EXISTS sync_type TEXT;
+ALTER TABLE parc_sync_locks ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+
+-- Les passages ignorés sont comptés à part dans parc_sync_stats et n'entrent
+-- pas dans nb_syncs (taux de succès, durées)
+ALTER TABLE parc_sync_stats ADD COLUMN IF NOT EXISTS nb_skipped INTEGER NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION parc_sync_stats_on_log() RETURNS TRIGGER AS $$
+DECLARE
+  duration NUMERIC := COALESCE(NEW.duration_seconds, 0);
+  timed BOOLEAN := COALESCE(NEW.duration_seconds, 0) > 0;
+  nb_rows BIGINT := COALESCE(NEW.equipements_count, 0) + COALESCE(NEW.pannes_count, 0) + COALESCE(NEW.arrets_count, 0);
+  bucket INTEGER := parc_sync_duration_bucket(COALESCE(NEW.duration_seconds, 0));
+  hist INTEGER[] := array_fill(0, ARRAY[11]);
+BEGIN
+  IF NEW.status = 'skipped' THEN
+    INSERT INTO parc_sync_stats AS s (jour, sync_type, nb_skipped)
+    VALUES (COALESCE(NEW.sync_date, NOW())::date, COALESCE(NEW.sync_type, 'other'), 1)
+    ON CONFLICT (jour, sync_type) DO UPDATE SET
+      nb_skipped = s.nb_skipped + 1,
+      updated_at = NOW();
+    RETURN NEW;
+  END IF;
+
+  IF timed THEN
+    hist[bucket] := 1;
+  END IF;
+
+  INSERT INTO parc_sync_stats AS s (
+    jour, sync_type, nb_syncs, nb_success, nb_partial, nb_errors,
+    nb_timed, total_duration, max_duration, timed_rows, duration_hist
+  ) VALUES (
+    COALESCE(NEW.sync_date, NOW())::date,
+    COALESCE(NEW.sync_type, 'other'),
+    1,
+    (NEW.status = 'success')::int,
+    (NEW.status = 'partial')::int,
+    (NEW.status = 'error')::int,
+    timed::int,
+    CASE WHEN timed THEN duration ELSE 0 END,
+    duration,
+    CASE WHEN timed THEN nb_rows ELSE 0 END,
+    hist
+  )
+  ON CONFLICT (jour, sync_type) DO UPDATE SET
+    nb_syncs = s.nb_syncs + 1,
+    nb_success = s.nb_success + EXCLUDED.nb_success,
+    nb_partial = s.nb_partial + EXCLUDED.nb_partial,
+    nb_errors = s.nb_errors + EXCLUDED.nb_errors,
+    nb_timed = s.nb_timed + EXCLUDED.nb_timed,
+    total_duration = s.total_duration + EXCLUDED.total_duration,
+    max_duration = GREATEST(s.max_duration, EXCLUDED.max_duration),
+    timed_rows = s.timed_rows + EXCLUDED.timed_rows,
+    duration_hist = (
+      SELECT array_agg(a + b ORDER BY i)
+      FROM unnest(s.duration_hist, EXCLUDED.duration_hist) WITH ORDINALITY AS t(a, b, i)
+    ),
+    updated_at = NOW();
+
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,131 @@
+-- ============================================
+-- STATISTIQUES DE PANNES PAR APPAREIL
+-- ============================================
+-- Une ligne par appareil (id_wsoucont): nombre de pannes, dernière panne,
+-- fréquence sur 30 / 90 jours et MTBF. Les visites (cause 99) sont exclues,
+-- comme dans les écrans du parc.
+--
+-- Maintenue par trigger à chaque écriture dans parc_pannes (sync complète, cron,
+-- rejeu du spool): seuls les appareils présents dans le lot écrit sont recalculés.
+-- Les compteurs 30 / 90 jours glissent avec la date: parc_pannes_stats_refresh_windows()
+-- recalcule une fois par jour les appareils concernés (appelée par les syncs de pannes).
+
+CREATE TABLE IF NOT EXISTS parc_pannes_stats (
+  id_wsoucont INTEGER PRIMARY KEY,
+  code_appareil TEXT,
+  nb_pannes INTEGER NOT NULL DEFAULT 0,
+  nb_pannes_30j INTEGER NOT NULL DEFAULT 0,
+  nb_pannes_90j INTEGER NOT NULL DEFAULT 0,
+  premiere_panne DATE,
+  derniere_panne DATE,
+  derniere_panne_id BIGINT,
+  mtbf_jours NUMERIC, -- écart moyen entre deux pannes (NULL si moins de 2 pannes)
+  nb_personnes_bloquees INTEGER NOT NULL DEFAULT 0,
+  computed_on DATE NOT NULL DEFAULT CURRENT_DATE, -- date de référence des compteurs 30 / 90 jours
+  updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_parc_pannes_stats_code ON parc_pannes_stats(code_appareil);
+CREATE INDEX IF NOT EXISTS idx_parc_pannes_stats_derniere ON parc_pannes_stats(derniere_panne DESC);
+CREATE INDEX IF NOT EXISTS idx_parc_pannes_wsoucont_date ON parc_pannes(id_wsoucont, date_appel DESC);
+
+-- Recalcule les statistiques des appareils donnés depuis parc_pannes
+CREATE OR REPLACE FUNCTION parc_pannes_stats_refresh(p_ids INTEGER[]) RETURNS INTEGER AS $$
+  WITH agg AS (
+    SELECT
+      id_wsoucont,
+      (array_agg(code_appareil ORDER BY date_appel DESC NULLS LAST, id_panne DESC))[1] AS code_appareil,
+      count(*)::int AS nb_pannes,
+      (count(*) FILTER (WHERE date_appel >= CURRENT_DATE - 30))::int AS nb_pannes_30j,
+      (count(*) FILTER (WHERE date_appel >= CURRENT_DATE - 90))::int AS nb_pannes_90j,
+      min(date_appel) AS premiere_panne,
+      max(date_appel) AS derniere_panne,
+      (array_agg(id_panne ORDER BY date_appel DESC NULLS LAST, id_panne DESC))[1] AS derniere_panne_id,
+      CASE WHEN count(date_appel) > 1
+        THEN round((max(date_appel) - min(date_appel))::numeric / (count(date_appel) - 1), 1)
+      END AS mtbf_jours,
+      COALESCE(sum(personnes_bloquees), 0)::int AS nb_personnes_bloquees
+    FROM parc_pannes
+    WHERE id_wsoucont = ANY(p_ids)
+      AND COALESCE(cause, '') <> '99'
+    GROUP BY id_wsoucont
+  ),
+  upserted AS (
+    INSERT INTO parc_pannes_stats AS s (
+      id_wsoucont, code_appareil, nb_pannes, nb_pannes_30j, nb_pannes_90j,
+      premiere_panne, derniere_panne, derniere_panne_id, mtbf_jours,
+      nb_personnes_bloquees, computed_on, updated_at
+    )
+    SELECT
+      id_wsoucont, code_appareil, nb_pannes, nb_pannes_30j, nb_pannes_90j,
+      premiere_panne, derniere_panne, derniere_panne_id, mtbf_jours,
+      nb_personnes_bloquees, CURRENT_DATE, NOW()
+    FROM agg
+    ON CONFLICT (id_wsoucont) DO UPDATE SET
+      code_appareil = EXCLUDED.code_appareil,
+      nb_pannes = EXCLUDED.nb_pannes,
+      nb_pannes_30j = EXCLUDED.nb_pannes_30j,
+      nb_pannes_90j = EXCLUDED.nb_pannes_90j,
+      premiere_panne = EXCLUDED.premiere_panne,
+      derniere_panne = EXCLUDED.derniere_panne,
+      derniere_panne_id = EXCLUDED.derniere_panne_id,
+      mtbf_jours = EXCLUDED.mtbf_jours,
+      nb_personnes_bloquees = EXCLUDED.nb_personnes_bloquees,
+      computed_on = EXCLUDED.computed_on,
+      updated_at = NOW()
+    RETURNING 1
+  ),
+  -- Appareils sans panne restante (panne réaffectée ou requalifiée en visite)
+  removed AS (
+    DELETE FROM parc_pannes_stats
+    WHERE id_wsoucont = ANY(p_ids)
+      AND id_wsoucont NOT IN (SELECT id_wsoucont FROM agg)
+    RETURNING 1
+  )
+  SELECT (SELECT count(*) FROM upserted)::int + (SELECT count(*) FROM removed)::int;
+$$ LANGUAGE sql;
+
+-- Recalcul quotidien des compteurs 30 / 90 jours qui ont pu glisser depuis computed_on
+CREATE OR REPLACE FUNCTION parc_pannes_stats_refresh_windows() RETURNS INTEGER AS $$
+  SELECT parc_pannes_stats_refresh(ARRAY(
+    SELECT id_wsoucont FROM parc_pannes_stats
+    WHERE computed_on < CURRENT_DATE
+      AND derniere_panne >= computed_on - 90
+  ));
+$$ LANGUAGE sql;
+
+-- Trigger de niveau instruction: un recalcul par lot écrit, pas par ligne
+CREATE OR REPLACE FUNCTION parc_pannes_stats_on_write() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' THEN
+    -- Une panne peut changer d'appareil: recalculer l'ancien et le nouveau
+    PERFORM parc_pannes_stats_refresh(ARRAY(
+      SELECT id_wsoucont FROM new_rows WHERE id_wsoucont IS NOT NULL
+      UNION
+      SELECT id_wsoucont FROM old_rows WHERE id_wsoucont IS NOT NULL
+    ));
+  ELSE
+    PERFORM parc_pannes_stats_refresh(ARRAY(
+      SELECT DISTINCT id_wsoucont FROM new_rows WHERE id_wsoucont IS NOT NULL
+    ));
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_parc_pannes_stats_insert ON parc_pannes;
+CREATE TRIGGER trigger_parc_pannes_stats_insert
+  AFTER INSERT ON parc_pannes
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION parc_pannes_stats_on_write();
+
+DROP TRIGGER IF EXISTS trigger_parc_pannes_stats_update ON parc_pannes;
+CREATE TRIGGER trigger_parc_pannes_stats_update
+  AFTER UPDATE ON parc_pannes
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION parc_pannes_stats_on_write();
+
+-- Reprise de l'historique existant
+SELECT parc_pannes_stats_refresh(ARRAY(
+  SELECT DISTINCT id_wsoucont FROM parc_pannes WHERE id_wsoucont IS NOT NULL
+));
@@ -0,0 +1,56 @@
+-- ============================================
+-- HISTORIQUE DES PASSAGES (VISITES D'ENTRETIEN)
+-- ============================================
+-- Une ligne par (appareil, date de passage):
+--   source 'progilift': écrite en masse par api/sync.py?step=2b à partir des
+--                       DATEPASS1..5 de Wsoucont2 (upsert idempotent)
+--   source 'terrain'  : visite enregistrée depuis la fiche NFC
+-- Les passages qui sortent de la fenêtre des 5 derniers côté Progilift restent
+-- dans la table. Les visites d'un secteur sur un mois ou le dernier passage
+-- d'un appareil se lisent par plage sur les index ci-dessous.
+
+CREATE TABLE IF NOT EXISTS parc_passages (
+  id BIGSERIAL PRIMARY KEY,
+  id_wsoucont INTEGER NOT NULL,
+  secteur INTEGER,
+  date_passage TIMESTAMP NOT NULL,
+  source TEXT NOT NULL DEFAULT 'terrain',
+  technicien_id UUID,
+  note TEXT,
+  synced_at TIMESTAMP,
+  created_at TIMESTAMP DEFAULT NOW()
+);
+
+ALTER TABLE parc_passages ADD COLUMN IF NOT EXISTS secteur INTEGER;
+ALTER TABLE parc_passages ADD COLUMN IF NOT EXISTS source TEXT NOT NULL DEFAULT 'terrain';
+ALTER TABLE parc_passages ADD COLUMN IF NOT EXISTS synced_at TIMESTAMP;
+
+-- Clé de l'upsert de la sync (on_conflict=source,id_wsoucont,date_passage)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_parc_passages_unique ON parc_passages(source, id_wsoucont, date_passage);
+-- Visites d'un secteur sur une période / dernier passage d'un appareil
+CREATE INDEX IF NOT EXISTS idx_parc_passages_secteur_date ON parc_passages(secteur, date_passage);
+CREATE INDEX IF NOT EXISTS idx_parc_passages_wsoucont_date ON parc_passages(id_wsoucont, date_passage DESC);
+CREATE INDEX IF NOT EXISTS idx_parc_passages_date ON parc_passages(date_passage);
+
+-- Secteur des visites terrain (la fiche NFC n'envoie que id_wsoucont)
+CREATE OR REPLACE FUNCTION parc_passages_set_secteur() RETURNS TRIGGER AS $$
+BEGIN
+  IF NEW.secteur IS NULL THEN
+    SELECT secteur INTO NEW.secteur FROM parc_ascenseurs WHERE id_wsoucont = NEW.id_wsoucont;
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_parc_passages_secteur ON parc_passages;
+CREATE TRIGGER trigger_parc_passages_secteur BEFORE INSERT ON parc_passages FOR EACH ROW EXECUTE FUNCTION parc_passages_set_secteur();
+
+-- Reprise des passages déjà présents dans parc_ascenseurs (passage_1..5)
+INSERT INTO parc_passages (id_wsoucont, secteur, date_passage, source, synced_at)
+SELECT DISTINCT a.id_wsoucont, a.secteur, p.d::timestamp, 'progilift', NOW()
+FROM parc_ascenseurs a
+CROSS JOIN LATERAL unnest(ARRAY[
+  a.passage_1::date, a.passage_2::date, a.passage_3::date, a.passage_4::date, a.passage_5::date
+]) AS p(d)
+WHERE p.d IS NOT NULL
+ON CONFLICT (source, id_wsoucont, date_passage) DO NOTHING;
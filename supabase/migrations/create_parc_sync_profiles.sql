@@ -0,0 +1,19 @@
+-- ============================================
+-- PROFILS DES SYNCHRONISATIONS (api/sync.py?...&profile=1)
+-- ============================================
+-- Une ligne par appel profilé: temps cumulé des fonctions les plus coûteuses
+-- (cProfile), pic mémoire et sites d'allocation les plus lourds (tracemalloc).
+-- label reprend les paramètres de l'appel (ex: 'period=2&step=3').
+
+CREATE TABLE IF NOT EXISTS parc_sync_profiles (
+  id BIGSERIAL PRIMARY KEY,
+  label TEXT NOT NULL,
+  status TEXT,
+  duration_seconds NUMERIC,
+  peak_memory_kb NUMERIC,
+  top_functions JSONB, -- [{function, calls, tottime, cumtime}]
+  top_allocations JSONB, -- [{site, size_kb, count}]
+  created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_parc_sync_profiles_label ON parc_sync_profiles(label, created_at DESC);
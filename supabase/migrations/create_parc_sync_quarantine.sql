@@ -0,0 +1,29 @@
+-- ============================================
+-- QUARANTAINE DES LIGNES REFUSÉES PAR LA SYNC
+-- ============================================
+-- Une ligne que PostgREST refuse seule pour son contenu (SQLSTATE 22xxx:
+-- valeur trop longue, date invalide, type incompatible...; 23xxx: contrainte)
+-- une fois isolée par l'upsert adaptatif de api/sync.py / api/cron.py est
+-- enregistrée ici avec l'erreur et l'enregistrement brut, même si elle est
+-- seule dans son lot. Les erreurs de requête (PGRST*) ne sont jamais mises en
+-- quarantaine, ni les refus d'un appel qui en compte plus de QUARANTINE_MAX_ROWS
+-- (défaut de schéma probable plutôt que lignes invalides). Elle n'est plus renvoyée tant que son hash source
+-- (row_hash) ne change pas; si Progilift la corrige, elle sort de quarantaine
+-- et est réécrite normalement.
+--
+-- row_key: valeurs des colonnes de conflit jointes par '|' (ex: id_panne,
+-- 'progilift|1234|2025-03-10' pour parc_passages).
+
+CREATE TABLE IF NOT EXISTS parc_sync_quarantine (
+  tbl TEXT NOT NULL,
+  row_key TEXT NOT NULL,
+  row_hash TEXT NOT NULL,
+  http_status INTEGER,
+  error TEXT,
+  record JSONB,
+  first_seen TIMESTAMP DEFAULT NOW(),
+  last_seen TIMESTAMP DEFAULT NOW(),
+  PRIMARY KEY (tbl, row_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_parc_sync_quarantine_last_seen ON parc_sync_quarantine(last_seen DESC);
@@ -0,0 +1,34 @@
+-- ============================================
+-- FILE DE TRAVAIL DE LA SYNC COMPLÈTE (api/sync.py?mode=worker)
+-- ============================================
+-- Une ligne par unité (étape, secteur/période) d'une sync complète (run_id).
+-- Chaque worker prend une unité avec un bail (leased_until), la traite puis la
+-- marque 'done'. Une unité dont le bail a expiré (worker interrompu) redevient
+-- disponible pour les autres workers.
+--
+-- Phases (une phase ne démarre que lorsque les précédentes sont terminées) :
+--   0: types planning, arrêts
+--   1: équipements (x22), pannes (x7)
+--   2: passages Wsoucont2 (x22)
+--   3: nb_visites_an + flags en_arret
+
+CREATE TABLE IF NOT EXISTS parc_sync_queue (
+  run_id TEXT NOT NULL,
+  unit TEXT NOT NULL, -- '0', '1', '2:5', '2b:5', '3:2', '4'
+  step TEXT NOT NULL,
+  idx INTEGER NOT NULL DEFAULT 0, -- indice de secteur ou de période
+  phase INTEGER NOT NULL DEFAULT 0,
+  status TEXT NOT NULL DEFAULT 'pending', -- pending | running | done | failed
+  holder TEXT,
+  leased_until TIMESTAMP,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  result JSONB,
+  started_at TIMESTAMP,
+  finished_at TIMESTAMP,
+  created_at TIMESTAMP DEFAULT NOW(),
+  PRIMARY KEY (run_id, unit)
+);
+
+CREATE INDEX IF NOT EXISTS idx_parc_sync_queue_open ON parc_sync_queue(run_id, phase, idx)
+  WHERE status IN ('pending', 'running');
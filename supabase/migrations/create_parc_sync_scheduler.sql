@@ -0,0 +1,17 @@
+-- ============================================
+-- SCHEDULER PAR NIVEAUX (api/sync.py?mode=scheduler)
+-- ============================================
+
+-- État par périmètre: empreinte des arrêts, reprise des équipements par secteur
+ALTER TABLE parc_sync_watermarks ADD COLUMN IF NOT EXISTS fingerprint TEXT;
+ALTER TABLE parc_sync_watermarks ADD COLUMN IF NOT EXISTS cursor INTEGER DEFAULT 0;
+ALTER TABLE parc_sync_watermarks ADD COLUMN IF NOT EXISTS pass_started TIMESTAMP;
+ALTER TABLE parc_sync_watermarks ADD COLUMN IF NOT EXISTS last_run TIMESTAMP;
+
+-- Verrous à bail: un détenteur à la fois par périmètre, repris après expires_at
+CREATE TABLE IF NOT EXISTS parc_sync_locks (
+  scope TEXT PRIMARY KEY,
+  holder TEXT,
+  acquired_at TIMESTAMP,
+  expires_at TIMESTAMP
+);
@@ -0,0 +1,28 @@
+-- ============================================
+-- PRIORISATION DES SECTEURS (niveau equipements du scheduler)
+-- ============================================
+-- Une ligne par secteur: filigrane de la dernière sync réussie des équipements
+-- et taux de changement observé (lignes modifiées par jour, moyenne lissée).
+-- api/sync.py?mode=scheduler resynchronise souvent les secteurs actifs et les
+-- secteurs calmes seulement quand ils atteignent l'ancienneté maximale
+-- (SECTOR_MAX_STALENESS_HOURS), dans un budget journalier d'appels Progilift
+-- (seau de jetons tokens / tokens_at de parc_sync_watermarks, scope 'equipements').
+-- Un secteur en échec ou partiel n'est réessayé qu'à next_attempt_at (délai doublé
+-- à chaque échec consécutif, remis à zéro au premier succès) et paie ses essais
+-- sur les jetons au lieu de repasser hors budget toutes les 30 minutes.
+
+CREATE TABLE IF NOT EXISTS parc_sync_secteurs (
+  secteur INTEGER PRIMARY KEY,
+  watermark TIMESTAMP, -- début de la dernière sync réussie (delta suivant depuis cette date)
+  change_rate NUMERIC, -- lignes modifiées par jour (NULL tant qu'aucune sync delta n'a eu lieu)
+  last_changed INTEGER,
+  failures INTEGER DEFAULT 0, -- échecs consécutifs (0 après une sync réussie)
+  next_attempt_at TIMESTAMP, -- pas de nouvel essai avant cette date
+  updated_at TIMESTAMP DEFAULT NOW()
+);
+
+ALTER TABLE parc_sync_secteurs ADD COLUMN IF NOT EXISTS failures INTEGER DEFAULT 0;
+ALTER TABLE parc_sync_secteurs ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP;
+
+ALTER TABLE parc_sync_watermarks ADD COLUMN IF NOT EXISTS tokens NUMERIC;
+ALTER TABLE parc_sync_watermarks ADD COLUMN IF NOT EXISTS tokens_at TIMESTAMP;
@@ -0,0 +1,125 @@
+-- ============================================
+-- AGRÉGATS DES SYNCHRONISATIONS PROGILIFT
+-- ============================================
+-- Une ligne par (jour, type de sync), maintenue par trigger à chaque
+-- insertion dans parc_sync_logs. api/logs.py?stats=1 lit ces lignes au lieu
+-- de rescanner l'historique des logs.
+--
+-- Histogramme des durées (secondes), bornes hautes des classes :
+--   1, 2, 5, 10, 20, 30, 60, 120, 300, 600, +inf  (11 classes)
+-- Ces bornes doivent rester identiques à DURATION_BUCKETS dans api/logs.py.
+
+CREATE TABLE IF NOT EXISTS parc_sync_stats (
+  jour DATE NOT NULL,
+  sync_type TEXT NOT NULL,
+  nb_syncs INTEGER NOT NULL DEFAULT 0,
+  nb_success INTEGER NOT NULL DEFAULT 0,
+  nb_partial INTEGER NOT NULL DEFAULT 0,
+  nb_errors INTEGER NOT NULL DEFAULT 0,
+  nb_timed INTEGER NOT NULL DEFAULT 0, -- syncs avec une durée mesurée (> 0)
+  total_duration NUMERIC NOT NULL DEFAULT 0,
+  max_duration NUMERIC NOT NULL DEFAULT 0,
+  timed_rows BIGINT NOT NULL DEFAULT 0, -- lignes écrites par les syncs mesurées
+  duration_hist INTEGER[] NOT NULL DEFAULT array_fill(0, ARRAY[11]),
+  updated_at TIMESTAMPTZ DEFAULT NOW(),
+  PRIMARY KEY (jour, sync_type)
+);
+
+CREATE INDEX IF NOT EXISTS idx_parc_sync_logs_date ON parc_sync_logs(sync_date DESC);
+
+-- Classe d'histogramme (1..11) d'une durée
+CREATE OR REPLACE FUNCTION parc_sync_duration_bucket(duration NUMERIC) RETURNS INTEGER AS $$
+  SELECT width_bucket(duration, ARRAY[1, 2, 5, 10, 20, 30, 60, 120, 300, 600]::NUMERIC[]) + 1;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION parc_sync_stats_on_log() RETURNS TRIGGER AS $$
+DECLARE
+  duration NUMERIC := COALESCE(NEW.duration_seconds, 0);
+  timed BOOLEAN := COALESCE(NEW.duration_seconds, 0) > 0;
+  nb_rows BIGINT := COALESCE(NEW.equipements_count, 0) + COALESCE(NEW.pannes_count, 0) + COALESCE(NEW.arrets_count, 0);
+  bucket INTEGER := parc_sync_duration_bucket(COALESCE(NEW.duration_seconds, 0));
+  hist INTEGER[] := array_fill(0, ARRAY[11]);
+BEGIN
+  IF timed THEN
+    hist[bucket] := 1;
+  END IF;
+
+  INSERT INTO parc_sync_stats AS s (
+    jour, sync_type, nb_syncs, nb_success, nb_partial, nb_errors,
+    nb_timed, total_duration, max_duration, timed_rows, duration_hist
+  ) VALUES (
+    COALESCE(NEW.sync_date, NOW())::date,
+    COALESCE(NEW.sync_type, 'other'),
+    1,
+    (NEW.status = 'success')::int,
+    (NEW.status = 'partial')::int,
+    (NEW.status = 'error')::int,
+    timed::int,
+    CASE WHEN timed THEN duration ELSE 0 END,
+    duration,
+    CASE WHEN timed THEN nb_rows ELSE 0 END,
+    hist
+  )
+  ON CONFLICT (jour, sync_type) DO UPDATE SET
+    nb_syncs = s.nb_syncs + 1,
+    nb_success = s.nb_success + EXCLUDED.nb_success,
+    nb_partial = s.nb_partial + EXCLUDED.nb_partial,
+    nb_errors = s.nb_errors + EXCLUDED.nb_errors,
+    nb_timed = s.nb_timed + EXCLUDED.nb_timed,
+    total_duration = s.total_duration + EXCLUDED.total_duration,
+    max_duration = GREATEST(s.max_duration, EXCLUDED.max_duration),
+    timed_rows = s.timed_rows + EXCLUDED.timed_rows,
+    duration_hist = (
+      SELECT array_agg(a + b ORDER BY i)
+      FROM unnest(s.duration_hist, EXCLUDED.duration_hist) WITH ORDINALITY AS t(a, b, i)
+    ),
+    updated_at = NOW();
+
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Reprise de l'historique existant (avant la création du trigger)
+INSERT INTO parc_sync_stats (
+  jour, sync_type, nb_syncs, nb_success, nb_partial, nb_errors,
+  nb_timed, total_duration, max_duration, timed_rows, duration_hist
+)
+SELECT
+  l.jour,
+  l.st,
+  count(*),
+  count(*) FILTER (WHERE l.status = 'success'),
+  count(*) FILTER (WHERE l.status = 'partial'),
+  count(*) FILTER (WHERE l.status = 'error'),
+  count(*) FILTER (WHERE l.d > 0),
+  COALESCE(sum(l.d) FILTER (WHERE l.d > 0), 0),
+  COALESCE(max(l.d), 0),
+  COALESCE(sum(l.nb_rows) FILTER (WHERE l.d > 0), 0),
+  (
+    SELECT array_agg(count_bucket ORDER BY b)
+    FROM (
+      SELECT b, (
+        SELECT count(*)::int FROM parc_sync_logs x
+        WHERE x.sync_date::date = l.jour
+          AND COALESCE(x.sync_type, 'other') = l.st
+          AND COALESCE(x.duration_seconds, 0) > 0
+          AND parc_sync_duration_bucket(x.duration_seconds) = b
+      ) AS count_bucket
+      FROM generate_series(1, 11) AS b
+    ) h
+  )
+FROM (
+  SELECT
+    sync_date::date AS jour,
+    COALESCE(sync_type, 'other') AS st,
+    status,
+    COALESCE(duration_seconds, 0) AS d,
+    COALESCE(equipements_count, 0) + COALESCE(pannes_count, 0) + COALESCE(arrets_count, 0) AS nb_rows
+  FROM parc_sync_logs
+  WHERE sync_date IS NOT NULL
+) l
+GROUP BY l.jour, l.st
+ON CONFLICT (jour, sync_type) DO NOTHING;
+
+DROP TRIGGER IF EXISTS trigger_parc_sync_stats ON parc_sync_logs;
+CREATE TRIGGER trigger_parc_sync_stats AFTER INSERT ON parc_sync_logs FOR EACH ROW EXECUTE FUNCTION parc_sync_stats_on_log();
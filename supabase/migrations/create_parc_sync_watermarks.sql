@@ -0,0 +1,14 @@
+-- ============================================
+-- FILIGRANES DE SYNCHRONISATION PROGILIFT
+-- ============================================
+-- Une ligne par périmètre de sync (ex: 'pannes'). watermark = début de la
+-- dernière exécution réussie; le cron ne redemande à Progilift que les
+-- modifications postérieures (moins une marge de sécurité). Après un échec
+-- (status <> 'success'), le cron repart sur la fenêtre de 30 jours.
+
+CREATE TABLE IF NOT EXISTS parc_sync_watermarks (
+  scope TEXT PRIMARY KEY,
+  watermark TIMESTAMP,
+  status TEXT,
+  updated_at TIMESTAMPTZ DEFAULT NOW()
+);